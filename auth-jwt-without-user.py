@@ -1,11 +1,14 @@
+import os
 from datetime import datetime, timedelta
 from typing import Union
 
 from fastapi import Depends, FastAPI, HTTPException, status
 from fastapi.security import HTTPBasicCredentials, HTTPBearer
-from jose import JWTError, jwt
+from jose import JWTError
 from pydantic import BaseModel
 
+from jwt_keys import load_key_ring
+
 
 # This solution using HTTPBearer to authenticate
 # So we don't need to use username and password to authenticate
@@ -15,9 +18,13 @@ from pydantic import BaseModel
 # to get a string like this run:
 # openssl rand -hex 32
 SECRET_KEY = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
-ALGORITHM = "HS256"
+ALGORITHM = os.getenv("JWT_ALGORITHM", "RS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# other services can verify our tokens by only the public keys (*.pub.pem) in JWT_KEYS_DIR
+# check jwt_keys.py for how to config the keys
+key_ring = load_key_ring(ALGORITHM, secret_key=SECRET_KEY)
+
 
 class Token(BaseModel):
     access_token: str
@@ -33,7 +40,7 @@ def create_access_token(expires_delta: Union[timedelta, None] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode = {"exp": expire}
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = key_ring.encode(to_encode)
     return encoded_jwt
 
 
@@ -49,10 +56,11 @@ async def check_access_token(credentials: HTTPBasicCredentials = Depends(HTTPBea
 
     token = credentials.credentials
 
+    # the signature is verified by the public key of the kid in the token header
+    # before, we used verify_signature=False here, so any token was accepted
     try:
-        payload = jwt.decode(token, key='secret', options={"verify_signature": False,
-                                                           "verify_aud": False,
-                                                           "verify_iss": False})
+        payload = key_ring.decode(token, options={"verify_aud": False,
+                                                  "verify_iss": False})
         if payload is None:
             raise credentials_exception
         return payload
@@ -1,12 +1,15 @@
+import os
 from datetime import datetime, timedelta
 from typing import Union
 
 from fastapi import Depends, FastAPI, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
+from jose import JWTError
 from passlib.context import CryptContext
 from pydantic import BaseModel
 
+from jwt_keys import load_key_ring
+
 
 # This solution using OAuth2PasswordRequestForm as authenticate
 # So we need to transfer username and password to grand the access
@@ -15,9 +18,14 @@ from pydantic import BaseModel
 # to get a string like this run:
 # openssl rand -hex 32
 SECRET_KEY = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
-ALGORITHM = "HS256"
+ALGORITHM = os.getenv("JWT_ALGORITHM", "RS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# the key ring signs tokens by the active kid, and verifies them by the kid in the token header
+# with RS256/ES256, SECRET_KEY is not used, check jwt_keys.py for how to config the keys
+# set JWT_ALGORITHM=HS256 to go back to the shared SECRET_KEY
+key_ring = load_key_ring(ALGORITHM, secret_key=SECRET_KEY)
+
 
 # password is "secret"
 fake_users_db = {
@@ -88,7 +96,7 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = key_ring.encode(to_encode)
     return encoded_jwt
 
 
@@ -99,7 +107,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = key_ring.decode(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
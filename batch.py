@@ -0,0 +1,244 @@
+import asyncio
+import json
+import logging
+import os
+from contextlib import ExitStack, contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Union
+
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import BaseModel, Field
+
+# Batch requests: the client sends N small requests in 1 HTTP request, and gets the N responses in 1 body
+#
+# ex: a page needs a user, its items, and some items by id
+#   POST /batch/
+#   {"requests": [
+#       {"path": "/users/1"},
+#       {"path": "/items/?owner_id=1"},
+#       {"method": "POST", "path": "/users/1/items/", "body": {"title": "Foo"}}
+#   ]}
+# =>
+#   [{"status": 200, "headers": {...}, "body": {...}}, {"status": 200, ...}, {"status": 200, ...}]
+#
+# the sub-requests don't go through the network, they are sent to the app in the same process (ASGI),
+# at most "concurrency" of them at the same time, with asyncio.gather()
+# so the page pays for 1 connection, 1 TLS handshake, 1 round trip instead of N
+#
+# - the headers of the batch (ex: Authorization, X-Token) are given to every sub-request,
+#   a sub-request can add or override headers
+# - the dependencies of the batch route (ex: the auth check) run once for the whole batch,
+#   a bad token rejects the batch before any sub-request runs
+# - shared resources, ex: the db session: "lane" gives a resource per concurrent slot,
+#   the sub-requests that run one after the other on a slot reuse it, they find it in request.state
+#   (a db session can't be used by 2 threads at the same time, so it's not shared by the whole batch)
+# - a sub-request always gets its own response, a failure doesn't fail the batch
+# - a streaming response (text/event-stream, ex: GET /feed/) never ends, so it's rejected with a 400
+#
+# add it to an app:
+#   add_batch_route(app)
+#
+# config by env:
+# BATCH_MAX_REQUESTS: the max number of sub-requests in a batch, default is 50
+# BATCH_CONCURRENCY: the sub-requests of a batch that run at the same time, default is 8
+
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+# the headers of the batch request that describe its own body, they are not given to the sub-requests
+# nor its Idempotency-Key: the sub-requests would share it and collide (check idempotency.py),
+# a sub-request can send its own key in its "headers"
+SKIPPED_HEADERS = {b"content-length", b"content-type", b"transfer-encoding", b"expect", b"idempotency-key"}
+
+logger = logging.getLogger("batch")
+
+
+class SubRequest(BaseModel):
+    method: str = "GET"
+    # with the query string, ex: /items/?owner_id=1
+    path: str = Field(regex=r"^/")
+    headers: Dict[str, str] = {}
+    # sent as JSON
+    body: Any = None
+
+
+class Batch(BaseModel):
+    requests: List[SubRequest]
+
+
+class SubResponse(BaseModel):
+    status: int
+    headers: Dict[str, str]
+    # the JSON of the response, or its text when it's not JSON
+    body: Any = None
+
+
+class _Capture:
+    # the ASGI "send" of a sub-request, keeps the response in memory
+    def __init__(self):
+        self.status = 500
+        self.headers = []
+        self.chunks = []
+        # a stream (ex: GET /feed/) never ends by itself, it can't be put in the body of the batch
+        self.stream = False
+        # set when the sub-request must get "http.disconnect": its response is complete, it's a stream,
+        # or the client of the batch went away. a StreamingResponse only stops on a disconnect
+        self.closed = asyncio.Event()
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+            self.headers = message.get("headers", [])
+            if dict(self.headers).get(b"content-type", b"").startswith(b"text/event-stream"):
+                self.stream = True
+                self.closed.set()
+        elif message["type"] == "http.response.body":
+            if not self.stream:
+                self.chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                self.closed.set()
+
+    def response(self) -> SubResponse:
+        if self.stream:
+            return _error(400, "A batch can't contain a streaming response")
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in self.headers}
+        body = b"".join(self.chunks)
+        content = body.decode("utf-8", errors="replace")
+        if headers.get("content-type", "").startswith("application/json") and body:
+            try:
+                content = json.loads(body)
+            except ValueError:
+                # a body that says it's JSON but isn't, it's returned as text
+                pass
+        return SubResponse(status=self.status, headers=headers, body=content)
+
+
+def _encode_headers(headers: Dict[str, str]) -> Dict[bytes, bytes]:
+    # the headers of a sub-request, like the server would get them from the network: latin-1, without line breaks
+    # raises ValueError for a header that can't be sent, the sub-request gets a 400
+    encoded = {}
+    for name, value in headers.items():
+        if not name or any(c in name for c in " :\r\n") or any(c in value for c in "\r\n\x00"):
+            raise ValueError(f"Invalid header: {name!r}")
+        try:
+            encoded[name.lower().encode("latin-1")] = value.encode("latin-1")
+        except UnicodeEncodeError:
+            raise ValueError(f"The header {name!r} must be latin-1")
+    return encoded
+
+
+def _error(status: int, detail: str) -> SubResponse:
+    return SubResponse(status=status, headers={"content-type": "application/json"}, body={"detail": detail})
+
+
+class BatchDispatcher:
+    def __init__(self, app, batch_path: str, concurrency: int = BATCH_CONCURRENCY,
+                 lane: Callable[[], Iterator[Dict[str, Any]]] = None):
+        self.app = app
+        self.batch_path = batch_path
+        self.concurrency = concurrency
+        # a generator function, like a FastAPI dependency with yield:
+        # it yields the shared resources of a slot (put in request.state), then it cleans them up
+        self.lane = contextmanager(lane) if lane is not None else None
+
+    def _scope(self, parent: dict, sub: SubRequest, body: bytes, overrides: Dict[bytes, bytes],
+               state: Dict[str, Any]) -> dict:
+        path, _, query = sub.path.partition("?")
+        headers = [(name, value) for name, value in parent["headers"] if name not in SKIPPED_HEADERS]
+        headers = [(name, value) for name, value in headers if name not in overrides] + list(overrides.items())
+        if body:
+            headers += [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        return {
+            "type": "http",
+            "asgi": parent.get("asgi", {"version": "3.0"}),
+            "http_version": parent.get("http_version", "1.1"),
+            "method": sub.method.upper(),
+            "scheme": parent.get("scheme", "http"),
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": parent.get("root_path", ""),
+            "query_string": query.encode(),
+            "headers": headers,
+            "client": parent.get("client"),
+            "server": parent.get("server"),
+            "state": dict(state),
+        }
+
+    async def _send(self, parent: dict, sub: SubRequest, state: Dict[str, Any], capture: _Capture) -> SubResponse:
+        if sub.path.partition("?")[0] == self.batch_path:
+            return _error(400, "A batch can't contain another batch")
+        try:
+            overrides = _encode_headers(sub.headers)
+        except ValueError as e:
+            return _error(400, str(e))
+        body = json.dumps(sub.body).encode() if sub.body is not None else b""
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # like a client that goes away once it has its response
+            await capture.closed.wait()
+            return {"type": "http.disconnect"}
+
+        try:
+            await self.app(self._scope(parent, sub, body, overrides, state), receive, capture)
+            return capture.response()
+        except Exception:
+            # the other sub-requests go on
+            logger.exception("sub-request %s %s failed", sub.method, sub.path)
+            return _error(500, "Internal Server Error")
+
+    async def dispatch(self, request: Request, requests: Sequence[SubRequest]) -> List[SubResponse]:
+        # 1 slot per concurrent sub-request, a sub-request takes a free slot and gives it back when it's done
+        slots = asyncio.Queue()
+        with ExitStack() as stack:
+            for _ in range(min(self.concurrency, len(requests))):
+                slots.put_nowait(stack.enter_context(self.lane()) if self.lane is not None else {})
+
+            captures = set()
+            gone = False
+
+            async def watch():
+                # after the body of the batch, the next message of the server is "http.disconnect",
+                # when the client goes away (or when the response of the batch is sent)
+                nonlocal gone
+                while (await request.receive())["type"] != "http.disconnect":
+                    pass
+                gone = True
+                for capture in captures:
+                    capture.closed.set()
+
+            async def run(sub: SubRequest) -> SubResponse:
+                state = await slots.get()
+                capture = _Capture()
+                captures.add(capture)
+                if gone:
+                    capture.closed.set()
+                try:
+                    return await self._send(request.scope, sub, state, capture)
+                finally:
+                    captures.discard(capture)
+                    slots.put_nowait(state)
+
+            watcher = asyncio.ensure_future(watch())
+            try:
+                return await asyncio.gather(*[run(sub) for sub in requests])
+            finally:
+                watcher.cancel()
+
+
+def add_batch_route(app: FastAPI, path: str = "/batch/", max_requests: int = BATCH_MAX_REQUESTS,
+                    concurrency: int = BATCH_CONCURRENCY, lane: Callable[[], Iterator[Dict[str, Any]]] = None,
+                    dependencies: Union[Sequence, None] = None):
+    # dispatch through the whole app, with its middlewares, like a request from the network
+    dispatcher = BatchDispatcher(app, path, concurrency=concurrency, lane=lane)
+
+    @app.post(path, response_model=List[SubResponse], dependencies=dependencies)
+    async def batch(batch: Batch, request: Request):
+        if len(batch.requests) > max_requests:
+            raise HTTPException(status_code=413, detail=f"A batch has at most {max_requests} requests")
+        return await dispatcher.dispatch(request, batch.requests)
+
+    return dispatcher
@@ -0,0 +1,88 @@
+# a page of sql_app loaded with separate calls against 1 POST /batch/
+# run from the project folder:
+# => python -m benchmarks.bench_batch
+# => python -m benchmarks.bench_batch --calls 20 --pages 50
+#
+# the page needs: the user, its items, and N-2 other users by id
+# - sequential: the calls one after the other on 1 keep-alive connection
+# - parallel: all the calls at the same time, on up to 6 connections like a browser
+# - batch: 1 request with all the calls
+# the server is uvicorn with sql_app, on a temp db
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load import free_port, wait_for_server
+
+
+async def load_page(client: httpx.AsyncClient, mode: str, paths):
+    if mode == "sequential":
+        for path in paths:
+            (await client.get(path)).raise_for_status()
+    elif mode == "parallel":
+        for response in await asyncio.gather(*[client.get(path) for path in paths]):
+            response.raise_for_status()
+    else:
+        response = await client.post("/batch/", json={"requests": [{"path": path} for path in paths]})
+        assert all(result["status"] == 200 for result in response.json())
+
+
+async def run(base_url: str, calls: int, pages: int) -> dict:
+    limits = httpx.Limits(max_connections=6)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits) as client:
+        user_ids = []
+        for i in range(calls):
+            user_id = (await client.post("/users/", json={"email": f"u{i}@example.com", "password": "x"})).json()["id"]
+            await client.post(f"/users/{user_id}/items/", json={"title": f"Item {i}"})
+            user_ids.append(user_id)
+        paths = [f"/users/{user_ids[0]}", f"/items/?owner_id={user_ids[0]}"]
+        paths += [f"/users/{user_id}" for user_id in user_ids[1:calls - 1]]
+
+        results = {}
+        for mode in ["sequential", "parallel", "batch"]:
+            await load_page(client, mode, paths)
+            times = []
+            for _ in range(pages):
+                start = time.perf_counter()
+                await load_page(client, mode, paths)
+                times.append((time.perf_counter() - start) * 1000)
+            results[mode] = statistics.median(times)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="separate calls against POST /batch/")
+    parser.add_argument("--calls", type=int, default=15, help="calls per page")
+    parser.add_argument("--pages", type=int, default=30)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "SQL_APP_DATABASE_URL": f"sqlite:///{tmp}/bench.db", "SQL_APP_AUTO_MIGRATE": "1"}
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "sql_app.main:app", "--port", str(port), "--log-level", "warning"],
+            env=env,
+        )
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            asyncio.run(wait_for_server(base_url, process))
+            results = asyncio.run(run(base_url, args.calls, args.pages))
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(f"{'mode':<12}{'page ms':>10}")
+    for mode, ms in results.items():
+        print(f"{mode:<12}{ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# measure how fast N sql_app workers reach the ready state
+# run from the project folder:
+# => python -m benchmarks.bench_boot
+# => python -m benchmarks.bench_boot --workers 1 4 8 --json bench_boot.json
+#
+# modes:
+# - create_all: the old way, every worker runs models.Base.metadata.create_all() on boot
+# - version check: the schema is created once by "python -m sql_app.schema",
+#                  then every worker only checks the version at startup
+#
+# N workers are started at the same time on the same db, like "uvicorn --workers N" does
+# "ready" is the time from the start of the process until the startup handlers finished
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+WORKER = r"""
+import sys, time
+mode = sys.argv[1]
+if mode == "create_all":
+    from sql_app import models
+    from sql_app.database import engine
+    models.Base.metadata.create_all(bind=engine)
+from sql_app.main import app, check_schema
+if mode == "check":
+    check_schema()
+print(time.time())
+"""
+
+
+def boot(workers: int, mode: str, db_url: str) -> dict:
+    env = {**os.environ, "SQL_APP_DATABASE_URL": db_url}
+    start = time.time()
+    processes = [subprocess.Popen([sys.executable, "-c", WORKER, mode], env=env, text=True,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                 for _ in range(workers)]
+    ready = []
+    failed = 0
+    for process in processes:
+        out, _ = process.communicate()
+        if process.returncode != 0:
+            # ex: two workers run CREATE TABLE on an empty db at the same time
+            failed += 1
+            continue
+        ready.append((float(out.strip().splitlines()[-1]) - start) * 1000)
+    return {
+        "workers": workers,
+        "failed": failed,
+        "median_ready_ms": statistics.median(ready) if ready else None,
+        "all_ready_ms": max(ready) if ready else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sql_app boot time with N workers")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            # create_all on an empty db: every worker creates the tables, and they race
+            empty = f"sqlite:///{tmp}/empty-{workers}.db"
+            results.append({"mode": "create_all, empty db", **boot(workers, "create_all", empty)})
+
+            # create_all on an existing db: every worker still inspects every table
+            existing = f"sqlite:///{tmp}/existing-{workers}.db"
+            subprocess.run([sys.executable, "-m", "sql_app.schema"], check=True, capture_output=True,
+                           env={**os.environ, "SQL_APP_DATABASE_URL": existing})
+            results.append({"mode": "create_all, existing db", **boot(workers, "create_all", existing)})
+
+            # the new way: the schema step ran once above, the workers only check the version
+            results.append({"mode": "version check", **boot(workers, "check", existing)})
+
+    print(f"{'mode':<26}{'workers':>8}{'failed':>8}{'median ready ms':>17}{'all ready ms':>14}")
+    for r in results:
+        median = f"{r['median_ready_ms']:.1f}" if r["median_ready_ms"] is not None else "-"
+        everyone = f"{r['all_ready_ms']:.1f}" if r["all_ready_ms"] is not None else "-"
+        print(f"{r['mode']:<26}{r['workers']:>8}{r['failed']:>8}{median:>17}{everyone:>14}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# fan-out of the change feed (GET /feed/) to many subscribers in 1 worker
+# run from the project folder:
+# => python -m benchmarks.bench_feed
+# => python -m benchmarks.bench_feed --subscribers 1000 5000 10000 --items 200
+#
+# N subscribers read the feed like N SSE clients, while the items are created through crud
+# we measure the delay between the commit of the last item and the moment every subscriber has it,
+# and the events sent per second
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+
+async def run(subscribers: int, items: int) -> dict:
+    import anyio.to_thread
+
+    from sql_app import crud, schemas
+    from sql_app.database import LazySession
+    from sql_app.feed import ChangeFeed
+
+    feed = ChangeFeed(poll_interval=60)
+    await feed.start()
+    try:
+        db = LazySession()
+        user_id = crud.create_user(db, schemas.UserCreate(email=f"bench{subscribers}@example.com", password="x")).id
+        db.close()
+        await asyncio.sleep(0.1)
+
+        received = [0] * subscribers
+        done = asyncio.Event()
+        remaining = [subscribers]
+
+        async def consume(index):
+            stream = feed.stream(feed.subscribe())
+            try:
+                async for chunk in stream:
+                    received[index] += chunk.count(b"\nevent: item\n")
+                    if received[index] >= items:
+                        remaining[0] -= 1
+                        if not remaining[0]:
+                            done.set()
+                        return
+            finally:
+                await stream.aclose()
+
+        tasks = [asyncio.create_task(consume(index)) for index in range(subscribers)]
+        await asyncio.sleep(0.1)
+
+        def create_items():
+            for i in range(items):
+                db = LazySession()
+                crud.create_user_item(db, schemas.ItemCreate(title=f"Item {i}", description="bench"), user_id)
+                db.close()
+            return time.perf_counter()
+
+        start = time.perf_counter()
+        last_commit = await anyio.to_thread.run_sync(create_items)
+        await done.wait()
+        end = time.perf_counter()
+        await asyncio.gather(*tasks)
+        return {
+            "delay_ms": (end - last_commit) * 1000,
+            "events_per_second": subscribers * items / (end - start),
+            "lagged": feed.stats["lagged"],
+        }
+    finally:
+        await feed.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="change feed fan-out")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--items", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQL_APP_DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        from sql_app import schema
+        from sql_app.database import engine
+
+        schema.migrate(engine)
+        print(f"{'subscribers':>12}{'last delay ms':>15}{'events/s':>12}{'lagged':>8}")
+        for subscribers in args.subscribers:
+            result = asyncio.run(run(subscribers, args.items))
+            print(f"{subscribers:>12}{result['delay_ms']:>15.1f}{result['events_per_second']:>12.0f}"
+                  f"{result['lagged']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# full responses against sparse fieldsets (?fields=...) on GET /users/
+# run from the project folder:
+# => python -m benchmarks.bench_fields
+# => python -m benchmarks.bench_fields --users 1000 --items-per-user 20
+#
+# for each fieldset: the time of one page (median) and the size of the body
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+FIELDSETS = [None, "id,email,is_active,items", "id,email", "id"]
+
+
+async def run(users: int, items_per_user: int, page: int, repeat: int):
+    from sql_app.main import app, flight
+
+    # no sharing between the requests, we measure the work of 1 request
+    flight.max_waiters = 0
+    results = []
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as client:
+            for i in range(users):
+                user_id = (await client.post("/users/", json={"email": f"u{i}@example.com", "password": "x"})).json()["id"]
+                for j in range(items_per_user):
+                    await client.post(f"/users/{user_id}/items/", json={"title": f"Item {j}", "description": "bench"})
+
+            for fields in FIELDSETS:
+                params = {"limit": page} if fields is None else {"limit": page, "fields": fields}
+                times = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    response = await client.get("/users/", params=params)
+                    times.append((time.perf_counter() - start) * 1000)
+                results.append((fields or "(all)", statistics.median(times), len(response.content)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sparse fieldsets on GET /users/")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--items-per-user", type=int, default=10)
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQL_APP_DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        os.environ["SQL_APP_AUTO_MIGRATE"] = "1"
+        results = asyncio.run(run(args.users, args.items_per_user, args.page, args.repeat))
+
+    print(f"{'fields':<28}{'ms':>8}{'bytes':>10}")
+    for fields, ms, size in results:
+        print(f"{fields:<28}{ms:>8.2f}{size:>10}")
+
+
+if __name__ == "__main__":
+    main()
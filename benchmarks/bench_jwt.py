@@ -0,0 +1,80 @@
+# benchmark the JWT verify throughput for each algorithm
+# run from the project folder:
+# => python -m benchmarks.bench_jwt
+# => python -m benchmarks.bench_jwt --seconds 2 --json bench_jwt.json
+#
+# for each algorithm, we compare:
+# - "cached key": KeyRing.decode(), the key is parsed once and cached by kid
+# - "pem per call": jwt.decode(token, pem), jose parses the PEM again on every call
+
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+
+from jose import jwt
+
+from jwt_keys import KeyRing, generate_private_key
+
+ALGORITHMS = ["HS256", "RS256", "ES256"]
+
+
+def ops_per_second(func, seconds: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        # check the clock every 100 calls, so the clock doesn't cost more than the work
+        for _ in range(100):
+            func()
+        count += 100
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - start)
+
+
+def bench_algorithm(algorithm: str, seconds: float) -> dict:
+    if algorithm.startswith("HS"):
+        private_pem = public_pem = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
+    else:
+        private_pem = generate_private_key(algorithm)
+        public_pem = None
+
+    ring = KeyRing(algorithm)
+    ring.add_key("bench", private_key=private_pem)
+    if public_pem is None:
+        public_pem = ring.export_public_key("bench")
+
+    claims = {"sub": "johndoe", "exp": datetime.utcnow() + timedelta(hours=1)}
+    token = ring.encode(claims)
+
+    return {
+        "algorithm": algorithm,
+        "sign_cached_key": ops_per_second(lambda: ring.encode(claims), seconds),
+        "verify_cached_key": ops_per_second(lambda: ring.decode(token), seconds),
+        "verify_pem_per_call": ops_per_second(lambda: jwt.decode(token, public_pem, algorithms=[algorithm]), seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JWT sign/verify throughput")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time to run each case")
+    parser.add_argument("--algorithms", nargs="+", default=ALGORITHMS)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = [bench_algorithm(algorithm, args.seconds) for algorithm in args.algorithms]
+
+    print(f"{'algorithm':<10}{'sign/s':>14}{'verify/s':>14}{'verify pem/s':>16}{'speedup':>10}")
+    for r in results:
+        speedup = r["verify_cached_key"] / r["verify_pem_per_call"]
+        print(f"{r['algorithm']:<10}{r['sign_cached_key']:>14.0f}{r['verify_cached_key']:>14.0f}"
+              f"{r['verify_pem_per_call']:>16.0f}{speedup:>9.1f}x")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
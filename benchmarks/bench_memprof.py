@@ -0,0 +1,92 @@
+# the cost of MEMPROF=1 on a worker of sql_app, is it cheap enough for a canary?
+# run from the project folder:
+# => python -m benchmarks.bench_memprof
+# => python -m benchmarks.bench_memprof --requests 3000 --concurrency 20 --writes 0
+#
+# the same load (GET /users/ and some POST /users/{id}/items/) on uvicorn with:
+# - memprof off
+# - MEMPROF=1 with 1 frame per allocation (the default)
+# - MEMPROF=1 with 10 frames per allocation
+# and the requests per second and the RSS of the worker at the end
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load import free_port, wait_for_server
+
+# MEMPROF_ADMIN=1: the off mode still has GET /admin/memory for the RSS, tracemalloc stays off
+MODES = [
+    ("off", {"MEMPROF": "0", "MEMPROF_ADMIN": "1"}),
+    ("frames=1", {"MEMPROF": "1", "MEMPROF_FRAMES": "1"}),
+    ("frames=10", {"MEMPROF": "1", "MEMPROF_FRAMES": "10"}),
+]
+# the /admin/ routes of the bench server need it
+ADMIN_TOKEN = "bench"
+
+
+async def load(base_url: str, requests: int, concurrency: int, writes: float) -> dict:
+    # frames=10 is slow, a request can wait more than the 5 s default of httpx
+    async with httpx.AsyncClient(base_url=base_url, limits=httpx.Limits(max_connections=concurrency),
+                                 timeout=60) as client:
+        user_id = (await client.post("/users/", json={"email": "bench@example.com", "password": "x"})).json()["id"]
+        queue = asyncio.Queue()
+        every = round(1 / writes) if writes else 0
+        for i in range(requests):
+            queue.put_nowait(i)
+
+        async def worker():
+            while not queue.empty():
+                i = queue.get_nowait()
+                if every and i % every == 0:
+                    await client.post(f"/users/{user_id}/items/", json={"title": f"Item {i}"})
+                else:
+                    await client.get("/users/", params={"limit": 20})
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        seconds = time.perf_counter() - start
+        memory = (await client.get("/admin/memory", headers={"X-Admin-Token": ADMIN_TOKEN})).json()
+    return {"rps": requests / seconds, "rss_mb": memory["rss_bytes"] / 2 ** 20}
+
+
+def run(env: dict, requests: int, concurrency: int, writes: float) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        # the writers wait for the sqlite lock, the slow query log would print every wait
+        env = {**os.environ, **env, "SQL_APP_DATABASE_URL": f"sqlite:///{tmp}/bench.db", "SQL_APP_AUTO_MIGRATE": "1",
+               "SQL_APP_SLOW_QUERY_MS": "60000", "SQL_APP_ADMIN_TOKEN": ADMIN_TOKEN}
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "sql_app.main:app", "--port", str(port), "--log-level", "warning"],
+            env=env,
+        )
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            asyncio.run(wait_for_server(base_url, process))
+            return asyncio.run(load(base_url, requests, concurrency, writes))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cost of MEMPROF=1")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--writes", type=float, default=0.25, help="the part of the requests that create an item")
+    args = parser.parse_args()
+
+    print(f"{'mode':<12}{'req/s':>8}{'rss MB':>8}")
+    for name, env in MODES:
+        result = run(env, args.requests, args.concurrency, args.writes)
+        print(f"{name:<12}{result['rps']:>8.0f}{result['rss_mb']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
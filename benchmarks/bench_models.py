@@ -0,0 +1,76 @@
+# micro benchmark: validate (parse_obj / from_orm) vs construct_trusted() for our models
+# run from the project folder:
+# => python -m benchmarks.bench_models
+# => python -m benchmarks.bench_models --number 2000 --json bench_models.json
+#
+# "validate" is what FastAPI does for the client data
+# "trusted" is construct_trusted(), for the data from our own stores
+# "construct" is pydantic Model.construct(), it's shallow, the nested models stay as dicts
+
+import argparse
+import json
+import timeit
+
+from main import Item, Item1
+from sql_app import schemas
+from trusted import construct_trusted
+
+
+def item_data(images: int) -> dict:
+    return {
+        "name": "Foo",
+        "description": "A very nice Item",
+        "price": 35.4,
+        "tax": 3.2,
+        "tags": ["a", "b", "c"],
+        "tags2": ["x", "y"],
+        "image": {"url": "http://example.com/main.png", "name": "main"},
+        "images": [{"url": f"http://example.com/{i}.png", "name": f"image {i}"} for i in range(images)],
+    }
+
+
+def user_data(items: int) -> dict:
+    return {
+        "id": 1,
+        "email": "johndoe@example.com",
+        "is_active": True,
+        "version": 1,
+        "items": [{"id": i, "title": f"Item {i}", "description": "seed", "owner_id": 1, "version": 1}
+                  for i in range(items)],
+    }
+
+
+CASES = [
+    ("Item1", Item1, {"id": "foo", "title": "Foo", "description": "There goes my hero"}),
+    ("Item, 2 images", Item, item_data(2)),
+    ("Item, 20 images", Item, item_data(20)),
+    ("schemas.User, 0 items", schemas.User, user_data(0)),
+    ("schemas.User, 10 items", schemas.User, user_data(10)),
+    ("schemas.User, 100 items", schemas.User, user_data(100)),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pydantic validate vs trusted construct")
+    parser.add_argument("--number", type=int, default=5000, help="calls per case")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'case':<26}{'validate us':>13}{'trusted us':>12}{'construct us':>14}{'speedup':>9}")
+    for name, model, data in CASES:
+        # make sure both ways give the same model
+        assert construct_trusted(model, data) == model.parse_obj(data)
+        validate = timeit.timeit(lambda: model.parse_obj(data), number=args.number) / args.number * 1e6
+        trusted = timeit.timeit(lambda: construct_trusted(model, data), number=args.number) / args.number * 1e6
+        construct = timeit.timeit(lambda: model.construct(**data), number=args.number) / args.number * 1e6
+        results.append({"case": name, "validate_us": validate, "trusted_us": trusted, "construct_us": construct})
+        print(f"{name:<26}{validate:>13.2f}{trusted:>12.2f}{construct:>14.2f}{validate / trusted:>8.1f}x")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# measure the cold start of main.py with and without the prebuilt OpenAPI schema
+# run from the project folder:
+# => python -m benchmarks.bench_openapi
+# => python -m benchmarks.bench_openapi --runs 10 --json bench_openapi.json
+#
+# each run starts a new python process (like a new worker) and measures:
+# - import: time to import main.py
+# - startup: time to run the startup handlers (the prebuilt schema is loaded here)
+# - first: time of the first /openapi.json request
+# - second: time of the second /openapi.json request (always served from memory)
+#
+# modes:
+# - no cache: OPENAPI_CACHE=0, FastAPI builds the schema on the first request
+# - cold cache: the cache is empty, the first worker builds the schema at startup and saves it
+# - prebuilt: the schema is built ahead of time by "python -m openapi_cache main:app"
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+WORKER = r"""
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+client = TestClient(main.app)
+client.__enter__()
+started = time.perf_counter()
+client.get("/openapi.json")
+first = time.perf_counter()
+client.get("/openapi.json")
+second = time.perf_counter()
+client.__exit__(None, None, None)
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "startup_ms": (started - imported) * 1000,
+    "first_ms": (first - started) * 1000,
+    "second_ms": (second - first) * 1000,
+}))
+"""
+
+
+def run_worker(env: dict) -> dict:
+    output = subprocess.run([sys.executable, "-c", WORKER], env={**os.environ, **env},
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAPI cold start with and without the prebuilt schema")
+    parser.add_argument("--runs", type=int, default=5, help="worker processes per mode")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        results["no cache"] = summarize([run_worker({"OPENAPI_CACHE": "0"}) for _ in range(args.runs)])
+
+        cold = []
+        for i in range(args.runs):
+            # a new empty folder for each run, so each run builds the schema
+            cold.append(run_worker({"OPENAPI_CACHE_DIR": os.path.join(tmp, f"cold{i}")}))
+        results["cold cache"] = summarize(cold)
+
+        prebuilt_dir = os.path.join(tmp, "prebuilt")
+        subprocess.run([sys.executable, "-m", "openapi_cache", "main:app", "--dir", prebuilt_dir],
+                       check=True, capture_output=True)
+        results["prebuilt"] = summarize([run_worker({"OPENAPI_CACHE_DIR": prebuilt_dir}) for _ in range(args.runs)])
+
+    print(f"{'mode':<12}{'import ms':>11}{'startup ms':>12}{'first req ms':>14}{'second req ms':>15}")
+    for mode, r in results.items():
+        print(f"{mode:<12}{r['import_ms']:>11.1f}{r['startup_ms']:>12.1f}{r['first_ms']:>14.2f}{r['second_ms']:>15.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
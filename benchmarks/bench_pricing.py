@@ -0,0 +1,86 @@
+# bulk quotes: a loop over Item models against pricing.py (NumPy on the columns)
+# run from the project folder:
+# => python -m benchmarks.bench_pricing
+# => python -m benchmarks.bench_pricing --items 500000 --repeat 5
+#
+# the same prices and taxes (1 item in 4 without tax), quoted by:
+# - Item loop: Item.parse_obj() + item_with_tax() for every item, then the sums, like N calls of create_item
+# - numpy, JSON: pricing.parse_body() of the JSON columns + pricing.quote()
+# - numpy, binary: the same from the binary body (N prices then N taxes, float64)
+# - POST json / POST binary: the whole endpoint /create_item/quote/, in process (no network)
+# the time is the best of --repeat runs
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+os.environ.setdefault("IDEMPOTENCY_DB", f"{tempfile.mkdtemp()}/idempotency.db")
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+import pricing
+from main import Item, app, item_with_tax
+
+
+def item_loop(rows):
+    totals = []
+    for row in rows:
+        item = item_with_tax(Item.parse_obj(row))
+        totals.append(item.get("price_with_tax", item["price"]))
+    return sum(totals)
+
+
+def best(function, repeat: int) -> float:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Item loop vs NumPy bulk quotes")
+    parser.add_argument("--items", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    prices = np.round(rng.uniform(1, 500, args.items), 2)
+    taxes = np.where(np.arange(args.items) % 4 == 0, np.nan, np.round(prices * 0.2, 2))
+    tax_list = [None if np.isnan(tax) else tax for tax in taxes.tolist()]
+    rows = [{"name": "x", "price": price, "tax": tax} for price, tax in zip(prices.tolist(), tax_list)]
+    json_body = json.dumps({"price": prices.tolist(), "tax": tax_list}).encode()
+    binary_body = np.concatenate([prices, taxes]).astype(pricing.FLOAT64).tobytes()
+    client = TestClient(app)
+
+    # make sure every way gives the same total
+    expected = item_loop(rows)
+    assert abs(pricing.quote(*pricing.parse_body(json_body))[1]["total_sum"] - expected) < 1e-6 * expected
+    assert abs(pricing.quote(*pricing.parse_body(binary_body, "application/octet-stream"))[1]["total_sum"]
+               - expected) < 1e-6 * expected
+
+    cases = [
+        ("Item loop", lambda: item_loop(rows)),
+        ("numpy, JSON", lambda: pricing.quote(*pricing.parse_body(json_body))),
+        ("numpy, binary", lambda: pricing.quote(*pricing.parse_body(binary_body, "application/octet-stream"))),
+        ("POST json", lambda: client.post("/create_item/quote/", content=json_body,
+                                          headers={"Content-Type": "application/json"}).raise_for_status()),
+        ("POST binary", lambda: client.post("/create_item/quote/", content=binary_body, headers={
+            "Content-Type": "application/octet-stream", "Accept": "application/octet-stream",
+        }).raise_for_status()),
+    ]
+    print(f"{args.items} items, json body {len(json_body) / 2 ** 20:.1f} MB, binary body {len(binary_body) / 2 ** 20:.1f} MB")
+    print(f"{'case':<16}{'ms':>10}{'items/s':>14}{'speedup':>9}")
+    baseline = None
+    for name, function in cases:
+        seconds = best(function, args.repeat)
+        baseline = baseline or seconds
+        print(f"{name:<16}{seconds * 1000:>10.1f}{args.items / seconds:>14,.0f}{baseline / seconds:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# compare the throughput of the default uvicorn setup with serve.py
+# run from the project folder:
+# => python -m benchmarks.bench_serve
+# => python -m benchmarks.bench_serve --app sql_app.main:app --requests 5000 --concurrency 100
+#
+# setups:
+# - default: "uvicorn main:app" with 1 worker, asyncio loop and h11
+# - serve.py, 1 worker: uvloop + httptools when installed
+# - serve.py, auto workers: 1 worker per CPU
+#
+# the load generator runs on the same machine, so it takes CPU from the server
+# on a machine with few CPUs, the multi worker numbers are limited by that
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import httpx
+
+from benchmarks.load import Endpoint, free_port, run_endpoint, wait_for_server
+from serve import default_workers
+
+ENDPOINTS = {
+    "main:app": [
+        Endpoint("GET /items/{item_id}", "GET", "/items/foo", lambda c: {"headers": {"X-Token": "coneofsilence"}}),
+        Endpoint("GET /items/", "GET", "/items/?item-query=abc"),
+    ],
+    "sql_app.main:app": [
+        Endpoint("GET /users/", "GET", "/users/"),
+        Endpoint("GET /items/", "GET", "/items/"),
+    ],
+}
+
+
+async def bench(command, args, env) -> dict:
+    port = free_port()
+    process = subprocess.Popen(command + ["--port", str(port)], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        await wait_for_server(base_url, process)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits) as client:
+            results = {}
+            for endpoint in ENDPOINTS[args.app]:
+                await run_endpoint(client, endpoint, {}, min(args.requests, 100), args.concurrency)
+                results[endpoint.name] = await run_endpoint(client, endpoint, {}, args.requests, args.concurrency)
+            return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="uvicorn default vs serve.py throughput")
+    parser.add_argument("--app", choices=list(ENDPOINTS), default="main:app")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    setups = {
+        "default (1 worker, asyncio, h11)": [sys.executable, "-m", "uvicorn", args.app,
+                                             "--loop", "asyncio", "--http", "h11", "--log-level", "warning"],
+        "serve.py, 1 worker": [sys.executable, "serve.py", args.app, "--workers", "1", "--log-level", "warning"],
+        f"serve.py, auto ({default_workers()} worker(s))": [sys.executable, "serve.py", args.app,
+                                                         "--log-level", "warning"],
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "SQL_APP_DATABASE_URL": f"sqlite:///{tmp}/bench.db", "SQL_APP_AUTO_MIGRATE": "1"}
+        for name, command in setups.items():
+            results[name] = asyncio.run(bench(command, args, env))
+
+    print(f"{'setup':<36}{'endpoint':<24}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}")
+    for name, endpoints in results.items():
+        for endpoint, r in endpoints.items():
+            print(f"{name:<36}{endpoint:<24}{r['throughput']:>10.0f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# write throughput of sql_app with 1, 4 and 8 shards
+# run from the project folder:
+# => python -m benchmarks.bench_shards
+# => python -m benchmarks.bench_shards --shards 1 2 4 8 --processes 16 --items 1000
+#
+# like N workers of the app, N processes write at the same time through crud:
+# - create users: every user takes an id from the global index on shard 0, then it's added to its shard
+# - create items: for random users, an item is only written to the shard of its user
+# with 1 shard, all the writes wait for the one writer lock of sql_app.db
+
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def _create_users(args):
+    worker, count = args
+    from sql_app import crud, schemas
+    from sql_app.database import LazySession
+
+    user_ids = []
+    for i in range(count):
+        db = LazySession()
+        user_ids.append(crud.create_user(db, schemas.UserCreate(email=f"w{worker}-{i}@example.com", password="x")).id)
+        db.close()
+    return user_ids
+
+
+def _create_items(args):
+    user_ids, count, seed = args
+    from sql_app import crud, schemas
+    from sql_app.database import LazySession
+
+    rng = random.Random(seed)
+    for i in range(count):
+        db = LazySession()
+        crud.create_user_item(db, schemas.ItemCreate(title=f"Item {i}", description="bench"), rng.choice(user_ids))
+        db.close()
+    return count
+
+
+def run(shards: int, processes: int, users: int, items: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQL_APP_DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        os.environ["SQL_APP_SHARDS"] = str(shards)
+        # the writers wait for the locks, the slow query log would print every wait
+        os.environ["SQL_APP_SLOW_QUERY_MS"] = "60000"
+        subprocess.run([sys.executable, "-m", "sql_app.schema"], check=True, capture_output=True)
+
+        # spawn: every process imports sql_app with the env above
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            # import sql_app in every process before the clock starts
+            pool.map(_create_users, [(worker, 0) for worker in range(processes)])
+
+            start = time.perf_counter()
+            user_ids = [user_id for ids in pool.map(_create_users, [(worker, users) for worker in range(processes)])
+                        for user_id in ids]
+            users_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            pool.map(_create_items, [(user_ids, items, seed) for seed in range(processes)])
+            items_seconds = time.perf_counter() - start
+
+    return {
+        "users_per_second": len(user_ids) / users_seconds,
+        "items_per_second": items * processes / items_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sql_app write throughput by number of shards")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--processes", type=int, default=8, help="writer processes, like the workers of the app")
+    parser.add_argument("--users", type=int, default=50, help="users created per process")
+    parser.add_argument("--items", type=int, default=300, help="items created per process")
+    args = parser.parse_args()
+
+    print(f"{'shards':>6}{'users/s':>10}{'items/s':>10}")
+    for shards in args.shards:
+        result = run(shards, args.processes, args.users, args.items)
+        print(f"{shards:>6}{result['users_per_second']:>10.0f}{result['items_per_second']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# the overhead of the slow query log when no statement is slow
+# run from the project folder:
+# => python -m benchmarks.bench_slowlog
+#
+# we run the same point read (crud.get_user) on 2 engines of the same db, one with the slow query log installed
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+
+def main():
+    parser = argparse.ArgumentParser(description="slow query log overhead")
+    parser.add_argument("--number", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{tmp}/bench.db"
+        os.environ["SQL_APP_DATABASE_URL"] = url
+        subprocess.run([sys.executable, "-m", "sql_app.schema"], check=True, capture_output=True)
+
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+
+        from sql_app import crud, schemas
+        from sql_app.slowlog import SlowQueryLog
+
+        plain = create_engine(url, connect_args={"check_same_thread": False})
+        logged = create_engine(url, connect_args={"check_same_thread": False})
+        SlowQueryLog(threshold_ms=1000).install(logged)
+
+        with sessionmaker(bind=plain)() as db:
+            user_id = crud.create_user(db, schemas.UserCreate(email="bench@example.com", password="x")).id
+
+        results = {}
+        for name, engine in [("without log", plain), ("with log", logged)]:
+            db = sessionmaker(bind=engine)()
+            crud.get_user(db, user_id)
+            seconds = min(timeit.repeat(lambda: (crud.get_user(db, user_id), db.expire_all()),
+                                        number=args.number, repeat=3))
+            results[name] = seconds / args.number * 1e6
+            db.close()
+
+    for name, us in results.items():
+        print(f"{name:<14}{us:>10.2f} us per query")
+    print(f"overhead      {results['with log'] - results['without log']:>10.2f} us per query")
+
+
+if __name__ == "__main__":
+    main()
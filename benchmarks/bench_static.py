@@ -0,0 +1,102 @@
+# throughput of static_files.FileServer against a plain "read the file and return it" endpoint
+# run from the project folder:
+# => python -m benchmarks.bench_static
+# => python -m benchmarks.bench_static --uvicorn      (real server and sockets, needs a free port)
+#
+# 3 files: a small hot one (served from the memory cache), a medium one and a big one (sent in chunks)
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+
+import httpx
+from fastapi import FastAPI, Request, Response
+
+from benchmarks.load import Endpoint, free_port, run_endpoint, wait_for_server
+from static_files import FileServer
+
+SIZES = {"small.bin": 4 * 1024, "medium.bin": 256 * 1024, "big.bin": 8 * 1024 * 1024}
+
+
+def build_app(root: str) -> FastAPI:
+    app = FastAPI()
+    files = FileServer(root)
+
+    @app.get("/plain/{file_path:path}")
+    def read_plain(file_path: str):
+        # the naive way, the whole file is read into memory on every request
+        with open(os.path.join(root, file_path), "rb") as f:
+            return Response(f.read(), media_type="application/octet-stream")
+
+    @app.get("/files/{file_path:path}")
+    async def read_file(file_path: str, request: Request):
+        return await files.response(file_path, request)
+
+    return app
+
+
+async def run(client: httpx.AsyncClient, requests: int, concurrency: int):
+    results = {}
+    for name, size in SIZES.items():
+        # fewer requests for the big file, so a run takes about the same time
+        count = max(20, requests * 4096 // max(size, 4096 * 16)) if size > 4096 else requests
+        for kind in ("plain", "files"):
+            endpoint = Endpoint(kind, "GET", f"/{kind}/{name}")
+            await run_endpoint(client, endpoint, {}, min(count, 20), concurrency)
+            results[(name, kind)] = await run_endpoint(client, endpoint, {}, count, concurrency)
+    return results
+
+
+async def run_asgi(root: str, requests: int, concurrency: int):
+    transport = httpx.ASGITransport(app=build_app(root))
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+        return await run(client, requests, concurrency)
+
+
+async def run_uvicorn(root: str, requests: int, concurrency: int):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.bench_static:app", "--port", str(port), "--log-level", "warning"],
+        env={**os.environ, "BENCH_STATIC_ROOT": root},
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        await wait_for_server(base_url, process)
+        async with httpx.AsyncClient(base_url=base_url) as client:
+            return await run(client, requests, concurrency)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+# for --uvicorn, the server process imports this module and serves this app
+if os.getenv("BENCH_STATIC_ROOT"):
+    app = build_app(os.environ["BENCH_STATIC_ROOT"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="static file serving throughput")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--uvicorn", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        for name, size in SIZES.items():
+            with open(os.path.join(root, name), "wb") as f:
+                f.write(os.urandom(size))
+        run_mode = run_uvicorn if args.uvicorn else run_asgi
+        results = asyncio.run(run_mode(root, args.requests, args.concurrency))
+
+    print(f"{'file':<12}{'size':>10}{'endpoint':>10}{'req/s':>10}{'MB/s':>10}{'p95 ms':>9}")
+    for (name, kind), r in results.items():
+        size = SIZES[name]
+        print(f"{name:<12}{size:>10}{kind:>10}{r['throughput']:>10.0f}{r['throughput'] * size / 1e6:>10.1f}"
+              f"{r['p95_ms']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# compare the per-user item summary table with computing it on the fly
+# run from the project folder:
+# => python -m benchmarks.bench_summary
+# => python -m benchmarks.bench_summary --items 10000000 --users 100000      (the 10M items run, takes a while)
+#
+# for one page of users (--page-size), we measure:
+# - load User.items: the ORM way, load the users then the items of each user
+# - GROUP BY: count and latest item on the fly, GROUP BY owner_id on the items table
+# - summary table: read the page from user_item_summary
+# and the time of a full rebuild of the summary table
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def timed(func, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def fill(db_path: str, users: int, items: int, batch: int = 100000):
+    connection = sqlite3.connect(db_path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.executemany(
+        "INSERT INTO users (id, email, hashed_password, is_active) VALUES (?, ?, 'x', 1)",
+        ((i, f"user{i}@example.com") for i in range(1, users + 1)),
+    )
+    for start in range(0, items, batch):
+        connection.executemany(
+            "INSERT INTO items (title, description, owner_id) VALUES (?, 'bench', ?)",
+            ((f"Item {i}", random.randint(1, users)) for i in range(start, min(start + batch, items))),
+        )
+        connection.commit()
+        print(f"\r{min(start + batch, items)} items", end="", file=sys.stderr)
+    print(file=sys.stderr)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="summary table vs GROUP BY on the fly")
+    parser.add_argument("--items", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        os.environ["SQL_APP_DATABASE_URL"] = f"sqlite:///{db_path}"
+        subprocess.run([sys.executable, "-m", "sql_app.schema"], check=True, capture_output=True)
+        fill(db_path, args.users, args.items)
+
+        from sqlalchemy import func
+
+        from sql_app import crud, models
+        from sql_app.database import SessionLocal
+
+        db = SessionLocal()
+        # the middle page, so OFFSET isn't free
+        skip = args.users // 2
+
+        def load_user_items():
+            users = crud.get_users(db, skip=skip, limit=args.page_size)
+            result = [(user.id, len(user.items), max((item.id for item in user.items), default=None))
+                      for user in users]
+            db.expire_all()
+            return result
+
+        def group_by():
+            rows = (
+                db.query(models.Item.owner_id, func.count(models.Item.id), func.max(models.Item.id))
+                .group_by(models.Item.owner_id)
+                .order_by(models.Item.owner_id)
+                .offset(skip)
+                .limit(args.page_size)
+                .all()
+            )
+            titles = dict(db.query(models.Item.id, models.Item.title)
+                          .filter(models.Item.id.in_([row[2] for row in rows])))
+            return [(owner_id, count, latest, titles[latest]) for owner_id, count, latest in rows]
+
+        def summary():
+            return crud.get_user_item_summaries(db, skip=skip, limit=args.page_size)
+
+        results = {
+            "items": args.items,
+            "users": args.users,
+            "rebuild_ms": timed(lambda: crud.rebuild_user_item_summary(db), 1),
+            "load_user_items_ms": timed(load_user_items, args.repeat),
+            "group_by_ms": timed(group_by, args.repeat),
+            "summary_table_ms": timed(summary, args.repeat),
+        }
+        db.close()
+
+    print(f"{args.items} items, {args.users} users, page of {args.page_size} users")
+    print(f"{'load User.items':<20}{results['load_user_items_ms']:>12.2f} ms")
+    print(f"{'GROUP BY':<20}{results['group_by_ms']:>12.2f} ms")
+    print(f"{'summary table':<20}{results['summary_table_ms']:>12.2f} ms")
+    print(f"{'full rebuild':<20}{results['rebuild_ms']:>12.2f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# size the threadpool of sql_app from data: throughput and wait for a thread at several pool sizes
+# run from the project folder:
+# => python -m benchmarks.bench_threadpool
+# => python -m benchmarks.bench_threadpool --sizes 8 40 100 --concurrency 200
+#
+# the requests go through the ASGI transport in-process, with the same seeded db for every size
+
+import argparse
+import asyncio
+import os
+import tempfile
+
+import httpx
+
+from benchmarks.load import Endpoint, run_endpoint, setup_sql_app
+
+
+async def run(sizes, requests: int, concurrency: int):
+    from sql_app.main import app, threadpool
+
+    endpoint = Endpoint("GET /users/{user_id}", "GET", "/users/{user_id}",
+                        lambda c: {"path": {"user_id": c["user_ids"][0]}})
+    results = []
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as client:
+            context = await setup_sql_app(client)
+            for size in sizes:
+                threadpool.size = size
+                threadpool.reset()
+                result = await run_endpoint(client, endpoint, context, requests, concurrency)
+                stats = threadpool.snapshot()["pool"]
+                results.append((size, result, stats))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sql_app throughput by threadpool size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4, 16, 40, 100])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQL_APP_DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        os.environ["SQL_APP_AUTO_MIGRATE"] = "1"
+        results = asyncio.run(run(args.sizes, args.requests, args.concurrency))
+
+    print(f"{'threads':>8}{'req/s':>10}{'p95 ms':>9}{'wait avg ms':>13}{'wait p95 ms':>13}{'max queued':>12}")
+    for size, r, stats in results:
+        print(f"{size:>8}{r['throughput']:>10.0f}{r['p95_ms']:>9.2f}{stats['wait_avg_ms']:>13.2f}"
+              f"{stats['wait_p95_ms']:>13.2f}{stats['max_queued']:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# in-process load test for the apps in this project
+# run from the project folder:
+# => python -m benchmarks.load                                  (all apps, ASGI transport, in-process)
+# => python -m benchmarks.load --app main --concurrency 50 --requests 2000
+# => python -m benchmarks.load --uvicorn                        (start a real uvicorn server for each app)
+#
+# save the numbers as a baseline, then compare later runs against it:
+# => python -m benchmarks.load --json results.json --save-baseline benchmarks/baseline.json
+# => python -m benchmarks.load --baseline benchmarks/baseline.json
+# a run exits with code 1 when an endpoint is slower than the baseline by more than --tolerance percent
+#
+# the ASGI transport calls the app directly without any socket, so it measures our code and FastAPI only
+# the --uvicorn mode also measures the server and the network stack
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import httpx
+
+from serve import load_app
+
+
+class Endpoint:
+    def __init__(self, name: str, method: str, path: str, build: Callable[[dict], dict] = None):
+        # build(context) returns the kwargs for httpx, such as headers or json body
+        self.name = name
+        self.method = method
+        self.path = path
+        self.build = build or (lambda context: {})
+
+
+class Scenario:
+    def __init__(self, app: str, endpoints: List[Endpoint], setup=None, env: Dict[str, str] = None):
+        # app is the uvicorn style path, ex: "main:app"
+        self.app = app
+        self.endpoints = endpoints
+        # setup(client) is an async function that prepares data, it returns the context for the endpoints
+        self.setup = setup
+        self.env = env or {}
+
+
+_emails = itertools.count()
+
+
+async def setup_sql_app(client: httpx.AsyncClient) -> dict:
+    user_ids = []
+    for i in range(20):
+        response = await client.post("/users/", json={"email": f"seed{i}@example.com", "password": "secret"})
+        user_ids.append(response.json()["id"])
+        for j in range(5):
+            await client.post(f"/users/{user_ids[-1]}/items/", json={"title": f"Item {j}", "description": "seed"})
+    return {"user_ids": user_ids}
+
+
+async def setup_auth_jwt(client: httpx.AsyncClient) -> dict:
+    response = await client.post("/token", data={"username": "johndoe", "password": "secret"})
+    return {"headers": {"Authorization": f"Bearer {response.json()['access_token']}"}}
+
+
+def scenarios(db_path: str) -> Dict[str, Scenario]:
+    token_headers = {"X-Token": "coneofsilence"}
+    item = {
+        "name": "Foo",
+        "description": "A very nice Item",
+        "price": 35.4,
+        "tax": 3.2,
+        "tags": ["a", "b"],
+        "images": [{"url": "http://example.com/a.png", "name": "a"}, {"url": "http://example.com/b.png", "name": "b"}],
+    }
+    return {
+        "main": Scenario("main:app", [
+            Endpoint("GET /items/{item_id}", "GET", "/items/foo", lambda c: {"headers": token_headers}),
+            Endpoint("GET /items/", "GET", "/items/?item-query=abc"),
+            Endpoint("POST /create_item/", "POST", "/create_item/", lambda c: {"json": item}),
+            Endpoint("GET /models/{model_name}", "GET", "/models/alexnet?model_name1=alexnet"),
+        ]),
+        "sql_app": Scenario("sql_app.main:app", [
+            Endpoint("GET /users/", "GET", "/users/"),
+            Endpoint("GET /users/{user_id}", "GET", "/users/{user_id}",
+                     lambda c: {"path": {"user_id": c["user_ids"][next(_emails) % len(c["user_ids"])]}}),
+            Endpoint("GET /items/", "GET", "/items/"),
+            Endpoint("POST /users/", "POST", "/users/",
+                     lambda c: {"json": {"email": f"load{next(_emails)}-{time.time_ns()}@example.com",
+                                         "password": "secret"}}),
+        ], setup=setup_sql_app, env={"SQL_APP_DATABASE_URL": f"sqlite:///{db_path}", "SQL_APP_AUTO_MIGRATE": "1"}),
+        "auth-jwt": Scenario("auth-jwt:app", [
+            Endpoint("GET /users/me/", "GET", "/users/me/", lambda c: {"headers": c["headers"]}),
+            Endpoint("GET /users/me/items/", "GET", "/users/me/items/", lambda c: {"headers": c["headers"]}),
+        ], setup=setup_auth_jwt),
+    }
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    # nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+async def run_endpoint(client: httpx.AsyncClient, endpoint: Endpoint, context: dict,
+                       requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    remaining = itertools.count()
+
+    async def worker():
+        nonlocal errors
+        while next(remaining) < requests:
+            kwargs = endpoint.build(context)
+            path = endpoint.path.format(**kwargs.pop("path", {}))
+            start = time.perf_counter()
+            try:
+                response = await client.request(endpoint.method, path, **kwargs)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_server(url: str, process: subprocess.Popen, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with code {process.returncode}")
+            try:
+                await client.get(url + "/openapi.json")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError("uvicorn did not start in time")
+
+
+async def run_scenario(scenario: Scenario, args) -> Dict[str, dict]:
+    os.environ.update(scenario.env)
+    process = None
+    lifespan = None
+
+    if args.uvicorn:
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", scenario.app, "--port", str(port), "--log-level", "warning"],
+            env={**os.environ, **scenario.env},
+        )
+        base_url = f"http://127.0.0.1:{port}"
+        await wait_for_server(base_url, process)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=base_url, limits=limits)
+    else:
+        app = load_app(scenario.app)
+        # ASGITransport doesn't send lifespan events, so run the startup/shutdown handlers ourselves
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver")
+
+    try:
+        context = await scenario.setup(client) if scenario.setup else {}
+        results = {}
+        for endpoint in scenario.endpoints:
+            # warm up, so the first request cost (such as the lazy imports) doesn't go into the numbers
+            await run_endpoint(client, endpoint, context, min(args.requests, 50), args.concurrency)
+            results[endpoint.name] = await run_endpoint(client, endpoint, context, args.requests, args.concurrency)
+        return results
+    finally:
+        await client.aclose()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    # a regression is a lower throughput or a higher p95 than the baseline, by more than tolerance percent
+    regressions = []
+    for app_name, endpoints in results.items():
+        for name, current in endpoints.items():
+            before = baseline.get(app_name, {}).get(name)
+            if before is None:
+                continue
+            if current["throughput"] < before["throughput"] * (1 - tolerance / 100):
+                regressions.append(f"{app_name} {name}: throughput {before['throughput']:.0f} -> {current['throughput']:.0f} req/s")
+            if current["p95_ms"] > before["p95_ms"] * (1 + tolerance / 100):
+                regressions.append(f"{app_name} {name}: p95 {before['p95_ms']:.2f} -> {current['p95_ms']:.2f} ms")
+    return regressions
+
+
+def print_report(results: dict):
+    print(f"{'app':<10}{'endpoint':<28}{'req':>7}{'err':>6}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for app_name, endpoints in results.items():
+        for name, r in endpoints.items():
+            print(f"{app_name:<10}{name:<28}{r['requests']:>7}{r['errors']:>6}{r['throughput']:>10.0f}"
+                  f"{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the apps of this project")
+    parser.add_argument("--app", action="append", choices=["main", "sql_app", "auth-jwt"],
+                        help="app to test, can be repeated, default is all apps")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent clients per endpoint")
+    parser.add_argument("--uvicorn", action="store_true", help="run each app in a local uvicorn server")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare the results against this file")
+    parser.add_argument("--save-baseline", help="write the results as the new baseline to this file")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="allowed regression in percent")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        all_scenarios = scenarios(os.path.join(tmp, "bench.db"))
+        results = {}
+        for app_name in args.app or list(all_scenarios):
+            results[app_name] = asyncio.run(run_scenario(all_scenarios[app_name], args))
+
+    print_report(results)
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("no regression against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple, Union
+
+import anyio.to_thread
+
+# Idempotency keys: a client can retry a POST without creating the thing twice
+#
+# the client sends a unique key with the request, and the same key with every retry of it:
+#   POST /users/
+#   Idempotency-Key: 8e03978e-40d5-43e8-bc93-6894a57f9324
+#
+# - the first request runs as usual, and its response is stored with the key
+# - a retry gets the stored response back, with the header "Idempotent-Replayed: true",
+#   the endpoint is NOT run again (no validation, no uniqueness lookup, no commit)
+# - a retry that arrives while the first request is still running waits for it, then gets its response
+# - the same key with another body is a client bug: 422
+# - a 5xx response is not stored, so the retry runs the endpoint again
+# - the body of a request with a key is read in memory, a body over max_request_body (1 MiB by default) is a 413
+#
+# the keys are stored in a sqlite file, so all the workers of the app share them, and they expire after a TTL
+# the key is scoped by the method, the path and the credentials of the request (Authorization, X-Token),
+# so 2 clients can't read each other's responses by sending the same key
+#
+# add it to an app, for some POST routes (regex of the path):
+#   app.add_middleware(IdempotencyMiddleware, paths=[r"/users/", r"/users/\d+/items/"])
+#
+# config by env:
+# IDEMPOTENCY_DB: the sqlite file of the keys, default is "idempotency.db"
+# IDEMPOTENCY_TTL: seconds a response is kept for the retries, default is 86400 (1 day)
+
+IDEMPOTENCY_DB = os.getenv("IDEMPOTENCY_DB", "idempotency.db")
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+
+HEADER = b"idempotency-key"
+MAX_KEY_LENGTH = 255
+
+logger = logging.getLogger("idempotency")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    response_status INTEGER,
+    response_headers TEXT,
+    response_body BLOB,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    locked_until REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at ON idempotency_keys (expires_at);
+"""
+
+# the results of IdempotencyStore.begin()
+NEW = "new"
+RUNNING = "running"
+DONE = "done"
+MISMATCH = "mismatch"
+
+
+class StoredResponse:
+    def __init__(self, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class IdempotencyStore:
+    def __init__(self, path: str = None, ttl: float = IDEMPOTENCY_TTL, lease: float = 60.0):
+        self.path = path or IDEMPOTENCY_DB
+        self.ttl = ttl
+        # a running key is given to the next retry when its request doesn't finish in "lease" seconds
+        # ex: the worker process was killed in the middle of the request
+        self.lease = lease
+        self._local = threading.local()
+        self._schema_ready = False
+        self._begins = 0
+
+    # sqlite connections can't be shared between threads, so each thread has its own
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                connection.executescript(SCHEMA)
+                self._schema_ready = True
+            self._local.connection = connection
+        return connection
+
+    def begin(self, key: str, fingerprint: str) -> Tuple[str, Union[StoredResponse, None]]:
+        # take the key for this request (NEW), or tell how the request of the key is doing
+        connection = self._connection()
+        now = time.time()
+        self._begins += 1
+        if self._begins % 1000 == 0:
+            self.purge()
+        # BEGIN IMMEDIATE takes the write lock first, so 2 workers never both take a new key
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT fingerprint, status, response_status, response_headers, response_body, expires_at, "
+                "locked_until FROM idempotency_keys WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is not None and row[5] < now:
+                connection.execute("DELETE FROM idempotency_keys WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                connection.execute(
+                    "INSERT INTO idempotency_keys (key, fingerprint, created_at, expires_at, locked_until) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, fingerprint, now, now + self.ttl, now + self.lease),
+                )
+                connection.execute("COMMIT")
+                return NEW, None
+            if row[0] != fingerprint:
+                connection.execute("COMMIT")
+                return MISMATCH, None
+            if row[1] == "running":
+                if row[6] < now:
+                    # the request of the key died, this one takes it over
+                    connection.execute(
+                        "UPDATE idempotency_keys SET locked_until = ? WHERE key = ?", (now + self.lease, key)
+                    )
+                    connection.execute("COMMIT")
+                    return NEW, None
+                connection.execute("COMMIT")
+                return RUNNING, None
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(row[3])]
+        return DONE, StoredResponse(row[2], headers, row[4])
+
+    def complete(self, key: str, response: StoredResponse):
+        headers = json.dumps([(name.decode("latin-1"), value.decode("latin-1")) for name, value in response.headers])
+        self._connection().execute(
+            "UPDATE idempotency_keys SET status = 'done', response_status = ?, response_headers = ?, "
+            "response_body = ?, expires_at = ? WHERE key = ?",
+            (response.status, headers, response.body, time.time() + self.ttl, key),
+        )
+
+    def release(self, key: str):
+        # the request failed, forget the key so a retry runs the endpoint again
+        self._connection().execute("DELETE FROM idempotency_keys WHERE key = ? AND status = 'running'", (key,))
+
+    def purge(self) -> int:
+        cursor = self._connection().execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (time.time(),))
+        return cursor.rowcount
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app, store: IdempotencyStore = None, paths: Iterable[str] = None,
+                 methods: Iterable[str] = ("POST",), scope_headers: Iterable[str] = ("authorization", "x-token"),
+                 wait_timeout: float = 30.0, poll_interval: float = 0.05, max_body: int = 1024 * 1024,
+                 max_request_body: int = 1024 * 1024):
+        self.app = app
+        self.store = store or IdempotencyStore()
+        # None: every path of the methods above
+        self.paths = [re.compile(path) for path in paths] if paths is not None else None
+        self.methods = set(methods)
+        self.scope_headers = [name.encode() for name in scope_headers]
+        # how long a retry waits for the first request of its key, then it gets a 409
+        self.wait_timeout = wait_timeout
+        # how often a retry checks the store when the first request runs in another worker
+        self.poll_interval = poll_interval
+        # a bigger response is not stored, a retry would run the endpoint again
+        self.max_body = max_body
+        # the body of a request with a key is held in memory (it's part of the fingerprint), a bigger one is a 413
+        self.max_request_body = max_request_body
+        # the requests of this worker that are running, a retry waits on their event instead of polling the store
+        self._running: Dict[str, asyncio.Event] = {}
+
+    def _matches(self, scope) -> bool:
+        if scope["type"] != "http" or scope["method"] not in self.methods:
+            return False
+        return self.paths is None or any(path.fullmatch(scope["path"]) for path in self.paths)
+
+    async def __call__(self, scope, receive, send):
+        if not self._matches(scope):
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        idempotency_key = headers.get(HEADER)
+        if idempotency_key is None:
+            return await self.app(scope, receive, send)
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            return await _send_error(send, 400, f"{HEADER.decode()} must have 1 to {MAX_KEY_LENGTH} characters")
+
+        # the whole body is read first, it's part of the fingerprint
+        # a Content-Length over the limit is refused before reading anything, a chunked body when it goes over it
+        too_big = f"The body of a request with {HEADER.decode()} is limited to {self.max_request_body} bytes"
+        content_length = headers.get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_request_body:
+            return await _send_error(send, 413, too_big)
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_request_body:
+                return await _send_error(send, 413, too_big)
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+
+        key = _digest(scope["method"].encode(), scope["path"].encode(), idempotency_key,
+                      *(headers.get(name, b"") for name in self.scope_headers))
+        fingerprint = _digest(scope.get("query_string", b""), body)
+
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            result, stored = await anyio.to_thread.run_sync(self.store.begin, key, fingerprint)
+            if result == NEW:
+                return await self._run(key, scope, body, receive, send)
+            if result == DONE:
+                return await _replay(send, stored)
+            if result == MISMATCH:
+                return await _send_error(send, 422, f"{HEADER.decode()} was already used with another request")
+            # RUNNING: wait for the first request, then ask the store again
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return await _send_error(send, 409, "A request with this key is still running, retry later")
+            running = self._running.get(key)
+            try:
+                if running is not None:
+                    await asyncio.wait_for(running.wait(), timeout)
+                else:
+                    await asyncio.sleep(min(self.poll_interval, timeout))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, key: str, scope, body: bytes, receive, send):
+        done = self._running[key] = asyncio.Event()
+        response = StoredResponse(500, [], b"")
+        chunks = []
+        size = 0
+        sent_body = False
+
+        async def replay_receive():
+            nonlocal sent_body
+            if not sent_body:
+                sent_body = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # the body was read already, the next message of the server is the disconnect
+            return await receive()
+
+        async def capture_send(message):
+            nonlocal size
+            if message["type"] == "http.response.start":
+                response.status = message["status"]
+                response.headers = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                # a response that is too big to be stored is not kept in memory either
+                if size <= self.max_body:
+                    chunks.append(chunk)
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, capture_send)
+            response.body = b"".join(chunks)
+            if response.status >= 500 or size > self.max_body:
+                if response.status < 500:
+                    logger.warning("response of %s %s is too big to be stored for the retries",
+                                   scope["method"], scope["path"])
+                await anyio.to_thread.run_sync(self.store.release, key)
+            else:
+                await anyio.to_thread.run_sync(self.store.complete, key, response)
+        except BaseException:
+            await anyio.to_thread.run_sync(self.store.release, key)
+            raise
+        finally:
+            if self._running.get(key) is done:
+                del self._running[key]
+            done.set()
+
+
+def _digest(*parts: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        # the length first, so ("ab", "c") and ("a", "bc") don't give the same digest
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+async def _replay(send, stored: StoredResponse):
+    await send({
+        "type": "http.response.start",
+        "status": stored.status,
+        "headers": stored.headers + [(b"idempotent-replayed", b"true")],
+    })
+    await send({"type": "http.response.body", "body": stored.body})
+
+
+async def _send_error(send, status: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,316 @@
+import argparse
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Union
+
+# Durable background job queue, backed by a sqlite file, so we don't need redis or rabbitmq
+#
+# BackgroundTasks of FastAPI runs the task in the same worker after the response
+# so the task is lost when the worker dies, and under load it takes CPU from the requests
+#
+# with this queue:
+# - the endpoint only writes the job into the sqlite file (a few ms), then returns
+# - separate worker processes take the jobs in batches and run them, with retries and a concurrency limit
+# - a job is only removed from the queue when it's done, so a crash doesn't lose it
+#
+# declare a task:
+#   jobs = JobQueue()
+#
+#   @jobs.task
+#   def write_notification(email: str, message=""):
+#       ...
+#
+# add a job (the args must be JSON serializable):
+#   jobs.enqueue("write_notification", email, message="some notification")
+#
+# run the workers, run from the project folder:
+# => python -m jobqueue main --processes 2 --concurrency 4
+# "main" is the module that declares the tasks, it's imported by every worker process
+#
+# config by env:
+# JOBS_DB: the sqlite file of the queue, default is "jobs.db"
+
+JOBS_DB = os.getenv("JOBS_DB", "jobs.db")
+
+logger = logging.getLogger("jobqueue")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    locked_by TEXT,
+    locked_until REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at);
+"""
+
+
+class Job:
+    def __init__(self, id: int, name: str, payload: str, attempts: int, max_attempts: int, created_at: float):
+        self.id = id
+        self.name = name
+        data = json.loads(payload)
+        self.args = data["args"]
+        self.kwargs = data["kwargs"]
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.created_at = created_at
+
+
+class JobQueue:
+    def __init__(self, path: str = None, max_attempts: int = 5, lease: float = 60.0):
+        self.path = path or JOBS_DB
+        self.max_attempts = max_attempts
+        # a running job is given back to the queue when its worker doesn't finish it in "lease" seconds
+        # ex: the worker process was killed
+        self.lease = lease
+        self.tasks: Dict[str, Callable] = {}
+        self._local = threading.local()
+        self._schema_ready = False
+
+    # sqlite connections can't be shared between threads, so each thread has its own
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            # WAL: the readers don't block the writer, and the writer doesn't block the readers
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                connection.executescript(SCHEMA)
+                self._schema_ready = True
+            self._local.connection = connection
+        return connection
+
+    def task(self, func: Callable = None, name: str = None):
+        # register a function as a task, use it as a decorator: @jobs.task or @jobs.task(name="...")
+        def register(func):
+            self.tasks[name or func.__name__] = func
+            return func
+
+        return register(func) if func is not None else register
+
+    def enqueue(self, name: Union[str, Callable], *args, delay: float = 0, max_attempts: int = None,
+                **kwargs) -> int:
+        name = name if isinstance(name, str) else name.__name__
+        now = time.time()
+        payload = json.dumps({"args": args, "kwargs": kwargs})
+        cursor = self._connection().execute(
+            "INSERT INTO jobs (name, payload, max_attempts, run_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (name, payload, max_attempts or self.max_attempts, now + delay, now),
+        )
+        return cursor.lastrowid
+
+    def claim(self, worker_id: str, limit: int) -> List[Job]:
+        # take up to "limit" jobs that are due, and lock them for this worker
+        # BEGIN IMMEDIATE takes the write lock first, so 2 workers never take the same job
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute(
+                "SELECT id, name, payload, attempts, max_attempts, created_at FROM jobs "
+                "WHERE (status = 'queued' AND run_at <= ?) OR (status = 'running' AND locked_until < ?) "
+                "ORDER BY run_at LIMIT ?",
+                (now, now, limit),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, "
+                "locked_by = ?, locked_until = ? WHERE id = ?",
+                [(now, worker_id, now + self.lease, row[0]) for row in rows],
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return [Job(id, name, payload, attempts + 1, max_attempts, created_at)
+                for id, name, payload, attempts, max_attempts, created_at in rows]
+
+    def complete(self, job: Job):
+        self._connection().execute(
+            "UPDATE jobs SET status = 'done', finished_at = ?, locked_by = NULL, locked_until = NULL WHERE id = ?",
+            (time.time(), job.id),
+        )
+
+    def fail(self, job: Job, error: str):
+        now = time.time()
+        if job.attempts < job.max_attempts:
+            # retry later, wait longer after every attempt: 2s, 4s, 8s, ... up to 5 minutes
+            run_at = now + min(2 ** job.attempts, 300)
+            self._connection().execute(
+                "UPDATE jobs SET status = 'queued', run_at = ?, last_error = ?, locked_by = NULL, "
+                "locked_until = NULL WHERE id = ?",
+                (run_at, error, job.id),
+            )
+        else:
+            self._connection().execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, last_error = ?, locked_by = NULL, "
+                "locked_until = NULL WHERE id = ?",
+                (now, error, job.id),
+            )
+
+    def run(self, job: Job):
+        func = self.tasks.get(job.name)
+        try:
+            if func is None:
+                raise LookupError(f"Unknown task {job.name}, is the module that declares it imported?")
+            func(*job.args, **job.kwargs)
+        except Exception:
+            logger.warning("job %d (%s) failed, attempt %d/%d", job.id, job.name, job.attempts, job.max_attempts)
+            self.fail(job, traceback.format_exc(limit=5))
+        else:
+            self.complete(job)
+
+    def purge(self, older_than: float = 24 * 3600) -> int:
+        # remove the done jobs, we only keep them for a while for the latency stats
+        cursor = self._connection().execute(
+            "DELETE FROM jobs WHERE status = 'done' AND finished_at < ?", (time.time() - older_than,)
+        )
+        return cursor.rowcount
+
+    def stats(self, window: int = 1000) -> dict:
+        connection = self._connection()
+        now = time.time()
+        counts = dict(connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        oldest = connection.execute(
+            "SELECT MIN(run_at) FROM jobs WHERE status = 'queued' AND run_at <= ?", (now,)
+        ).fetchone()[0]
+        # latency = from enqueue until done, for the last "window" done jobs
+        latencies = [row[0] for row in connection.execute(
+            "SELECT finished_at - created_at FROM jobs WHERE status = 'done' "
+            "ORDER BY finished_at DESC LIMIT ?", (window,)
+        ).fetchall()]
+        latencies.sort()
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] if latencies else None
+
+        return {
+            "depth": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "oldest_queued_age_seconds": now - oldest if oldest else 0,
+            "latency_p50_seconds": percentile(50),
+            "latency_p95_seconds": percentile(95),
+        }
+
+
+class Worker:
+    # takes the jobs in batches and runs up to "concurrency" of them at the same time in threads
+    def __init__(self, queue: JobQueue, concurrency: int = 4, batch: int = 10, poll_interval: float = 0.5):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self.id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+
+    def run_once(self, executor: ThreadPoolExecutor = None) -> int:
+        jobs = self.queue.claim(self.id, self.batch)
+        if executor is None:
+            for job in jobs:
+                self.queue.run(job)
+        else:
+            # wait for the whole batch, so we never run more than "concurrency" jobs
+            list(executor.map(self.queue.run, jobs))
+        return len(jobs)
+
+    def run_forever(self, purge_interval: float = 600):
+        last_purge = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self._stop.is_set():
+                if self.run_once(executor) == 0:
+                    self._stop.wait(self.poll_interval)
+                if time.monotonic() - last_purge > purge_interval:
+                    self.queue.purge()
+                    last_purge = time.monotonic()
+
+    def stop(self):
+        self._stop.set()
+
+
+def _worker_process(module: str, path: str, concurrency: int, batch: int):
+    queue = _load_queue(module, path)
+    worker = Worker(queue, concurrency=concurrency, batch=batch)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    logger.info("worker %s started, tasks: %s", worker.id, ", ".join(queue.tasks))
+    try:
+        worker.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def _load_queue(module: str, path: str = None) -> JobQueue:
+    # find the JobQueue declared in the module, ex: "jobs" in main.py
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    mod = importlib.import_module(module)
+    queues = [value for value in vars(mod).values() if isinstance(value, JobQueue)]
+    if not queues:
+        raise LookupError(f"No JobQueue in module {module}")
+    queue = queues[0]
+    if path:
+        queue.path = path
+    return queue
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the job queue workers")
+    parser.add_argument("module", help="the module that declares the JobQueue and its tasks, ex: main")
+    parser.add_argument("--processes", type=int, default=2, help="worker processes")
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs running at the same time per process")
+    parser.add_argument("--batch", type=int, default=None, help="jobs taken at once, default is --concurrency")
+    parser.add_argument("--db", default=None, help="the sqlite file of the queue, default is JOBS_DB")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(message)s")
+    batch = args.batch or args.concurrency
+    processes = [
+        multiprocessing.Process(target=_worker_process, args=(args.module, args.db, args.concurrency, batch))
+        for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        # SIGTERM is given to the workers, they finish their current batch then exit
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        stop(None, None)
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    # with "python -m jobqueue", this file runs as __main__, and main.py imports it again as "jobqueue"
+    # so we run the "jobqueue" copy, then the JobQueue class of the workers is the one main.py uses
+    import jobqueue
+
+    jobqueue.main()
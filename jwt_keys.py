@@ -0,0 +1,176 @@
+import logging
+import os
+import threading
+from typing import Dict, Union
+
+from jose import JWTError, jwk, jwt
+from jose.backends.base import Key
+
+
+# Key ring for signing and verifying JWTs, used by auth-jwt.py and auth-jwt-without-user.py
+#
+# with HS256, every service that verifies a token must hold the same SECRET_KEY that signs it
+# with RS256/ES256, only the token issuer holds the private key,
+# other services only need the public key to verify the token
+#
+# every key has a "kid" (key id), the kid is written into the token header when we sign it
+# so when we rotate the signing key, tokens signed by the old key are still valid
+# until we retire the old kid from the ring
+#
+# keys are parsed ONCE into jose Key objects and cached by kid
+# if we give jwt.decode() a PEM string, it parses the PEM again on every call, which is slow for RSA/EC
+
+
+logger = logging.getLogger("jwt_keys")
+
+ASYMMETRIC_ALGORITHMS = {"RS256", "RS384", "RS512", "ES256", "ES384", "ES512"}
+SYMMETRIC_ALGORITHMS = {"HS256", "HS384", "HS512"}
+
+
+class KeyRing:
+    def __init__(self, algorithm: str = "RS256"):
+        if algorithm not in ASYMMETRIC_ALGORITHMS | SYMMETRIC_ALGORITHMS:
+            raise ValueError(f"Unsupported JWT algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.active_kid: Union[str, None] = None
+        self._signing_keys: Dict[str, Key] = {}
+        self._verify_keys: Dict[str, Key] = {}
+        self._lock = threading.Lock()
+
+    def add_key(self, kid: str, private_key: Union[str, bytes, None] = None,
+                public_key: Union[str, bytes, None] = None, activate: bool = False):
+        # for HS256, the secret is both the private and the public key
+        if self.algorithm in SYMMETRIC_ALGORITHMS:
+            public_key = public_key or private_key
+        if private_key is None and public_key is None:
+            raise ValueError("A key needs a private key, a public key or both")
+
+        # parse the PEM once here, then keep the Key object
+        signing_key = jwk.construct(private_key, self.algorithm) if private_key is not None else None
+        if public_key is not None:
+            verify_key = jwk.construct(public_key, self.algorithm)
+        else:
+            verify_key = signing_key.public_key()
+
+        with self._lock:
+            # copy on write, so readers never see a half updated dict
+            verify_keys = dict(self._verify_keys)
+            verify_keys[kid] = verify_key
+            self._verify_keys = verify_keys
+            if signing_key is not None:
+                signing_keys = dict(self._signing_keys)
+                signing_keys[kid] = signing_key
+                self._signing_keys = signing_keys
+                if activate or self.active_kid is None:
+                    self.active_kid = kid
+
+    def rotate(self, kid: str, private_key: Union[str, bytes], public_key: Union[str, bytes, None] = None):
+        # new tokens are signed by the new kid, old tokens still verify by their old kid
+        self.add_key(kid, private_key=private_key, public_key=public_key, activate=True)
+
+    def retire(self, kid: str):
+        # after retire, tokens signed by this kid are rejected
+        with self._lock:
+            if kid == self.active_kid:
+                raise ValueError("Can not retire the active signing key, rotate first")
+            self._verify_keys = {k: v for k, v in self._verify_keys.items() if k != kid}
+            self._signing_keys = {k: v for k, v in self._signing_keys.items() if k != kid}
+
+    def kids(self):
+        return list(self._verify_keys)
+
+    def export_public_key(self, kid: str) -> bytes:
+        # give this PEM to the services that only verify tokens, save it as <kid>.pub.pem
+        return self._verify_keys[kid].to_pem()
+
+    def encode(self, claims: dict) -> str:
+        key = self._signing_keys.get(self.active_kid)
+        if key is None:
+            raise JWTError("No signing key in the key ring")
+        return jwt.encode(claims, key, algorithm=self.algorithm, headers={"kid": self.active_kid})
+
+    def decode(self, token: str, **kwargs) -> dict:
+        # read the kid from the header without verifying, then verify by the cached key of that kid
+        header = jwt.get_unverified_header(token)
+        key = self._verify_keys.get(header.get("kid"))
+        if key is None:
+            raise JWTError("Unknown key id")
+        return jwt.decode(token, key, algorithms=[self.algorithm], **kwargs)
+
+
+def generate_private_key(algorithm: str) -> bytes:
+    # generate a new private key as PEM, use it for local development or tests
+    # in production, generate the key once and give the path to load_key_ring()
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+    if algorithm.startswith("RS"):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    elif algorithm.startswith("ES"):
+        curve = {"ES256": ec.SECP256R1(), "ES384": ec.SECP384R1(), "ES512": ec.SECP521R1()}[algorithm]
+        private_key = ec.generate_private_key(curve)
+    else:
+        raise ValueError(f"{algorithm} does not use a key pair")
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+def _kid(name: str) -> str:
+    # "k1.pem", "k1.key.pem" and "k1.pub.pem" are the keys of the kid "k1"
+    # only the last suffixes are removed, so "2024.01.pem" is the kid "2024.01", not "2024"
+    kid = os.path.splitext(name)[0]
+    for suffix in (".pub", ".key"):
+        if kid.endswith(suffix):
+            return kid[:-len(suffix)]
+    return kid
+
+
+def _read_key(*paths: str) -> Union[bytes, None]:
+    # the first of the paths that exists
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+    return None
+
+
+def load_key_ring(algorithm: Union[str, None] = None, secret_key: Union[str, None] = None) -> KeyRing:
+    # config by env:
+    # JWT_ALGORITHM: RS256 (default), ES256, HS256, ...
+    # JWT_KEYS_DIR: a folder that contains <kid>.pem or <kid>.key.pem (private key) and/or <kid>.pub.pem (public key)
+    #               a service that only verifies tokens only need the *.pub.pem files
+    # JWT_ACTIVE_KID: the kid used to sign new tokens, default is the last kid by name
+    #
+    # without JWT_KEYS_DIR, a new key pair is generated when the app starts, FOR DEVELOPMENT ONLY:
+    # the tokens are invalid after a restart, and every worker has its own key,
+    # so with "uvicorn --workers N" (or serve.py), a token of a worker is rejected by the others
+    algorithm = algorithm or os.getenv("JWT_ALGORITHM", "RS256")
+    ring = KeyRing(algorithm)
+
+    if algorithm in SYMMETRIC_ALGORITHMS:
+        ring.add_key(os.getenv("JWT_ACTIVE_KID", "default"), private_key=secret_key)
+        return ring
+
+    keys_dir = os.getenv("JWT_KEYS_DIR")
+    if not keys_dir:
+        logger.warning("JWT_KEYS_DIR is not set, a %s key is generated for this process only: "
+                       "for development with 1 worker, the tokens don't work on the other workers", algorithm)
+        ring.add_key("dev", private_key=generate_private_key(algorithm))
+        return ring
+
+    kids = sorted({_kid(name) for name in os.listdir(keys_dir) if name.endswith(".pem")})
+    for kid in kids:
+        private_key = _read_key(os.path.join(keys_dir, f"{kid}.pem"), os.path.join(keys_dir, f"{kid}.key.pem"))
+        public_key = _read_key(os.path.join(keys_dir, f"{kid}.pub.pem"))
+        ring.add_key(kid, private_key=private_key, public_key=public_key, activate=True)
+
+    active_kid = os.getenv("JWT_ACTIVE_KID")
+    if active_kid:
+        # fail at startup, not on every login later
+        if active_kid not in ring._signing_keys:
+            raise ValueError(f"JWT_ACTIVE_KID={active_kid} has no private key in {keys_dir}")
+        ring.active_kid = active_kid
+    return ring
@@ -1,12 +1,25 @@
 from fastapi import FastAPI, Request, Query, Path, Body, Header, status, Form, File, UploadFile, HTTPException, \
-    Depends, BackgroundTasks
+    Depends, Response
+import json
 from enum import Enum
-from typing import Union, List, Set, Dict
-from pydantic import BaseModel, Required, Field, HttpUrl
+from typing import Union, List, Set, Dict, Tuple
+from pydantic import BaseModel, Required, Field, HttpUrl, ValidationError, validator
 from datetime import datetime
 from uuid import UUID
 from fastapi.responses import JSONResponse
 from fastapi.encoders import jsonable_encoder
+from fastapi.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+
+import memprof
+import openapi_cache
+import pricing
+from batch import add_batch_route
+from idempotency import IdempotencyMiddleware
+from jobqueue import JobQueue
+from ndjson import NDJSON_MAX_LINE_BYTES, NDJSONStreamResponse, dumps_line, read_lines, spool
+from static_files import FileServer
+from trusted import construct_trusted
 
 
 # init FastApi by using # app = FastAPI()
@@ -76,6 +89,15 @@ app = FastAPI(
     # docs_url="/docs2"
 )
 
+# load the prebuilt OpenAPI schema at startup, instead of building it on the first /docs request
+# build it ahead of time by: python -m openapi_cache main:app
+# check openapi_cache.py for more detail
+openapi_cache.install(app)
+
+# a retry of POST /items/ with the same Idempotency-Key header gets the first response back,
+# create_item() is not run again, check idempotency.py
+app.add_middleware(IdempotencyMiddleware, paths=[r"/items/"])
+
 
 # @app.get("/")
 # def root():
@@ -113,9 +135,20 @@ async def get_model(model_name1: ModelName1):
 
 
 # :path is to make sure file_path is a file path, but it doesn't seem to work
+# @app.get("/files/{file_path:path}")
+# async def read_file(file_path: str):
+#     return {"file_path": file_path}
+
+# :path lets file_path contain "/", ex: /files/css/site.css
+# the files are served from the STATIC_FILES_ROOT folder, with Range, If-Modified-Since and a memory cache
+# check static_files.py
+files = FileServer()
+
+
 @app.get("/files/{file_path:path}")
-async def read_file(file_path: str):
-    return {"file_path": file_path}
+@app.head("/files/{file_path:path}")
+async def read_file(file_path: str, request: Request):
+    return await files.response(file_path, request)
 
 
 fake_items_db = [{"item_name": "Foo"}, {"item_name": "Bar"}, {"item_name": "Baz"}]
@@ -223,17 +256,125 @@ class Item(BaseModel):
 
 # create the first data for Item model
 # and add additional value "price_with_tax" to the result
+# the dict is built by item_with_tax(), the bulk endpoint below uses it too
 @app.post("/create_item/")
 async def create_item(item: Item):
+    return item_with_tax(item)
+
+
+def item_with_tax(item: Item) -> dict:
     # transfer model to dict
     item_dict = item.dict()
-    if item.tax:
+    # a tax of 0 is still a tax (price_with_tax = price), only a missing tax is no tax, like pricing.quote()
+    if item.tax is not None:
         price_with_tax = item.price + item.tax
         # update a dict by using dict.update()
         item_dict.update({"price_with_tax": price_with_tax})
     return item_dict
 
 
+# bulk version of create_item, for the catalog sync that sends a lot of items
+# the body is NDJSON, 1 item per line, check ndjson.py
+# the response is NDJSON too, 1 result per line in the same order, then a summary line:
+# {"line": 1, "ok": true, "item": {..., "price_with_tax": 3.5}}
+# {"line": 2, "ok": false, "errors": [{"loc": ["price"], "msg": "field required", "type": "value_error.missing"}]}
+# {"summary": {"lines": 2, "valid": 1, "invalid": 1}}
+#
+# the lines are validated while the body arrives, so the memory stays small even for a body of many GB
+# by default, the results are spooled (in memory, then in a temp file) and sent when the body is read
+# with ?duplex=true, the results are sent while the body arrives, the client must read them while it sends
+# ex: curl -X POST -H "Content-Type: application/x-ndjson" --data-binary @items.ndjson http://127.0.0.1:8000/create_item/bulk/
+@app.post("/create_item/bulk/", response_class=NDJSONStreamResponse, openapi_extra={
+    "requestBody": {"content": {"application/x-ndjson": {"schema": {"type": "string"}}}, "required": True},
+})
+async def create_items_bulk(request: Request, duplex: bool = False):
+    async def results():
+        counts = {"lines": 0, "valid": 0, "invalid": 0}
+        try:
+            async for lines in read_lines(request.stream()):
+                # the validation is CPU work, it runs in the threadpool so the other requests are not blocked
+                output, valid, invalid = await run_in_threadpool(validate_item_lines, lines)
+                counts["lines"] = lines[-1][0]
+                counts["valid"] += valid
+                counts["invalid"] += invalid
+                if output:
+                    yield output
+        except ClientDisconnect:
+            return
+        yield dumps_line({"summary": counts})
+
+    return NDJSONStreamResponse(results() if duplex else spool(results()))
+
+
+def validate_item_lines(lines) -> Tuple[bytes, int, int]:
+    output = []
+    valid = invalid = 0
+    for line_number, line in lines:
+        if line is None:
+            errors = [{"loc": [], "msg": f"line is longer than {NDJSON_MAX_LINE_BYTES} bytes", "type": "value_error"}]
+        elif not line.strip():
+            # empty lines are allowed, ex: the last "\n" of the file
+            continue
+        else:
+            try:
+                item = Item.parse_raw(line)
+            except ValidationError as e:
+                errors = e.errors()
+            else:
+                output.append(dumps_line({"line": line_number, "ok": True, "item": item_with_tax(item)}))
+                valid += 1
+                continue
+        output.append(dumps_line({"line": line_number, "ok": False, "errors": errors}))
+        invalid += 1
+    return b"".join(output), valid, invalid
+
+
+# quotes of many items at once: price_with_tax of create_item, computed by NumPy on whole columns, check pricing.py
+# the body is {"price": [...], "tax": [...]}, or the binary format with "Content-Type: application/octet-stream"
+# the response is {"summary": {"count": 2, "total_sum": ...}, "totals": [38.6, 10.0]}, the totals in the same order
+# - ?totals=false: only the summary
+# - "Accept: application/octet-stream": the totals in binary, and the summary as JSON in the X-Quote-Summary header
+# ex: curl -X POST -H "Content-Type: application/octet-stream" --data-binary @quotes.bin http://127.0.0.1:8000/create_item/quote/
+@app.post("/create_item/quote/", openapi_extra={
+    "requestBody": {"content": {
+        "application/json": {"schema": {"type": "object", "properties": {
+            "price": {"type": "array", "items": {"type": "number"}},
+            "tax": {"type": "array", "items": {"type": "number", "nullable": True}},
+        }, "required": ["price"]}},
+        pricing.BINARY_CONTENT_TYPE: {"schema": {"type": "string", "format": "binary"}},
+    }, "required": True},
+})
+async def quote_items(request: Request, totals: bool = True):
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > pricing.PRICING_MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Body is too large")
+    binary = pricing.BINARY_CONTENT_TYPE in request.headers.get("accept", "")
+    try:
+        # the parsing and the math are CPU work, it runs in the threadpool so the other requests are not blocked
+        content, summary = await run_in_threadpool(
+            quote_body, body, request.headers.get("content-type", ""), totals, binary
+        )
+    except pricing.PricingError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if binary:
+        return Response(content, media_type=pricing.BINARY_CONTENT_TYPE,
+                        headers={"X-Quote-Summary": json.dumps(summary)})
+    return Response(content, media_type="application/json")
+
+
+def quote_body(body: bytearray, content_type: str, with_totals: bool, binary: bool) -> Tuple[bytes, dict]:
+    item_totals, summary = pricing.quote(*pricing.parse_body(body, content_type))
+    if binary:
+        return pricing.dump_totals(item_totals) if with_totals else b"", summary
+    result = {"summary": summary}
+    if with_totals:
+        # tolist() gives Python floats in 1 call, it's much faster than jsonable_encoder on the array
+        result["totals"] = item_totals.tolist()
+    return json.dumps(result).encode(), summary
+
+
 # update value "q" to the result
 # @app.put("/items/{item_id}")
 # async def create_item(item_id: int, item: Item, q: Union[str, None] = None):
@@ -499,7 +640,15 @@ async def update_item(id: str, item: Item):
     return "check command to see the result"
 
 
+# durable job queue, the jobs are saved in a sqlite file (jobs.db) and run by separate worker processes
+# run the workers by: python -m jobqueue main
+# check jobqueue.py for more detail
+jobs = JobQueue()
+
+
 # create a log file and write a log into it
+# @jobs.task register this function as a task, so the workers can run it by its name
+@jobs.task
 def write_notification(email: str, message=""):
     with open("log.txt", mode="w") as email_file:
         content = f"notification for {email}: {message}"
@@ -510,11 +659,26 @@ def write_notification(email: str, message=""):
 # so we can still running the main task, but also run the background task behind of it
 # it's useful when we need to send email, but still need to return the response
 # BackgroundTasks is like a queue in other language
+# @app.post("/send-notification/{email}")
+# async def send_notification(email: str, background_tasks: BackgroundTasks):
+#     background_tasks.add_task(write_notification, email, message="some notification")
+#     return {"message": "Notification sent in the background"}
+
+# but BackgroundTasks runs the task in the same worker, after the response
+# so the task is lost if the worker dies, and the task takes CPU from the next requests
+# so now we only add the job to the queue, and the worker processes run it
+# sqlite is blocking, so we add the job in the threadpool to not block the event loop
 @app.post("/send-notification/{email}")
-async def send_notification(email: str, background_tasks: BackgroundTasks):
-    background_tasks.add_task(write_notification, email, message="some notification")
+async def send_notification(email: str):
+    await run_in_threadpool(jobs.enqueue, write_notification, email, message="some notification")
     return {"message": "Notification sent in the background"}
 
+
+# queue depth and job latency, to see if we need more workers
+@app.get("/jobs/stats")
+async def read_job_stats():
+    return await run_in_threadpool(jobs.stats)
+
 # sample data for pytest, check on test_main.py to see how pytest work
 fake_secret_token = "coneofsilence"
 
@@ -524,6 +688,10 @@ fake_db = {
     "bar": {"id": "bar", "title": "Bar", "description": "The bartenders"},
 }
 
+# the version of each item of fake_db, 1 until it's changed by PATCH /items/{item_id}
+# GET and PATCH return it in the ETag header
+fake_db_versions = {}
+
 
 # sample data for pytest, check on test_main.py to see how pytest work
 class Item1(BaseModel):
@@ -533,13 +701,23 @@ class Item1(BaseModel):
 
 
 # sample data for pytest, check on test_main.py to see how pytest work
-@app.get("/items/{item_id}", response_model=Item1)
-async def read_main(item_id: str, x_token: str = Header()):
+
+# the data in fake_db is written by ourselves, so we don't need to validate it again on every read
+# construct_trusted() builds Item1 without validation
+# response_model=Item1 would validate the result once more, so we only declare Item1 in "responses"
+# the swagger still shows Item1 as the response
+
+# the read of fake_db doesn't wait on anything, so concurrent requests can't share it (check singleflight.py),
+# it's only worth it for a read that awaits I/O, ex: the db reads of sql_app
+@app.get("/items/{item_id}", response_model=None, responses={200: {"model": Item1}})
+async def read_main(item_id: str, response: Response, x_token: str = Header()):
     if x_token != fake_secret_token:
         raise HTTPException(status_code=400, detail="Invalid X-Token header")
     if item_id not in fake_db:
         raise HTTPException(status_code=404, detail="Item not found")
-    return fake_db[item_id]
+    # the version to send back with PATCH, in the "If-Match" header or as "version" in the body
+    response.headers["ETag"] = f'"{fake_db_versions.get(item_id, 1)}"'
+    return construct_trusted(Item1, fake_db[item_id])
 
 
 # sample data for pytest, check on test_main.py to see how pytest work
@@ -549,5 +727,70 @@ async def create_item(item: Item1, x_token: str = Header()):
         raise HTTPException(status_code=400, detail="Invalid X-Token header")
     if item.id in fake_db:
         raise HTTPException(status_code=400, detail="Item already exists")
-    fake_db[item.id] = item
+    # the client data is validated by Item1 above, store it as a dict like the other fake_db rows
+    fake_db[item.id] = item.dict()
     return item
+
+
+async def verify_x_token(x_token: str = Header()):
+    if x_token != fake_secret_token:
+        raise HTTPException(status_code=400, detail="Invalid X-Token header")
+
+
+# RSS, gc stats and, with MEMPROF=1, the allocations by line and by route at /admin/memory, check memprof.py
+# the routes are only there with MEMPROF=1 or MEMPROF_ADMIN=1, and they need the X-Token header
+memprof.install(app, dependencies=[Depends(verify_x_token)])
+
+
+# PATCH: only the fields the client sent are validated and changed, the others are kept
+# unlike PUT /items/{id} above, the client doesn't have to send the whole item again
+# to not overwrite the change of another client, send the ETag of GET /items/{item_id}:
+# - in the "If-Match" header: 412 when the item changed since then (like in the HTTP spec)
+# - or as "version" in the body: 409, like PATCH of sql_app
+class Item1Update(BaseModel):
+    title: Union[str, None] = None
+    description: Union[str, None] = None
+    # the version the client read, 409 when the item changed since then
+    version: Union[int, None] = None
+
+    @validator("title")
+    def title_not_null(cls, value):
+        # title can be left out, but not sent as null
+        if value is None:
+            raise ValueError("can't be null")
+        return value
+
+
+@app.patch("/items/{item_id}", response_model=Item1, dependencies=[Depends(verify_x_token)])
+async def patch_item(item_id: str, item: Item1Update, response: Response,
+                     if_match: Union[str, None] = Header(default=None)):
+    if item_id not in fake_db:
+        raise HTTPException(status_code=404, detail="Item not found")
+    version = fake_db_versions.get(item_id, 1)
+    if if_match is not None and if_match.strip() != "*":
+        # a list of ETags, ex: "2", W/"3"
+        etags = set()
+        for etag in if_match.split(","):
+            etag = etag.strip()
+            etags.add(etag[2:] if etag.startswith("W/") else etag)
+        if f'"{version}"' not in etags:
+            raise HTTPException(status_code=412, detail=f"The item was changed, it's at version {version}")
+    if item.version is not None and item.version != version:
+        raise HTTPException(status_code=409, detail=f"The item was changed, it's at version {version}")
+    # exclude_unset: {"title": "x"} only changes title, a description that wasn't sent is kept
+    changes = item.dict(exclude_unset=True, exclude={"version"})
+    row = fake_db[item_id]
+    changes = {name: value for name, value in changes.items() if row.get(name) != value}
+    if changes:
+        # a new dict, so a read that already has the old row doesn't see half of the change
+        fake_db[item_id] = {**row, **changes}
+        version += 1
+        fake_db_versions[item_id] = version
+    response.headers["ETag"] = f'"{version}"'
+    return fake_db[item_id]
+
+
+# many small calls in 1 request: POST /batch/ {"requests": [{"path": "/items/foo"}, {"path": "/items/bar"}]}
+# the token is checked once for the whole batch, and the X-Token header is given to every sub-request
+# check batch.py
+add_batch_route(app, dependencies=[Depends(verify_x_token)])
@@ -0,0 +1,345 @@
+import gc
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from collections import deque
+from typing import Dict, List, Sequence, Union
+
+from fastapi import FastAPI, HTTPException, Query
+
+# Memory profiling of a worker, opt-in, to find what makes the RSS grow over the day
+# ex: fake_db of main.py, the spooled uploads, the ORM sessions of sql_app
+#
+# turn it on for 1 canary worker: MEMPROF=1 uvicorn main:app
+# then (the routes need the auth of the app, ex: the X-Token header of main.py):
+# - GET /admin/memory: RSS, gc stats, memory traced by tracemalloc, the allocation delta of every route,
+#   and the last samples of the reporter
+# - GET /admin/memory/top: the lines (or files) that hold the most memory right now
+# - POST /admin/memory/snapshot, wait a while (or run some load), then GET /admin/memory/diff:
+#   the lines whose memory grew since the snapshot, that's where the leak is
+#
+# or, on a worker started with MEMPROF_ADMIN=1, only for a while: POST /admin/memory/trace?seconds=600
+# tracemalloc runs for 10 minutes, then it stops by itself (take the snapshot and the diff in that window)
+# without MEMPROF=1 or MEMPROF_ADMIN=1, install() adds nothing to the app: no route, no middleware
+#
+# cost, so it can run on a canary:
+# - tracemalloc only keeps MEMPROF_FRAMES frames per allocation (1 by default, the line that allocated),
+#   it's the main cost: every allocation is slower, and each traced block takes some more memory
+#   measured by python -m benchmarks.bench_memprof: ~5% less req/s when it's only GET /users/,
+#   but the writes allocate a lot (a new sqlite connection, the SQL statements): with 1 write in 4,
+#   154 req/s off => 60 req/s with 1 frame (-60%) => 13 req/s with 10 frames (-90%)
+#   so it's for 1 canary worker, with 1 frame, or for a trace window, never for the whole fleet
+# - the per-route delta is only measured for 1 request in MEMPROF_SAMPLE_EVERY, and it's only 2 counter reads:
+#   the traced memory at the end of the request - at the start, so a positive delta is memory that stayed
+#   !important: the traced memory is for the whole process, so the delta of a request that runs at the same time
+#   as others also has their allocations. such a sample is not recorded, it's counted in "overlapped" of the route,
+#   and the next request that runs alone is sampled instead. on a worker that is never idle, the routes only get
+#   "overlapped" counts: use a trace window and top/diff there. the threads that don't serve a request
+#   (ex: the feed poller of sql_app) can still add some noise to a delta
+# - a snapshot (top, diff) copies all the traces, it's slow on a big heap: only call it by hand
+# - the reporter thread wakes up every MEMPROF_REPORT_INTERVAL seconds, it's a thread, so it still reports
+#   when the event loop is blocked
+#
+# with MEMPROF_ADMIN=1 and outside of a trace window, tracemalloc is off: GET /admin/memory only has RSS and gc stats,
+# top/diff return 400, and the per-route middleware only checks that tracemalloc is off
+#
+# config by env:
+# MEMPROF=1: turn it on, default is off
+# MEMPROF_ADMIN=1: only add the /admin/memory routes, for RSS, gc stats and the trace windows, default is off
+# MEMPROF_FRAMES: the frames kept per allocation, default is 1, more gives the callers (group_by=traceback)
+# MEMPROF_SAMPLE_EVERY: measure 1 request in N for the per-route deltas, default is 10
+# MEMPROF_REPORT_INTERVAL: seconds between 2 samples of the reporter (logged and kept), default is 60
+
+MEMPROF = os.getenv("MEMPROF", "0") == "1"
+MEMPROF_ADMIN = os.getenv("MEMPROF_ADMIN", "0") == "1"
+MEMPROF_FRAMES = int(os.getenv("MEMPROF_FRAMES", "1"))
+MEMPROF_SAMPLE_EVERY = int(os.getenv("MEMPROF_SAMPLE_EVERY", "10"))
+MEMPROF_REPORT_INTERVAL = float(os.getenv("MEMPROF_REPORT_INTERVAL", "60"))
+
+logger = logging.getLogger("memprof")
+
+# the allocations of tracemalloc itself, and of the import system, are not interesting
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+GROUP_BY = ["lineno", "filename", "traceback"]
+
+
+def rss_bytes() -> int:
+    # the current RSS on linux, else the max RSS of the process
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def gc_stats() -> dict:
+    return {
+        # the objects waiting in each generation, a big gen 2 is many long lived objects
+        "counts": list(gc.get_count()),
+        "generations": gc.get_stats(),
+        "garbage": len(gc.garbage),
+    }
+
+
+class RouteStats:
+    __slots__ = ("samples", "total", "max", "last", "overlapped")
+
+    def __init__(self):
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+        self.last = 0
+        # the samples that were dropped, other requests ran at the same time
+        self.overlapped = 0
+
+    def add(self, delta: int):
+        self.samples += 1
+        self.total += delta
+        self.max = max(self.max, delta)
+        self.last = delta
+
+    def as_dict(self) -> dict:
+        return {
+            "samples": self.samples,
+            "avg_delta_bytes": self.total // self.samples if self.samples else 0,
+            "max_delta_bytes": self.max,
+            "last_delta_bytes": self.last,
+            "overlapped": self.overlapped,
+        }
+
+
+class MemoryProfiler:
+    def __init__(self, enabled: bool = MEMPROF, frames: int = MEMPROF_FRAMES, sample_every: int = MEMPROF_SAMPLE_EVERY,
+                 report_interval: float = MEMPROF_REPORT_INTERVAL, history: int = 60):
+        self.enabled = enabled
+        self.frames = frames
+        self.sample_every = max(1, sample_every)
+        self.report_interval = report_interval
+        self.routes: Dict[str, RouteStats] = {}
+        self.history = deque(maxlen=history)
+        self.baseline: Union[tracemalloc.Snapshot, None] = None
+        self._requests = 0
+        # the requests running now, and the requests started since tracing, check begin()
+        self._active = 0
+        self._started = 0
+        self._due = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._tracing = False
+        self._window = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._tracing = True
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._report_loop, name="memprof", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stop_tracing()
+
+    def trace_for(self, seconds: float):
+        # a trace window: tracemalloc runs for "seconds", then it stops by itself, unless MEMPROF=1
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self._tracing = True
+            if self._window is not None:
+                self._window.cancel()
+            if not self.enabled:
+                self._window = threading.Timer(seconds, self._stop_tracing)
+                self._window.daemon = True
+                self._window.start()
+
+    def _stop_tracing(self):
+        with self._lock:
+            if self._window is not None:
+                self._window.cancel()
+                self._window = None
+            if self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+                self.baseline = None
+
+    def sample(self) -> dict:
+        traced, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        return {
+            "time": time.time(),
+            "rss_bytes": rss_bytes(),
+            "traced_bytes": traced,
+            "traced_peak_bytes": peak,
+            "gc": list(gc.get_count()),
+            "gc_collections": [generation["collections"] for generation in gc.get_stats()],
+        }
+
+    def _report_loop(self):
+        while not self._stop.wait(self.report_interval):
+            sample = self.sample()
+            self.history.append(sample)
+            logger.info("memory %s", json.dumps(sample))
+
+    # per-route deltas, called by MemoryMiddleware
+
+    def begin(self) -> Union[int, None]:
+        # called at the start of every request while tracing
+        # returns a token when this request is sampled: 1 in sample_every, and only when no other request runs
+        with self._lock:
+            self._requests += 1
+            self._active += 1
+            self._started += 1
+            if self._requests % self.sample_every == 0:
+                self._due = True
+            if self._due and self._active == 1:
+                self._due = False
+                return self._started
+            return None
+
+    def end(self, token: Union[int, None]) -> bool:
+        # True when the sample is clean: no other request started while it ran
+        with self._lock:
+            self._active -= 1
+            if token is not None and self._started != token:
+                # try again with the next request
+                self._due = True
+                return False
+            return token is not None
+
+    def _route(self, route: str) -> RouteStats:
+        stats = self.routes.get(route)
+        if stats is None:
+            stats = self.routes[route] = RouteStats()
+        return stats
+
+    def record(self, route: str, delta: int):
+        with self._lock:
+            self._route(route).add(delta)
+
+    def record_overlapped(self, route: str):
+        with self._lock:
+            self._route(route).overlapped += 1
+
+    # snapshots
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        if not tracemalloc.is_tracing():
+            raise HTTPException(status_code=400, detail="tracemalloc is off, start the worker with MEMPROF=1")
+        return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+    def take_baseline(self):
+        self.baseline = self._snapshot()
+
+    def top(self, limit: int = 20, group_by: str = "lineno") -> List[dict]:
+        return [_stat(stat, group_by) for stat in self._snapshot().statistics(group_by)[:limit]]
+
+    def diff(self, limit: int = 20, group_by: str = "lineno") -> List[dict]:
+        if self.baseline is None:
+            raise HTTPException(status_code=400, detail="No snapshot yet, take one by POST /admin/memory/snapshot")
+        stats = self._snapshot().compare_to(self.baseline, group_by)
+        return [_stat(stat, group_by) for stat in stats[:limit]]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            routes = {route: stats.as_dict() for route, stats in self.routes.items()}
+        return {
+            "enabled": tracemalloc.is_tracing(),
+            **self.sample(),
+            "gc_stats": gc_stats(),
+            # the routes that keep the most memory first
+            "routes": dict(sorted(routes.items(), key=lambda item: -item[1]["avg_delta_bytes"])),
+            "history": list(self.history),
+        }
+
+
+def _stat(stat: Union[tracemalloc.Statistic, tracemalloc.StatisticDiff], group_by: str) -> dict:
+    frames = stat.traceback if group_by == "traceback" else stat.traceback[:1]
+    site = [f"{frame.filename}:{frame.lineno}" if group_by != "filename" else frame.filename for frame in frames]
+    result = {"site": site if group_by == "traceback" else site[0], "size_bytes": stat.size, "count": stat.count}
+    if isinstance(stat, tracemalloc.StatisticDiff):
+        result["size_diff_bytes"] = stat.size_diff
+        result["count_diff"] = stat.count_diff
+    return result
+
+
+class MemoryMiddleware:
+    # the traced memory kept by a sampled request, by route (the name of the endpoint)
+    def __init__(self, app, profiler: MemoryProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracemalloc.is_tracing():
+            return await self.app(scope, receive, send)
+        token = self.profiler.begin()
+        before = tracemalloc.get_traced_memory()[0] if token is not None else 0
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            clean = self.profiler.end(token)
+            # the router adds the endpoint to the scope, so we know the route once the request is done
+            # (and the trace window may have ended during the request)
+            if token is not None and tracemalloc.is_tracing():
+                endpoint = scope.get("endpoint")
+                route = f"{scope['method']} {getattr(endpoint, '__name__', scope['path'])}"
+                if clean:
+                    self.profiler.record(route, tracemalloc.get_traced_memory()[0] - before)
+                else:
+                    self.profiler.record_overlapped(route)
+
+
+def install(app: FastAPI, profiler: MemoryProfiler = None, dependencies: Union[Sequence, None] = None,
+            admin: Union[bool, None] = None) -> MemoryProfiler:
+    # the /admin/memory routes, and with MEMPROF=1: tracemalloc and the reporter from the startup
+    # admin: add them, default is MEMPROF=1, MEMPROF_ADMIN=1 or an enabled profiler, else nothing is added to the app
+    # dependencies: the auth of the routes, ex: [Depends(verify_x_token)], they show the code and the heap of the worker
+    profiler = profiler or MemoryProfiler()
+    if admin is None:
+        admin = MEMPROF or MEMPROF_ADMIN or profiler.enabled
+    if not admin:
+        return profiler
+    app.add_middleware(MemoryMiddleware, profiler=profiler)
+    app.add_event_handler("startup", profiler.start)
+    app.add_event_handler("shutdown", profiler.stop)
+    group_by = Query(default="lineno", regex=f"^({'|'.join(GROUP_BY)})$")
+
+    @app.get("/admin/memory", dependencies=dependencies)
+    def read_memory():
+        return profiler.snapshot()
+
+    @app.get("/admin/memory/top", dependencies=dependencies)
+    def read_memory_top(limit: int = Query(default=20, ge=1, le=500), group_by: str = group_by):
+        return profiler.top(limit, group_by)
+
+    @app.post("/admin/memory/trace", dependencies=dependencies)
+    def start_memory_trace(seconds: float = Query(default=600, gt=0, le=24 * 3600)):
+        profiler.trace_for(seconds)
+        return {"tracing": True, "seconds": None if profiler.enabled else seconds}
+
+    @app.post("/admin/memory/snapshot", dependencies=dependencies)
+    def take_memory_snapshot():
+        profiler.take_baseline()
+        return {"taken": True}
+
+    @app.get("/admin/memory/diff", dependencies=dependencies)
+    def read_memory_diff(limit: int = Query(default=20, ge=1, le=500), group_by: str = group_by):
+        return profiler.diff(limit, group_by)
+
+    return profiler
@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+from typing import Any, AsyncIterator, List, Tuple, Union
+
+from pydantic.json import pydantic_encoder
+from starlette.responses import Response
+
+# NDJSON (newline delimited JSON): 1 JSON document per line, ex:
+#   {"name": "Foo", "price": 1.5}
+#   {"name": "Bar", "price": 2}
+#
+# a big NDJSON body can be handled line by line while it arrives, without keeping the whole body in memory
+# read_lines() cuts the chunks of the body into lines, NDJSONStreamResponse sends the results while we read
+#
+# !important: to get the results while it still sends the body, the client must read the response at the same time
+# (full duplex). most clients (requests, httpx) send the whole body first, then read the response,
+# so with a big body, both sides wait for each other when their socket buffers are full
+# spool() is for these clients: the results are kept (in memory, then in a temp file) until the body is read
+#
+# config by env:
+# NDJSON_MAX_LINE_BYTES: a longer line is rejected (and skipped) instead of growing the buffer, default is 1 MiB
+# NDJSON_SPOOL_MEMORY_BYTES: spool() keeps this much in memory, the rest goes to a temp file, default is 1 MiB
+
+NDJSON_MAX_LINE_BYTES = int(os.getenv("NDJSON_MAX_LINE_BYTES", str(1024 * 1024)))
+NDJSON_SPOOL_MEMORY_BYTES = int(os.getenv("NDJSON_SPOOL_MEMORY_BYTES", str(1024 * 1024)))
+
+
+async def read_lines(chunks: AsyncIterator[bytes], max_line_bytes: int = NDJSON_MAX_LINE_BYTES
+                     ) -> AsyncIterator[List[Tuple[int, Union[bytes, None]]]]:
+    # yields the complete lines of every chunk as a list of (line number, line)
+    # the line is None when it's longer than max_line_bytes
+    # so the memory is at most 1 chunk + max_line_bytes, whatever the size of the body
+    buffer = b""
+    line_number = 0
+    # we are in the middle of a too long line, it's dropped until its end
+    skipping = False
+    async for chunk in chunks:
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        batch = []
+        for line in lines:
+            if skipping:
+                # the end of the too long line, it's already reported
+                skipping = False
+                continue
+            line_number += 1
+            batch.append((line_number, line if len(line) <= max_line_bytes else None))
+        if skipping:
+            buffer = b""
+        elif len(buffer) > max_line_bytes:
+            line_number += 1
+            batch.append((line_number, None))
+            buffer = b""
+            skipping = True
+        if batch:
+            yield batch
+    if buffer:
+        yield [(line_number + 1, buffer)]
+
+
+def dumps_line(obj: Any) -> bytes:
+    # pydantic_encoder also knows the types of the models, ex: set, HttpUrl, datetime
+    return json.dumps(obj, default=pydantic_encoder, separators=(",", ":")).encode() + b"\n"
+
+
+async def spool(chunks: AsyncIterator[bytes], max_memory: int = NDJSON_SPOOL_MEMORY_BYTES,
+                chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    # take all the chunks first, then give them back
+    # the writes go to the page cache of the OS, they are fast enough to be done in the event loop
+    with tempfile.SpooledTemporaryFile(max_size=max_memory) as f:
+        async for chunk in chunks:
+            f.write(chunk)
+        f.seek(0)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class NDJSONStreamResponse(Response):
+    # like StreamingResponse, but it doesn't listen for the disconnect on "receive" while it sends
+    # StreamingResponse does, and it would take the chunks of the request body that we are still reading
+    # a disconnect is seen by request.stream() instead, it raises ClientDisconnect
+    media_type = "application/x-ndjson"
+
+    def __init__(self, content: AsyncIterator[bytes], status_code: int = 200, headers: dict = None):
+        self.body_iterator = content
+        self.status_code = status_code
+        self.background = None
+        # no content-length, the body is sent in chunks
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        async for chunk in self.body_iterator:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
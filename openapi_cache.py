@@ -0,0 +1,153 @@
+import hashlib
+import importlib
+import json
+import os
+import sys
+import tempfile
+
+import fastapi
+import pydantic
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
+
+# Prebuilt OpenAPI schema
+#
+# by default, FastAPI builds the OpenAPI schema on the first /openapi.json (or /docs) request
+# for an app with many routes and models, it takes a while, and every new worker pays it on a client request
+#
+# here, the schema is built ahead of time and saved to a file, the name of the file is a hash of the route table
+# at startup, the app loads the file of the current hash instead of building the schema
+# when a route or a model changes, the hash changes, so an old file is never used
+#
+# build the schema ahead of time (ex: in the docker build), run from the project folder:
+# => python -m openapi_cache main:app
+#
+# config by env:
+# OPENAPI_CACHE_DIR: where the schema files are saved, default is ".openapi"
+# OPENAPI_CACHE=0: disable the cache, FastAPI builds the schema like normal
+
+OPENAPI_CACHE_DIR = os.getenv("OPENAPI_CACHE_DIR", ".openapi")
+OPENAPI_CACHE = os.getenv("OPENAPI_CACHE", "1") != "0"
+
+
+def _source_files(app: FastAPI):
+    # the schema depends on the Field/Query metadata in the source code, not only on the route paths
+    # so we hash the files of the modules that declare the endpoints and their models
+    modules = set()
+    for route in app.routes:
+        if not isinstance(route, APIRoute):
+            continue
+        modules.add(route.endpoint.__module__)
+        types = [route.response_model] + [param.type_ for param in route.dependant.body_params]
+        types += [param.type_ for param in route.dependant.query_params + route.dependant.path_params]
+        for type_ in types:
+            module = getattr(type_, "__module__", None)
+            if module and module != "builtins":
+                modules.add(module)
+    files = set()
+    for module in modules:
+        path = getattr(sys.modules.get(module), "__file__", None)
+        if path and os.path.exists(path):
+            files.add(path)
+    return sorted(files)
+
+
+def route_table_hash(app: FastAPI) -> str:
+    h = hashlib.sha256()
+    metadata = {
+        "fastapi": fastapi.__version__,
+        "pydantic": pydantic.VERSION,
+        "title": app.title,
+        "version": app.version,
+        "openapi_version": app.openapi_version,
+        "description": app.description,
+        "summary": getattr(app, "summary", None),
+        "terms_of_service": app.terms_of_service,
+        "contact": app.contact,
+        "license_info": app.license_info,
+        "tags": app.openapi_tags,
+        "servers": app.servers,
+        "root_path": app.root_path,
+    }
+    h.update(json.dumps(metadata, sort_keys=True, default=str).encode())
+    for route in app.routes:
+        methods = sorted(getattr(route, "methods", None) or [])
+        endpoint = getattr(route, "endpoint", None)
+        name = f"{getattr(endpoint, '__module__', '')}.{getattr(endpoint, '__qualname__', '')}"
+        include = getattr(route, "include_in_schema", True)
+        h.update(f"{route.path}|{','.join(methods)}|{route.name}|{name}|{include}\n".encode())
+    for path in _source_files(app):
+        with open(path, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()[:16]
+
+
+def cache_path(app: FastAPI, cache_dir: str = None) -> str:
+    return os.path.join(cache_dir or OPENAPI_CACHE_DIR, f"openapi-{route_table_hash(app)}.json")
+
+
+def build(app: FastAPI, cache_dir: str = None) -> str:
+    # build the schema by FastAPI, then save it to the file of the current hash
+    path = cache_path(app, cache_dir)
+    schema = app.openapi_schema or _generate(app)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temp file then rename, so other workers never read a half written file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(schema, f, separators=(",", ":"))
+    os.replace(tmp, path)
+    return path
+
+
+def load(app: FastAPI, cache_dir: str = None):
+    # return the saved schema of the current hash, or None if it's not built yet
+    try:
+        with open(cache_path(app, cache_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _generate(app: FastAPI) -> dict:
+    return FastAPI.openapi(app)
+
+
+def install(app: FastAPI, cache_dir: str = None):
+    # replace app.openapi() by a version that loads the prebuilt schema
+    # and load it at startup, so the first /openapi.json request doesn't build anything
+    if not OPENAPI_CACHE:
+        return
+
+    def openapi():
+        if app.openapi_schema is None:
+            schema = load(app, cache_dir)
+            if schema is None:
+                # not built yet, build it now and save it, so the next workers can load it
+                schema = _generate(app)
+                try:
+                    build(app, cache_dir)
+                except OSError:
+                    pass
+            app.openapi_schema = schema
+        return app.openapi_schema
+
+    app.openapi = openapi
+    app.add_event_handler("startup", openapi)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the OpenAPI schema of an app ahead of time")
+    parser.add_argument("app", help="the app in uvicorn style, ex: main:app")
+    parser.add_argument("--dir", default=None, help="where to save the schema, default is OPENAPI_CACHE_DIR")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.getcwd())
+    module_name, attr = args.app.split(":")
+    app = getattr(importlib.import_module(module_name), attr)
+    print(build(app, args.dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import importlib
+import importlib.util
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+# Production launcher for the apps in this project
+#
+# "uvicorn main:app --reload" is for development, it runs 1 worker with auto reload
+# this launcher is for production, run from the project folder:
+# => python serve.py main:app
+# => python serve.py sql_app.main:app --workers 4
+# => python serve.py auth-jwt              (":app" is added when it's missing)
+#
+# what it does:
+# - workers: by default, 1 worker per CPU that this process can use (or WEB_CONCURRENCY)
+# - uvloop and httptools are used when they are installed, they are faster than asyncio and h11
+# - the app is imported ONCE in the main process, then the workers are forked from it,
+#   so the workers share the imported code and data (copy on write) and start faster
+# - the socket is opened once in the main process with a bigger backlog, all workers accept on it
+# - a worker that dies is restarted
+#
+# !important: don't open db connections or threads at import time, do it in a startup handler
+# a connection opened before the fork would be shared by all workers
+
+logger = logging.getLogger("serve")
+
+
+def load_app(app_path: str):
+    # app_path is the uvicorn style path, ex: "main:app", "auth-jwt:app"
+    # importlib can import "auth-jwt" even if it's not a valid python name
+    if ":" not in app_path:
+        app_path += ":app"
+    module_name, attr = app_path.split(":")
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def default_workers() -> int:
+    if os.getenv("WEB_CONCURRENCY"):
+        return int(os.environ["WEB_CONCURRENCY"])
+    try:
+        # the CPUs this process is allowed to use, it can be less than os.cpu_count() in a container
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def best_loop() -> str:
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+
+def best_http() -> str:
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+
+def resolve_options(workers: int = None, loop: str = None, http: str = None):
+    # the options that are not given get their default: 1 worker per CPU, uvloop and httptools when installed
+    return workers or default_workers(), loop or best_loop(), http or best_http()
+
+
+def bind_socket(host: str, port: int, backlog: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(config: uvicorn.Config, sock: socket.socket):
+    # the default signal handlers of the main process must not run in the worker
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn(config: uvicorn.Config, sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(config, sock)
+        except BaseException:
+            logger.exception("worker crashed")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def serve(app_path: str, host: str = "127.0.0.1", port: int = 8000, workers: int = None,
+          loop: str = None, http: str = None, backlog: int = 2048, keep_alive: int = 5,
+          access_log: bool = False, log_level: str = "info"):
+    workers, loop, http = resolve_options(workers, loop, http)
+    app = load_app(app_path)
+    config = uvicorn.Config(
+        app,
+        loop=loop,
+        http=http,
+        backlog=backlog,
+        timeout_keep_alive=keep_alive,
+        access_log=access_log,
+        log_level=log_level,
+    )
+    logging.basicConfig(level=log_level.upper(), format="%(levelname)s:     %(message)s")
+    logger.info("serving %s on http://%s:%d with %d worker(s), loop=%s, http=%s, backlog=%d, keep-alive=%ds",
+                app_path, host, port, workers, config.loop, config.http, backlog, keep_alive)
+
+    sock = bind_socket(host, port, backlog)
+
+    if workers == 1 or not hasattr(os, "fork"):
+        # no fork on Windows, run everything in this process
+        run_worker(config, sock)
+        return
+
+    children = {spawn(config, sock) for _ in range(workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            logger.warning("worker %d exited with status %d, starting a new one", pid, status)
+            # don't restart in a tight loop when the app can't start at all
+            time.sleep(1)
+            children.add(spawn(config, sock))
+    sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve an app of this project with multiple workers")
+    parser.add_argument("app", help="the app in uvicorn style, ex: main:app, sql_app.main:app, auth-jwt")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="default: 1 per CPU, or WEB_CONCURRENCY")
+    parser.add_argument("--loop", choices=["auto", "asyncio", "uvloop"], default=None,
+                        help="default: uvloop when installed")
+    parser.add_argument("--http", choices=["auto", "h11", "httptools"], default=None,
+                        help="default: httptools when installed")
+    parser.add_argument("--backlog", type=int, default=2048, help="max queued connections on the socket")
+    parser.add_argument("--keep-alive", type=int, default=5, help="seconds to keep an idle connection open")
+    parser.add_argument("--access-log", action="store_true", help="log every request, it costs throughput")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args(argv)
+
+    serve(args.app, host=args.host, port=args.port, workers=args.workers, loop=args.loop, http=args.http,
+          backlog=args.backlog, keep_alive=args.keep_alive, access_log=args.access_log,
+          log_level=args.log_level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+# Single flight: when many requests ask for the same thing at the same time, only compute it once
+#
+# ex: a user goes viral, and 500 requests of GET /users/1 arrive at the same time
+# without single flight, we run 500 same queries and serialize the user 500 times
+# with single flight, the first request (the "leader") runs the query,
+# the other requests wait for it and all receive its result
+#
+# it's only for reads (idempotent requests), and each route opts in by calling flight.do() itself:
+#
+#   flight = SingleFlight()
+#
+#   @app.get("/users/{user_id}")
+#   def read_user(user_id: int, db: Session = Depends(get_db)):
+#       return flight.do(("read_user", user_id), lambda: load_user(db, user_id))
+#
+# the result is shared by all the waiters, so it must not be changed by them
+# ex: return a pydantic model, not an ORM object that is bound to the db session of the leader
+#
+# max_waiters: when that many requests are already waiting on a key,
+# the next ones compute the result by themselves instead of waiting,
+# so a slow leader can't hold an unlimited number of requests
+# !important: a waiter blocks a thread of the threadpool while it waits (40 threads by default),
+# so keep max_waiters well below the threadpool size, or 1 slow key takes all the threads
+#
+# only for sync endpoints: an async read that awaits I/O would need its own version, with the leader's work
+# shielded from its cancellation, there is none in this project for now
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # for sync endpoints (def), they run in the threadpool
+    # the default: a quarter of the default threadpool of anyio (40 threads)
+    def __init__(self, max_waiters: int = 10):
+        self.max_waiters = max_waiters
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "shared": 0, "bypassed": 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+                self.stats["leaders"] += 1
+            elif call.waiters >= self.max_waiters:
+                self.stats["bypassed"] += 1
+                call = None
+                leader = False
+            else:
+                call.waiters += 1
+                leader = False
+                self.stats["shared"] += 1
+
+        if call is None:
+            return fn()
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                # remove the key first, so a request that arrives after this gets fresh data
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
@@ -1,36 +1,327 @@
+import heapq
+from itertools import islice
+from typing import FrozenSet, Union
+
+from sqlalchemy import delete, func, insert, select, update
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
 
 from . import models, schemas
+from .database import LazySession, shard_count, shard_for, shard_session
+from .fields import load_fields
+
+# the functions that take "db" find the shards by themselves (check the shards in database.py):
+# - get_user, create_user, create_user_item, get_items(owner_id=...), update_user: the shard of the user
+# - update_item: the shard of the item, it's in its id (check create_user_item)
+# - get_user_by_email, create_user: the global index of the users on shard 0
+# - get_users, get_items, get_user_item_summaries, get_count: all the shards, the results are merged
+# db is a LazySession, or a plain Session for a db with 1 shard
+#
+# fields: only load these columns and relationships (a sparse fieldset, check fields.py), None is every column
+#
+# increment_counter, reconcile_counters, update_user_item_summary and rebuild_user_item_summary
+# work on the Session of 1 shard
+
+
+def _user_shard(db: Union[LazySession, Session], user_id: int) -> Session:
+    return shard_session(db, shard_for(user_id, shard_count(db)))
+
 
+def _merge(db: Union[LazySession, Session], build_query, key, skip: int, limit: int):
+    # the page [skip, skip + limit) of the rows of all the shards, ordered by key (a column of the model)
+    # every shard returns its first skip + limit rows, so a deep page costs more with more shards
+    count = shard_count(db)
+    if count == 1:
+        return build_query(shard_session(db, 0)).order_by(key).offset(skip).limit(limit).all()
+    rows = [build_query(shard_session(db, index)).order_by(key).limit(skip + limit).all() for index in range(count)]
+    return list(islice(heapq.merge(*rows, key=lambda row: getattr(row, key.key)), skip, skip + limit))
 
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+
+def get_user(db: Session, user_id: int, fields: FrozenSet[str] = None):
+    query = load_fields(_user_shard(db, user_id).query(models.User), models.User, fields)
+    return query.filter(models.User.id == user_id).first()
 
 
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    if shard_count(db) == 1:
+        return db.query(models.User).filter(models.User.email == email).first()
+    # the global index gives the id of the user, then we read the user on its shard
+    user_id = shard_session(db, 0).query(models.UserIndex.id).filter(models.UserIndex.email == email).scalar()
+    return get_user(db, user_id) if user_id is not None else None
+
+
+def get_users(db: Session, skip: int = 0, limit: int = 100, fields: FrozenSet[str] = None):
+    return _merge(db, lambda session: load_fields(session.query(models.User), models.User, fields),
+                  models.User.id, skip, limit)
+
+
+def owner_counter(owner_id: int) -> str:
+    return f"items:owner:{owner_id}"
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+def get_count(db: Session, name: str, user_id: int = None) -> int:
+    # the sum of the counter on all the shards
+    # user_id: the counter is only on the shard of this user, ex: owner_counter(user_id)
+    if user_id is not None:
+        sessions = [_user_shard(db, user_id)]
+    else:
+        sessions = [shard_session(db, index) for index in range(shard_count(db))]
+    return sum(
+        session.query(models.Counter.value).filter(models.Counter.name == name).scalar() or 0
+        for session in sessions
+    )
+
+
+def increment_counter(db: Session, name: str, delta: int = 1):
+    # it doesn't commit, so the counter is saved in the same transaction as the row it counts
+    updated = (
+        db.query(models.Counter)
+        .filter(models.Counter.name == name)
+        .update({models.Counter.value: models.Counter.value + delta}, synchronize_session=False)
+    )
+    if not updated:
+        db.add(models.Counter(name=name, value=delta))
+
+
+def reconcile_counters(db: Session) -> dict:
+    # count the rows for real, fix the counters that drifted (ex: rows inserted by hand)
+    # return the fixed counters as {name: (old value, new value)}
+    actual = {
+        "users": db.query(func.count(models.User.id)).scalar(),
+        "items": db.query(func.count(models.Item.id)).scalar(),
+    }
+    for owner_id, count in db.query(models.Item.owner_id, func.count(models.Item.id)).group_by(models.Item.owner_id):
+        actual[owner_counter(owner_id)] = count
+
+    stored = {counter.name: counter for counter in db.query(models.Counter)}
+    fixed = {}
+    for name, value in actual.items():
+        counter = stored.pop(name, None)
+        if counter is None:
+            db.add(models.Counter(name=name, value=value))
+            fixed[name] = (None, value)
+        elif counter.value != value:
+            fixed[name] = (counter.value, value)
+            counter.value = value
+    # counters of owners that have no item anymore
+    for name, counter in stored.items():
+        if name.startswith("items:owner:") and counter.value != 0:
+            fixed[name] = (counter.value, 0)
+            counter.value = 0
+    db.commit()
+    return fixed
 
 
 def create_user(db: Session, user: schemas.UserCreate):
     fake_hashed_password = user.password + "notreallyhashed"
-    db_user = models.User(email=user.email, hashed_password=fake_hashed_password)
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    # the global index gives the id of the user, and checks that the email is unique on all the shards
+    index_db = shard_session(db, 0)
+    index = models.UserIndex(email=user.email)
+    try:
+        index_db.add(index)
+        index_db.flush()
+    except Exception:
+        # ex: the email was taken since the check of the endpoint, the session must be usable again
+        index_db.rollback()
+        raise
+    user_db = _user_shard(db, index.id)
+    if user_db is not index_db:
+        # the user is on another shard, commit the index first, so the email is taken before the user exists
+        index_db.commit()
+    try:
+        db_user = models.User(id=index.id, email=user.email, hashed_password=fake_hashed_password)
+        user_db.add(db_user)
+        increment_counter(user_db, "users")
+        # flush the user before its summary row
+        user_db.flush()
+        user_db.add(models.UserItemSummary(user_id=db_user.id, item_count=0))
+        user_db.commit()
+    except Exception:
+        user_db.rollback()
+        if user_db is not index_db:
+            # the user wasn't added, give its email back
+            index_db.query(models.UserIndex).filter(models.UserIndex.id == index.id).delete()
+            index_db.commit()
+        raise
+    user_db.refresh(db_user)
     return db_user
 
 
-def get_items(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Item).offset(skip).limit(limit).all()
+def get_items(db: Session, skip: int = 0, limit: int = 100, owner_id: int = None, fields: FrozenSet[str] = None):
+    if owner_id is not None:
+        # the items of a user are on the shard of the user
+        return (
+            load_fields(_user_shard(db, owner_id).query(models.Item), models.Item, fields)
+            .filter(models.Item.owner_id == owner_id)
+            .order_by(models.Item.id)
+            .offset(skip)
+            .limit(limit)
+            .all()
+        )
+    return _merge(db, lambda session: load_fields(session.query(models.Item), models.Item, fields),
+                  models.Item.id, skip, limit)
 
 
 def create_user_item(db: Session, item: schemas.ItemCreate, user_id: int):
-    db_item = models.Item(**item.dict(), owner_id=user_id)
-    db.add(db_item)
-    db.commit()
-    db.refresh(db_item)
+    count = shard_count(db)
+    shard = shard_for(user_id, count)
+    item_db = shard_session(db, shard)
+    increment_counter(item_db, "items")
+    increment_counter(item_db, owner_counter(user_id))
+    item_id = None
+    if count > 1:
+        # the ids of the items of shard k are k, k + N, k + 2N, ... so they are unique on all the shards
+        # the counter update above holds the write lock of the shard, so MAX(id) can't change before our commit
+        item_db.flush()
+        max_id = item_db.query(func.max(models.Item.id)).scalar() or 0
+        item_id = (max_id // count + 1) * count + shard
+    db_item = models.Item(**item.dict(), owner_id=user_id, id=item_id)
+    item_db.add(db_item)
+    # flush to get the id of the new item, it's the latest item of the user
+    item_db.flush()
+    update_user_item_summary(item_db, db_item)
+    item_db.commit()
+    item_db.refresh(db_item)
     return db_item
+
+
+# PATCH: the changes are the fields the client sent, ex: schemas.ItemUpdate(...).dict(exclude_unset=True)
+# - the row is read, then only the fields whose value is different are set on it,
+#   so the ORM's UPDATE only has the columns that really changed (and none when nothing changed)
+# - version: the version the client read, the update fails right away when the row is at another version
+# - the UPDATE has "WHERE version = <the version we read>" (version_id_col in models.py),
+#   so when another request updated the row between our read and our write, nothing is written,
+#   we don't lock the row, the loser fails fast with VersionConflict and the client can read and retry
+class VersionConflict(Exception):
+    def __init__(self, current_version: int):
+        super().__init__(f"The row was changed, it's at version {current_version}")
+        self.current_version = current_version
+
+
+def _apply_changes(row, changes: dict, version: Union[int, None]) -> bool:
+    # True when some columns changed, the caller commits
+    if version is not None and version != row.version:
+        raise VersionConflict(row.version)
+    changed = False
+    for name, value in changes.items():
+        if getattr(row, name) != value:
+            setattr(row, name, value)
+            changed = True
+    return changed
+
+
+def _commit_versioned(db: Session, row):
+    try:
+        db.commit()
+    except StaleDataError:
+        db.rollback()
+        current = db.query(type(row).version).filter(type(row).id == row.id).scalar()
+        raise VersionConflict(current)
+
+
+def update_item(db: Session, item_id: int, changes: dict, version: int = None):
+    # the ids of the items of shard k are k, k + N, k + 2N, ... so the id gives the shard
+    item_db = _user_shard(db, item_id)
+    db_item = item_db.query(models.Item).filter(models.Item.id == item_id).first()
+    if db_item is None:
+        return None
+    if _apply_changes(db_item, changes, version):
+        if "title" in changes:
+            # the summary keeps the title of the latest item of the user
+            summary = models.UserItemSummary
+            item_db.query(summary).filter(
+                summary.user_id == db_item.owner_id, summary.latest_item_id == db_item.id
+            ).update({summary.latest_item_title: db_item.title}, synchronize_session=False)
+        _commit_versioned(item_db, db_item)
+    return db_item
+
+
+def update_user(db: Session, user_id: int, changes: dict, version: int = None):
+    user_db = _user_shard(db, user_id)
+    db_user = user_db.query(models.User).filter(models.User.id == user_id).first()
+    if db_user is None:
+        return None
+    changes = dict(changes)
+    if "password" in changes:
+        changes["hashed_password"] = changes.pop("password") + "notreallyhashed"
+    old_email = db_user.email
+    if not _apply_changes(db_user, changes, version):
+        return db_user
+    index_db = shard_session(db, 0)
+    email_changed = db_user.email != old_email
+    index_committed = False
+    try:
+        if email_changed:
+            # the global index keeps the emails unique on all the shards, like in create_user
+            index_db.query(models.UserIndex).filter(models.UserIndex.id == user_id).update(
+                {models.UserIndex.email: db_user.email}, synchronize_session=False
+            )
+            if user_db is not index_db:
+                index_db.commit()
+                index_committed = True
+        _commit_versioned(user_db, db_user)
+    except Exception:
+        user_db.rollback()
+        if index_committed:
+            # the user wasn't changed, give its old email back
+            index_db.query(models.UserIndex).filter(models.UserIndex.id == user_id).update(
+                {models.UserIndex.email: old_email}, synchronize_session=False
+            )
+            index_db.commit()
+        elif user_db is not index_db:
+            # ex: the email is taken, nothing was written
+            index_db.rollback()
+        raise
+    return db_user
+
+
+def update_user_item_summary(db: Session, db_item: models.Item):
+    # it doesn't commit, so the summary is saved in the same transaction as the item
+    summary = models.UserItemSummary
+    updated = (
+        db.query(summary)
+        .filter(summary.user_id == db_item.owner_id)
+        .update(
+            {
+                summary.item_count: summary.item_count + 1,
+                summary.latest_item_id: db_item.id,
+                summary.latest_item_title: db_item.title,
+            },
+            synchronize_session=False,
+        )
+    )
+    if not updated:
+        db.add(summary(user_id=db_item.owner_id, item_count=1,
+                       latest_item_id=db_item.id, latest_item_title=db_item.title))
+
+
+def get_user_item_summaries(db: Session, skip: int = 0, limit: int = 100, fields: FrozenSet[str] = None):
+    # the summary row of a user is on the shard of the user
+    summary = models.UserItemSummary
+    return _merge(db, lambda session: load_fields(session.query(summary), summary, fields),
+                  summary.user_id, skip, limit)
+
+
+def rebuild_user_item_summary(db: Session) -> int:
+    # rebuild the whole summary table from users and items, in one transaction
+    # return the number of rows
+    summary = models.UserItemSummary.__table__
+    users = models.User.__table__
+    items = models.Item.__table__
+    db.execute(delete(summary))
+    db.execute(
+        insert(summary).from_select(
+            ["user_id", "item_count", "latest_item_id"],
+            select(users.c.id, func.count(items.c.id), func.max(items.c.id))
+            .select_from(users.outerjoin(items, items.c.owner_id == users.c.id))
+            .group_by(users.c.id),
+        )
+    )
+    db.execute(
+        update(summary)
+        .where(summary.c.latest_item_id.isnot(None))
+        .values(latest_item_title=select(items.c.title).where(items.c.id == summary.c.latest_item_id)
+                .scalar_subquery())
+    )
+    db.commit()
+    return db.query(func.count(models.UserItemSummary.user_id)).scalar()
@@ -0,0 +1,314 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, List, Union
+
+import anyio.to_thread
+from sqlalchemy import event, func
+from sqlalchemy.orm import sessionmaker
+
+from . import models, schemas
+from .database import shard_for, shard_sessions
+from .fields import dump_fields, load_fields
+
+# Change feed of sql_app: the new users and items are pushed to the clients with server-sent events (SSE)
+# so the clients don't need to poll GET /items/ every few seconds
+#
+# in the browser:
+#   const feed = new EventSource("/feed/")
+#   feed.addEventListener("item", (e) => console.log(JSON.parse(e.data)))
+#
+# how it works, in every worker:
+# - 1 poller reads the new rows of every shard (WHERE id > the last id seen), it's 1 cheap query per shard,
+#   whatever the number of clients. it also sees the rows written by the other workers
+# - a commit in this worker (crud.create_user, crud.create_user_item) wakes the poller up right away,
+#   so the local writes don't wait for the poll interval
+# - every event is encoded once, then the same bytes are given to all the subscribers
+#
+# resume: the "id:" of an event is the position in the feed (the last item/user id seen on every shard)
+# after a disconnect, EventSource sends it back in the Last-Event-ID header, and we send the missed events
+# from a ring buffer of the last events. when they are not in the buffer anymore, the client gets a "reset" event,
+# then it should reload the lists (GET /items/) and reconnect without Last-Event-ID
+#
+# slow clients: every subscriber has a bounded queue, when it's full, the subscriber stops receiving from it,
+# and catches up from the ring buffer when it has read its queue (or gets "reset" if it's too late)
+#
+# users with several shards: the id of a user is taken (and committed) on the global index of shard 0 first,
+# then the user is committed on its own shard (check crud.create_user), so 2 users of a shard can be committed
+# out of id order, and "id > the last id seen" would skip the lower one forever
+# so the users of a shard are only sent up to the first id that is in the index but not on the shard yet,
+# the next ones wait for the next poll. a gap older than SQL_APP_FEED_SETTLE_SECONDS is given up
+# (ex: the worker died between the 2 commits), that user is not sent if it's committed later
+# the items don't need it: their id is taken under the write lock of their shard (check crud.create_user_item)
+#
+# config by env:
+# SQL_APP_FEED_POLL_INTERVAL: seconds between 2 polls of the db, default is 1
+# SQL_APP_FEED_BUFFER: the events kept for resume, default is 10000
+# SQL_APP_FEED_QUEUE_SIZE: the batches of events waiting for 1 subscriber, default is 100
+# SQL_APP_FEED_SETTLE_SECONDS: how long the users of a shard wait for a missing lower id, default is 30
+
+SQL_APP_FEED_POLL_INTERVAL = float(os.getenv("SQL_APP_FEED_POLL_INTERVAL", "1"))
+SQL_APP_FEED_BUFFER = int(os.getenv("SQL_APP_FEED_BUFFER", "10000"))
+SQL_APP_FEED_QUEUE_SIZE = int(os.getenv("SQL_APP_FEED_QUEUE_SIZE", "100"))
+SQL_APP_FEED_SETTLE_SECONDS = float(os.getenv("SQL_APP_FEED_SETTLE_SECONDS", "30"))
+HEARTBEAT_SECONDS = 15
+
+logger = logging.getLogger("sql_app.feed")
+
+USER_FIELDS = frozenset({"id", "email", "is_active"})
+
+# the sources of the feed: the event name, the model, and the prefix of its position ("i0" = items of shard 0)
+SOURCES = [
+    ("user", models.User, "u"),
+    ("item", models.Item, "i"),
+]
+
+
+def encode_position(position: Dict[str, int]) -> str:
+    # {"i0": 12, "u0": 4} => "i0=12,u0=4"
+    return ",".join(f"{key}={value}" for key, value in sorted(position.items()))
+
+
+def decode_position(value: str) -> Dict[str, int]:
+    # raises ValueError for a broken value
+    position = {}
+    for part in value.split(","):
+        key, _, number = part.partition("=")
+        position[key.strip()] = int(number)
+    return position
+
+
+class Event:
+    __slots__ = ("key", "id", "message")
+
+    def __init__(self, key: str, id: int, message: bytes):
+        self.key = key
+        self.id = id
+        self.message = message
+
+
+class Subscriber:
+    def __init__(self, position: Union[Dict[str, int], None], queue_size: int):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        # the last event sent to this subscriber, None when Last-Event-ID was broken
+        self.position = position
+        self.lagged = False
+
+
+class ChangeFeed:
+    def __init__(self, factories: List[sessionmaker] = None, poll_interval: float = SQL_APP_FEED_POLL_INTERVAL,
+                 buffer_size: int = SQL_APP_FEED_BUFFER, queue_size: int = SQL_APP_FEED_QUEUE_SIZE,
+                 batch: int = 500, settle_seconds: float = SQL_APP_FEED_SETTLE_SECONDS):
+        self.factories = factories or shard_sessions
+        self.settle_seconds = settle_seconds
+        # user id -> when the poller first saw it missing, check _settled_users()
+        self._gaps: Dict[int, float] = {}
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.batch = batch
+        self.position: Dict[str, int] = {}
+        self.buffer = deque()
+        self.buffer_size = buffer_size
+        # the highest id that is NOT in the buffer anymore (or that was never in it), per position key
+        self.floor: Dict[str, int] = {}
+        self.subscribers = set()
+        self.stats = {"polls": 0, "events": 0, "lagged": 0, "resets": 0}
+        self._loop = None
+        self._wake = None
+        self._task = None
+        # the same object for every event.listen(), so it's only added once to a factory
+        self._listener = self._after_commit
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self.position = await anyio.to_thread.run_sync(self._current_position)
+        self.floor = dict(self.position)
+        for factory in self.factories:
+            if not event.contains(factory, "after_commit", self._listener):
+                event.listen(factory, "after_commit", self._listener)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # the listeners stay on the factories, they do nothing once the loop is gone
+        # (event.remove() doesn't work well with a listener on several sessionmakers)
+        self._loop = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _after_commit(self, session):
+        # runs in the thread of the request, after a commit of this worker
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._wake.set)
+            except RuntimeError:
+                # the event loop is closed
+                pass
+
+    def _current_position(self) -> Dict[str, int]:
+        position = {}
+        for shard, factory in enumerate(self.factories):
+            with factory() as db:
+                for _, model, prefix in SOURCES:
+                    position[f"{prefix}{shard}"] = db.query(func.max(model.id)).scalar() or 0
+        return position
+
+    def _poll(self) -> List[Event]:
+        # runs in the threadpool, the new rows of every shard, in id order per shard
+        events = []
+        position = dict(self.position)
+        for shard, factory in enumerate(self.factories):
+            with factory() as db:
+                for name, model, prefix in SOURCES:
+                    key = f"{prefix}{shard}"
+                    query = db.query(model)
+                    if model is models.User:
+                        query = load_fields(query, model, USER_FIELDS)
+                    rows = query.filter(model.id > position.get(key, 0)).order_by(model.id).limit(self.batch).all()
+                    if model is models.User and len(self.factories) > 1 and rows:
+                        rows = self._settled_users(shard, position.get(key, 0), rows)
+                    for row in rows:
+                        if model is models.User:
+                            data = dump_fields(row, schemas.User, USER_FIELDS)
+                        else:
+                            data = schemas.Item.from_orm(row).dict()
+                        position[key] = row.id
+                        message = (f"id: {encode_position(position)}\nevent: {name}\n"
+                                   f"data: {json.dumps(data)}\n\n").encode()
+                        events.append(Event(key, row.id, message))
+        self.position = position
+        count = len(self.factories)
+        self._gaps = {id: seen for id, seen in self._gaps.items() if id > position.get(f"u{shard_for(id, count)}", 0)}
+        return events
+
+    def _settled_users(self, shard: int, after: int, rows: list) -> list:
+        # the rows up to the first id of this shard that is in the index but not committed on the shard yet
+        count = len(self.factories)
+        index = models.UserIndex
+        with self.factories[0]() as index_db:
+            ids = [id for (id,) in index_db.query(index.id).filter(
+                index.id > after, index.id <= rows[-1].id, index.id % count == shard
+            ).order_by(index.id)]
+        found = {row.id for row in rows}
+        now = time.monotonic()
+        for id in ids:
+            if id in found:
+                continue
+            if now - self._gaps.setdefault(id, now) < self.settle_seconds:
+                return [row for row in rows if row.id < id]
+        return rows
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                events = await anyio.to_thread.run_sync(self._poll)
+            except Exception:
+                logger.exception("feed poll failed")
+                continue
+            self.stats["polls"] += 1
+            if events:
+                self.publish(events)
+                if len(events) >= self.batch:
+                    # there are more rows, poll again right away
+                    self._wake.set()
+
+    def publish(self, events: List[Event]):
+        self.stats["events"] += len(events)
+        for e in events:
+            if len(self.buffer) >= self.buffer_size:
+                old = self.buffer.popleft()
+                self.floor[old.key] = max(self.floor.get(old.key, 0), old.id)
+            self.buffer.append(e)
+        # the same list goes to every subscriber, 1 put per subscriber per batch
+        for subscriber in self.subscribers:
+            if subscriber.lagged:
+                continue
+            try:
+                subscriber.queue.put_nowait(events)
+            except asyncio.QueueFull:
+                subscriber.lagged = True
+                self.stats["lagged"] += 1
+
+    def subscribe(self, last_event_id: str = None) -> Subscriber:
+        position = dict(self.position)
+        if last_event_id:
+            try:
+                position = decode_position(last_event_id)
+            except ValueError:
+                position = None
+        subscriber = Subscriber(position, self.queue_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def _catch_up(self, subscriber: Subscriber) -> Union[List[Event], None]:
+        # the events of the buffer that the subscriber didn't get, None when some of them are not in the buffer
+        position = subscriber.position
+        if position is None:
+            return None
+        for key, floor in self.floor.items():
+            if position.get(key, 0) < floor:
+                return None
+        return [e for e in self.buffer if e.id > position.get(e.key, 0)]
+
+    def _send(self, subscriber: Subscriber, events: List[Event]) -> List[bytes]:
+        # skip the events the subscriber already got, ex: from the catch up
+        messages = []
+        position = subscriber.position
+        for e in events:
+            if e.id > position.get(e.key, 0):
+                position[e.key] = e.id
+                messages.append(e.message)
+        return messages
+
+    async def stream(self, subscriber: Subscriber) -> AsyncIterator[bytes]:
+        try:
+            # tell EventSource to wait 1s before it reconnects
+            yield b"retry: 1000\n\n"
+            pending = self._catch_up(subscriber)
+            while True:
+                if pending is None:
+                    self.stats["resets"] += 1
+                    yield b'event: reset\ndata: {"reason": "missed events, reload the lists"}\n\n'
+                    return
+                if pending:
+                    yield b"".join(self._send(subscriber, pending))
+                try:
+                    events = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # a comment line, it keeps the proxies from closing an idle connection
+                    yield b": keepalive\n\n"
+                    pending = []
+                    continue
+                pending = events
+                if subscriber.lagged and subscriber.queue.empty():
+                    # the queue was full and we dropped some batches, take them from the buffer instead
+                    subscriber.lagged = False
+                    caught_up = self._catch_up(subscriber)
+                    pending = None if caught_up is None else events + caught_up
+        finally:
+            self.unsubscribe(subscriber)
+
+    def snapshot(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "position": encode_position(self.position),
+            "buffered_events": len(self.buffer),
+            **self.stats,
+        }
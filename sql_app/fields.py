@@ -0,0 +1,67 @@
+from typing import FrozenSet, List, Type, Union
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+from sqlalchemy import inspect
+from sqlalchemy.orm import Query, load_only, noload, selectinload
+
+# Sparse fieldsets: the client asks only for the fields it needs, ex: GET /users/?fields=id,email
+#
+# without "fields", the endpoints return every field of the schema, as before
+# with "fields":
+# - the SELECT only loads these columns (and the primary key), check load_fields()
+# - a relationship (ex: User.items) is only loaded when it's asked for, with 1 query for the whole page
+# - the response only has these fields, check dump_fields()
+# so the db reads less, we build smaller objects, and we send a smaller body
+
+
+def parse_fields(fields: Union[str, None], schema: Type[BaseModel]) -> Union[FrozenSet[str], None]:
+    # "id,email" => frozenset({"id", "email"}), None when the client didn't ask for a fieldset
+    if fields is None:
+        return None
+    names = frozenset(name.strip() for name in fields.split(",") if name.strip())
+    unknown = names - set(schema.__fields__)
+    if unknown or not names:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}, use some of: {', '.join(schema.__fields__)}"
+            if unknown else "fields is empty",
+        )
+    return names
+
+
+def load_fields(query: Query, model, fields: Union[FrozenSet[str], None]) -> Query:
+    if fields is None:
+        return query
+    mapper = inspect(model)
+    # the primary key is always loaded, the ORM needs it for the identity of the objects
+    columns = {column.key for column in mapper.column_attrs if column.key in fields}
+    columns.update(mapper.get_property_by_column(column).key for column in mapper.primary_key)
+    options = [load_only(*columns)]
+    for relationship in mapper.relationships:
+        attribute = getattr(model, relationship.key)
+        options.append(selectinload(attribute) if relationship.key in fields else noload(attribute))
+    return query.options(*options)
+
+
+def dump_fields(obj, schema: Type[BaseModel], fields: FrozenSet[str]) -> dict:
+    # only the asked fields of an ORM object, the nested models (ex: items) are converted by their schema
+    result = {}
+    for name, field in schema.__fields__.items():
+        if name not in fields:
+            continue
+        value = getattr(obj, name)
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            if isinstance(value, list):
+                value = [field.type_.from_orm(item).dict() for item in value]
+            elif value is not None:
+                value = field.type_.from_orm(value).dict()
+        result[name] = value
+    return result
+
+
+def serialize(rows: List, schema: Type[BaseModel], fields: Union[FrozenSet[str], None]) -> List:
+    # the whole schema (pydantic models) without a fieldset, only the asked fields (dicts) with one
+    if fields is None:
+        return [schema.from_orm(row) for row in rows]
+    return [dump_fields(row, schema, fields) for row in rows]
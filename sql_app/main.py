@@ -1,19 +1,117 @@
-from typing import List
+import os
+import secrets
+from typing import List, Union
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from . import crud, models, schemas
-from .database import SessionLocal, engine
+import memprof
+from batch import add_batch_route
+from idempotency import IdempotencyMiddleware
+from singleflight import SingleFlight
+
+from . import crud, schema, schemas
+from .database import LazySession, engine, pool_stats, slow_query_log
+from .feed import ChangeFeed
+from .fields import dump_fields, parse_fields, serialize
+from .slowlog import RouteMiddleware
+from .threadpool import ThreadPool
+
+# the db schema is NOT created on import anymore, create it once by: python -m sql_app.schema
+# at startup, we only check that the db is at the version this code needs
+# set SQL_APP_AUTO_MIGRATE=1 to create/upgrade the schema at startup instead, it's handy for a local dev db
+SQL_APP_AUTO_MIGRATE = os.getenv("SQL_APP_AUTO_MIGRATE", "0") == "1"
+
+# the /admin/ routes show the queries, the pool and the feed of the worker, and can clear the slow query log
+# they need the header "X-Admin-Token: <SQL_APP_ADMIN_TOKEN>", when SQL_APP_ADMIN_TOKEN is not set they are all refused
+SQL_APP_ADMIN_TOKEN = os.getenv("SQL_APP_ADMIN_TOKEN", "")
+
+
+# the shared dependency of the /admin/ routes
+async def verify_admin_token(x_admin_token: Union[str, None] = Header(default=None)):
+    # compare_digest: the time of the check doesn't tell how much of the token is right
+    if not SQL_APP_ADMIN_TOKEN or not secrets.compare_digest(x_admin_token or "", SQL_APP_ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid X-Admin-Token header")
+
+
+ADMIN = [Depends(verify_admin_token)]
 
-models.Base.metadata.create_all(bind=engine)
 
 app = FastAPI()
+# remember the route of every request, for the slow query log
+app.add_middleware(RouteMiddleware)
+# the retries of the POST with the same Idempotency-Key header get the first response back,
+# so a retry never creates a second user or item, check idempotency.py
+app.add_middleware(IdempotencyMiddleware, paths=[r"/users/", r"/users/\d+/items/"])
+
+# RSS, gc stats and, with MEMPROF=1, the allocations by line and by route at /admin/memory, check memprof.py
+# the routes are only there with MEMPROF=1 or MEMPROF_ADMIN=1, behind the admin token like the other /admin/ routes
+memprof.install(app, dependencies=ADMIN)
+
+# the sync endpoints run in the threadpool, its size and the limits per route come from the env
+# check threadpool.py, the wait for a thread is measured at GET /admin/threadpool
+threadpool = ThreadPool()
+
+# concurrent identical reads share one query, check singleflight.py
+# the routes that use it return pydantic models, so the result never holds the db session of another request
+# every waiter holds a thread of the pool while it waits, so the waiters of 1 key are at most a quarter of the pool
+# (SQL_APP_SINGLE_FLIGHT_MAX_WAITERS can change it, it's always kept below the pool size)
+SQL_APP_SINGLE_FLIGHT_MAX_WAITERS = min(
+    int(os.getenv("SQL_APP_SINGLE_FLIGHT_MAX_WAITERS", str(max(1, threadpool.size // 4)))),
+    max(1, threadpool.size - 2),
+)
+flight = SingleFlight(max_waiters=SQL_APP_SINGLE_FLIGHT_MAX_WAITERS)
+
+# the new users and items are pushed to the clients at GET /feed/, check feed.py
+feed = ChangeFeed()
+
+
+# ?fields=id,email returns only these fields, and only loads them from the db, check fields.py
+# the response is not validated by response_model then, it has only a part of the fields
+FIELDS = Query(default=None, description="Comma separated fields to return, ex: id,email. Default is all fields")
+
+
+@app.on_event("startup")
+async def configure_threadpool():
+    threadpool.configure()
+
+
+@app.on_event("startup")
+def check_schema():
+    # every shard, check database.py
+    if SQL_APP_AUTO_MIGRATE:
+        schema.migrate_all()
+    schema.check_all()
+
+
+# after check_schema(), the feed reads the tables
+@app.on_event("startup")
+async def start_feed():
+    await feed.start()
+
+
+@app.on_event("shutdown")
+async def stop_feed():
+    await feed.stop()
 
 
 # Dependency
-def get_db():
-    db = SessionLocal()
+# LazySession only takes a db connection on the first query, check database.py
+# the endpoints call db.release() as soon as their db work is done
+def get_db(request: Request):
+    # a sub-request of POST /batch/ uses the db of its batch slot, check batch_lane()
+    if "db" in request.scope.get("state", {}):
+        db = request.state.db
+        try:
+            yield db
+        finally:
+            # the next sub-requests of the slot get a clean session, even after a failure
+            # (ex: an IntegrityError leaves a transaction that must be rolled back), close() rolls it back
+            db.close()
+        return
+    db = LazySession()
     try:
         yield db
     finally:
@@ -21,35 +119,223 @@ def get_db():
 
 
 @app.post("/users/", response_model=schemas.User)
+@threadpool.instrument
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     db_user = crud.get_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+    try:
+        db_user = schemas.User.from_orm(crud.create_user(db=db, user=user))
+    except IntegrityError:
+        # another request took the email after our check
+        raise HTTPException(status_code=400, detail="Email already registered")
+    db.release()
+    return db_user
 
 
+# X-Total-Count header is the total number of rows, for the pager of the client
+# it's read from a counter that crud keeps up to date, so we don't run a COUNT(*) on every request
 @app.get("/users/", response_model=List[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
+@threadpool.instrument
+def read_users(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    fields: Union[str, None] = FIELDS,
+    db: Session = Depends(get_db),
+):
+    selected = parse_fields(fields, schemas.User)
+
+    def load():
+        users = crud.get_users(db, skip=skip, limit=limit, fields=selected)
+        return serialize(users, schemas.User, selected), crud.get_count(db, "users")
+
+    users, total = flight.do(("read_users", skip, limit, selected), load)
+    db.release()
+    if selected is not None:
+        return JSONResponse(users, headers={"X-Total-Count": str(total)})
+    response.headers["X-Total-Count"] = str(total)
     return users
 
 
+# items per user and the latest item of each user, for the dashboards
+# it reads the summary table that crud keeps up to date, instead of loading the items of every user
+@app.get("/users/summary/", response_model=List[schemas.UserItemSummary])
+@threadpool.instrument
+def read_user_item_summaries(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    fields: Union[str, None] = FIELDS,
+    db: Session = Depends(get_db),
+):
+    selected = parse_fields(fields, schemas.UserItemSummary)
+
+    def load():
+        summaries = crud.get_user_item_summaries(db, skip=skip, limit=limit, fields=selected)
+        return serialize(summaries, schemas.UserItemSummary, selected), crud.get_count(db, "users")
+
+    summaries, total = flight.do(("read_user_item_summaries", skip, limit, selected), load)
+    db.release()
+    if selected is not None:
+        return JSONResponse(summaries, headers={"X-Total-Count": str(total)})
+    response.headers["X-Total-Count"] = str(total)
+    return summaries
+
+
 @app.get("/users/{user_id}", response_model=schemas.User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+@threadpool.instrument
+def read_user(user_id: int, fields: Union[str, None] = FIELDS, db: Session = Depends(get_db)):
+    selected = parse_fields(fields, schemas.User)
+
+    def load():
+        db_user = crud.get_user(db, user_id=user_id, fields=selected)
+        if db_user is None:
+            return None
+        return schemas.User.from_orm(db_user) if selected is None else dump_fields(db_user, schemas.User, selected)
+
+    db_user = flight.do(("read_user", user_id, selected), load)
+    db.release()
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
+    if selected is not None:
+        return JSONResponse(db_user)
     return db_user
 
 
+# PATCH: only the fields the client sent are validated, and the UPDATE only has the columns that changed
+# send the "version" you read to not overwrite the change of another client: 409 when the row changed since then
+# the row is never locked, so the loser fails fast, reads the row again and retries (check crud.update_item)
+@app.patch("/users/{user_id}", response_model=schemas.User)
+@threadpool.instrument
+def update_user(user_id: int, user: schemas.UserUpdate, db: Session = Depends(get_db)):
+    changes = user.dict(exclude_unset=True, exclude={"version"})
+    if "email" in changes:
+        db_other = crud.get_user_by_email(db, email=changes["email"])
+        if db_other and db_other.id != user_id:
+            raise HTTPException(status_code=400, detail="Email already registered")
+    try:
+        db_user = crud.update_user(db, user_id=user_id, changes=changes, version=user.version)
+    except crud.VersionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except IntegrityError:
+        # another request took the email after our check
+        raise HTTPException(status_code=400, detail="Email already registered")
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    db_user = schemas.User.from_orm(db_user)
+    db.release()
+    return db_user
+
+
+@app.patch("/items/{item_id}", response_model=schemas.Item)
+@threadpool.instrument
+def update_item(item_id: int, item: schemas.ItemUpdate, db: Session = Depends(get_db)):
+    changes = item.dict(exclude_unset=True, exclude={"version"})
+    try:
+        db_item = crud.update_item(db, item_id=item_id, changes=changes, version=item.version)
+    except crud.VersionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if db_item is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    db_item = schemas.Item.from_orm(db_item)
+    db.release()
+    return db_item
+
+
 @app.post("/users/{user_id}/items/", response_model=schemas.Item)
+@threadpool.instrument
 def create_item_for_user(
     user_id: int, item: schemas.ItemCreate, db: Session = Depends(get_db)
 ):
-    return crud.create_user_item(db=db, item=item, user_id=user_id)
+    db_item = schemas.Item.from_orm(crud.create_user_item(db=db, item=item, user_id=user_id))
+    db.release()
+    return db_item
 
 
 @app.get("/items/", response_model=List[schemas.Item])
-def read_items(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    items = crud.get_items(db, skip=skip, limit=limit)
+@threadpool.instrument
+def read_items(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    owner_id: Union[int, None] = None,
+    fields: Union[str, None] = FIELDS,
+    db: Session = Depends(get_db),
+):
+    selected = parse_fields(fields, schemas.Item)
+
+    def load():
+        items = crud.get_items(db, skip=skip, limit=limit, owner_id=owner_id, fields=selected)
+        if owner_id is None:
+            total = crud.get_count(db, "items")
+        else:
+            total = crud.get_count(db, crud.owner_counter(owner_id), user_id=owner_id)
+        return serialize(items, schemas.Item, selected), total
+
+    items, total = flight.do(("read_items", skip, limit, owner_id, selected), load)
+    db.release()
+    if selected is not None:
+        return JSONResponse(items, headers={"X-Total-Count": str(total)})
+    response.headers["X-Total-Count"] = str(total)
     return items
+
+
+# the slow queries of this worker, the newest first, check slowlog.py
+@app.get("/admin/slow-queries", dependencies=ADMIN)
+def read_slow_queries():
+    return slow_query_log.snapshot()
+
+
+@app.delete("/admin/slow-queries", dependencies=ADMIN)
+def clear_slow_queries():
+    slow_query_log.clear()
+    return {"cleared": True}
+
+
+# connection pool checkout metrics of this worker, check poolstats.py
+@app.get("/admin/pool", dependencies=ADMIN)
+def read_pool_stats():
+    return pool_stats.snapshot(engine.pool)
+
+
+# threadpool saturation metrics of this worker, check threadpool.py
+# async, so it answers right away even when all the threads are busy
+@app.get("/admin/threadpool", dependencies=ADMIN)
+async def read_threadpool_stats():
+    return threadpool.snapshot()
+
+
+# server-sent events: "user" and "item" events, for the users and items created from now on
+# after a disconnect, EventSource sends the id of the last event it got in Last-Event-ID,
+# and the feed sends the missed events, check feed.py
+@app.get("/feed/")
+async def read_feed(last_event_id: Union[str, None] = Header(default=None)):
+    subscriber = feed.subscribe(last_event_id)
+    return StreamingResponse(
+        feed.stream(subscriber),
+        media_type="text/event-stream",
+        # no cache, and no buffering by nginx, the events must reach the client right away
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# subscribers and events of the feed of this worker
+@app.get("/admin/feed", dependencies=ADMIN)
+async def read_feed_stats():
+    return feed.snapshot()
+
+
+# the shared resources of a slot of POST /batch/: the sub-requests that run one after the other on a slot
+# use the same LazySession, so a batch of 20 sub-requests creates at most BATCH_CONCURRENCY sessions
+def batch_lane():
+    db = LazySession()
+    try:
+        yield {"db": db}
+    finally:
+        db.close()
+
+
+# many small calls in 1 request: POST /batch/ {"requests": [{"path": "/users/1"}, {"path": "/items/?owner_id=1"}]}
+# check batch.py
+batch_dispatcher = add_batch_route(app, lane=batch_lane)
@@ -0,0 +1,42 @@
+import argparse
+
+from . import crud
+from .database import shard_sessions
+
+# Maintenance commands for the sql_app db, run from the project folder:
+# => python -m sql_app.maintenance reconcile-counters
+# => python -m sql_app.maintenance rebuild-summary
+#
+# run them from a cron job, ex: every night
+# the counters and the summary are kept per shard (check database.py), the commands run on every shard
+
+
+def reconcile_counters():
+    # the counters are kept up to date by crud, but a row inserted or deleted by hand makes them drift
+    for shard, session_factory in enumerate(shard_sessions):
+        with session_factory() as db:
+            fixed = crud.reconcile_counters(db)
+        for name, (old, new) in sorted(fixed.items()):
+            print(f"shard {shard}: {name}: {old} -> {new}")
+        print(f"shard {shard}: {len(fixed)} counter(s) fixed")
+
+
+def rebuild_summary():
+    # the summary is kept up to date by crud, rebuild it after the items were changed by hand
+    for shard, session_factory in enumerate(shard_sessions):
+        with session_factory() as db:
+            rows = crud.rebuild_user_item_summary(db)
+        print(f"shard {shard}: user item summary rebuilt, {rows} user(s)")
+
+
+COMMANDS = {
+    "reconcile-counters": reconcile_counters,
+    "rebuild-summary": rebuild_summary,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sql_app maintenance commands")
+    parser.add_argument("command", choices=list(COMMANDS))
+    args = parser.parse_args()
+    COMMANDS[args.command]()
@@ -11,10 +11,17 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
+    # optimistic concurrency: every UPDATE of the ORM checks the version it read, and bumps it
+    # UPDATE users SET email=?, version=? WHERE users.id = ? AND users.version = ?
+    # when another request changed the row since we read it, no row is updated and the ORM raises StaleDataError
+    # check crud.update_user
+    version = Column(Integer, nullable=False, server_default="1")
 
     # relation
     items = relationship("Item", back_populates="owner")
 
+    __mapper_args__ = {"version_id_col": version}
+
 
 class Item(Base):
     __tablename__ = "items"
@@ -22,7 +29,50 @@ class Item(Base):
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, index=True)
     description = Column(String, index=True)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    # optimistic concurrency like User.version, check crud.update_item
+    version = Column(Integer, nullable=False, server_default="1")
 
     # relation
     owner = relationship("User", back_populates="items")
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+# total counts for the listings, they are updated in the same transaction as the insert
+# so we don't need a COUNT(*) on every request
+# names: "users", "items", "items:owner:<user_id>"
+class Counter(Base):
+    __tablename__ = "counters"
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+
+# items per user and the latest item of each user, for the dashboards
+# it's updated by crud when a user or an item is created, so we don't need to load User.items of every user
+# rebuild it from the items table by: python -m sql_app.maintenance rebuild-summary
+class UserItemSummary(Base):
+    __tablename__ = "user_item_summary"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    item_count = Column(Integer, nullable=False, default=0)
+    latest_item_id = Column(Integer)
+    latest_item_title = Column(String)
+
+
+# the global index of the users, it's only used on shard 0 (check the shards in database.py)
+# it gives the id of a new user, so the ids are unique on all the shards,
+# and the unique email, so the same email can't be registered on 2 shards
+class UserIndex(Base):
+    __tablename__ = "user_index"
+
+    id = Column(Integer, primary_key=True)
+    email = Column(String, unique=True, nullable=False)
+
+
+# the version of the db schema, check schema.py
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
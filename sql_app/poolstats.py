@@ -0,0 +1,81 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Connection pool metrics for sql_app, read them at GET /admin/pool
+#
+# - checkouts / checkins: how many times a connection was taken from / given back to the pool
+# - in_use / max_in_use: connections held by the requests right now, and the highest seen
+# - hold time: how long a connection was held, from checkout to checkin
+# - connects: new DBAPI connections opened (with sqlite, SQLAlchemy 1.4 uses NullPool, so it's 1 per checkout)
+# - sessions: LazySession objects created, and how many of them really used the db
+
+
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.in_use = 0
+            self.max_in_use = 0
+            self.hold_total = 0.0
+            self.hold_max = 0.0
+            self.sessions_created = 0
+            self.sessions_used = 0
+            self.sessions_released_early = 0
+
+    def incr(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def install(self, engine: Engine):
+        event.listen(engine, "connect", self._connect)
+        event.listen(engine, "checkout", self._checkout)
+        event.listen(engine, "checkin", self._checkin)
+
+    def _connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checkout_at"] = time.perf_counter()
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def _checkin(self, dbapi_connection, connection_record):
+        checkout_at = connection_record.info.pop("checkout_at", None)
+        if checkout_at is None:
+            return
+        held = time.perf_counter() - checkout_at
+        with self._lock:
+            self.checkins += 1
+            self.in_use -= 1
+            self.hold_total += held
+            self.hold_max = max(self.hold_max, held)
+
+    def snapshot(self, pool=None) -> dict:
+        with self._lock:
+            result = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "hold_avg_ms": self.hold_total / self.checkins * 1000 if self.checkins else 0,
+                "hold_max_ms": self.hold_max * 1000,
+                "sessions_created": self.sessions_created,
+                "sessions_used": self.sessions_used,
+                "sessions_released_early": self.sessions_released_early,
+            }
+        if pool is not None:
+            result["pool"] = pool.status()
+        return result
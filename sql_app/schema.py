@@ -0,0 +1,158 @@
+from typing import List
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from . import crud, models
+from .database import engine, engines
+
+# Schema management for the sql_app db
+#
+# before, main.py ran models.Base.metadata.create_all(bind=engine) on import
+# so every worker inspected every table on boot, and the workers raced each other on an empty db
+#
+# now the schema is created (and upgraded) ONCE by an explicit step, run from the project folder:
+# => python -m sql_app.schema
+# and the app only checks the version in the schema_version table at startup, it's a single SELECT
+#
+# when you change models.py, add a migration function to MIGRATIONS and bump SCHEMA_VERSION
+#
+# with shards (check database.py), every shard is a db with the same schema, the CLI migrates all of them
+
+
+def _create_tables(connection: Connection):
+    # checkfirst=True (default), so the tables of an old db (before schema_version existed) are kept
+    models.Base.metadata.create_all(bind=connection)
+
+
+def _add_counters(connection: Connection):
+    # the counters table, and an index for the "owner_id" filter of GET /items/
+    models.Counter.__table__.create(bind=connection, checkfirst=True)
+    for index in models.Item.__table__.indexes:
+        if index.name == "ix_items_owner_id":
+            index.create(bind=connection, checkfirst=True)
+    # fill the counters from the rows that already exist
+    with Session(bind=connection) as db:
+        crud.reconcile_counters(db)
+
+
+def _add_user_item_summary(connection: Connection):
+    models.UserItemSummary.__table__.create(bind=connection, checkfirst=True)
+    with Session(bind=connection) as db:
+        crud.rebuild_user_item_summary(db)
+
+
+def _add_user_index(connection: Connection):
+    # the global index of the users, the users that already exist keep their ids
+    # only shard 0 uses it, it stays empty on the other shards
+    models.UserIndex.__table__.create(bind=connection, checkfirst=True)
+    users = models.User.__table__
+    index = models.UserIndex.__table__
+    connection.execute(
+        index.insert().from_select(
+            ["id", "email"],
+            select(users.c.id, users.c.email)
+            .where(users.c.email.isnot(None))
+            .where(users.c.id.notin_(select(index.c.id))),
+        )
+    )
+
+
+def _add_versions(connection: Connection):
+    # the version column of users and items, for the optimistic concurrency of PATCH (check crud.update_item)
+    # a new db already has it, _create_tables() creates the tables of models.py as they are now
+    for table in [models.User.__table__, models.Item.__table__]:
+        columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+        if "version" not in columns:
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+# version -> the function that upgrades the db from (version - 1) to version
+MIGRATIONS = {
+    1: _create_tables,
+    2: _add_counters,
+    3: _add_user_item_summary,
+    4: _add_user_index,
+    5: _add_versions,
+}
+
+SCHEMA_VERSION = max(MIGRATIONS)
+
+
+class SchemaVersionError(RuntimeError):
+    pass
+
+
+def _read_version(connection: Connection) -> int:
+    return connection.execute(select(func.max(models.SchemaVersion.version))).scalar() or 0
+
+
+def current_version(bind: Engine = engine) -> int:
+    # 0 means the db has no schema_version table yet (an empty db, or a db created before this file)
+    try:
+        with bind.connect() as connection:
+            return _read_version(connection)
+    except OperationalError:
+        return 0
+
+
+def _lock(connection: Connection):
+    # the workers that start together with SQL_APP_AUTO_MIGRATE=1 all call migrate()
+    # so the write lock is taken BEFORE the version is read: the first worker migrates,
+    # the others wait for its commit, then read the new version and have nothing to do
+    # pysqlite doesn't start a transaction before a SELECT or a CREATE TABLE by itself, so we do it,
+    # it also makes the DDL of a migration atomic, a failed migration leaves the db as it was
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def migrate(bind: Engine = engine) -> int:
+    if current_version(bind) == SCHEMA_VERSION:
+        # the usual case, no need to lock the db
+        return SCHEMA_VERSION
+    with bind.begin() as connection:
+        _lock(connection)
+        version = _read_version(connection) if inspect(connection).has_table("schema_version") else 0
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            MIGRATIONS[target](connection)
+            connection.execute(models.SchemaVersion.__table__.insert().values(version=target))
+    return SCHEMA_VERSION
+
+
+def check(bind: Engine = engine):
+    # the cheap check for the app startup
+    version = current_version(bind)
+    if version != SCHEMA_VERSION:
+        raise SchemaVersionError(
+            f"The db schema is at version {version}, but the app needs version {SCHEMA_VERSION}. "
+            f"Run: python -m sql_app.schema"
+        )
+
+
+def migrate_all(binds: List[Engine] = None):
+    for bind in binds or engines:
+        migrate(bind)
+
+
+def check_all(binds: List[Engine] = None):
+    for bind in binds or engines:
+        check(bind)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create or upgrade the sql_app db schema")
+    parser.add_argument("--check", action="store_true", help="only check the version, don't change the db")
+    args = parser.parse_args()
+
+    for shard, shard_engine in enumerate(engines):
+        if args.check:
+            check(shard_engine)
+            print(f"shard {shard}: schema is up to date (version {SCHEMA_VERSION})")
+        else:
+            before = current_version(shard_engine)
+            migrate(shard_engine)
+            print(f"shard {shard}: schema upgraded from version {before} to {SCHEMA_VERSION}")
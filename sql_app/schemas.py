@@ -1,6 +1,6 @@
 from typing import List, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 
 
 class ItemBase(BaseModel):
@@ -12,9 +12,27 @@ class ItemCreate(ItemBase):
     pass
 
 
+# PATCH: every field is optional, only the fields the client sends are validated and changed
+# a field that can't be null (ex: title) can be left out, but not sent as null
+def _not_null(value):
+    if value is None:
+        raise ValueError("can't be null")
+    return value
+
+
+class ItemUpdate(BaseModel):
+    title: Union[str, None] = None
+    description: Union[str, None] = None
+    # the version the client read, the update fails with 409 when the item changed since then
+    version: Union[int, None] = None
+
+    _title_not_null = validator("title", allow_reuse=True)(_not_null)
+
+
 class Item(ItemBase):
     id: int
     owner_id: int
+    version: int
 
     # use this orm_mode = True so it can return the data even if it is not a dict, but an ORM model
     class Config:
@@ -29,11 +47,32 @@ class UserCreate(UserBase):
     password: str
 
 
+class UserUpdate(BaseModel):
+    email: Union[str, None] = None
+    password: Union[str, None] = None
+    is_active: Union[bool, None] = None
+    # the version the client read, the update fails with 409 when the user changed since then
+    version: Union[int, None] = None
+
+    _fields_not_null = validator("email", "password", "is_active", allow_reuse=True)(_not_null)
+
+
 class User(UserBase):
     id: int
     is_active: bool
+    version: int
     items: List[Item] = []
 
     # use this orm_mode = True so it can return the data even if it is not a dict, but an ORM model
     class Config:
         orm_mode = True
+
+
+class UserItemSummary(BaseModel):
+    user_id: int
+    item_count: int
+    latest_item_id: Union[int, None] = None
+    latest_item_title: Union[str, None] = None
+
+    class Config:
+        orm_mode = True
@@ -0,0 +1,175 @@
+import functools
+import os
+import time
+from collections import deque
+from typing import Callable, Dict, Union
+
+import anyio
+import anyio.to_thread
+
+# Threadpool config and metrics for the sync endpoints of sql_app
+#
+# every sql_app endpoint is a sync "def", so FastAPI runs it in the anyio threadpool
+# the pool has 40 threads (tokens) by default, when they are all busy, the next requests wait for a thread
+# and nothing shows it, the requests are just slower
+#
+# with this module:
+# - the pool size is set at startup from the env
+# - a route can have its own limit, ex: at most 4 "create_user" at the same time,
+#   so a slow route can't take all the threads of the pool
+# - we measure how long a request waits for a thread, how many threads are busy and how many requests wait
+#   read them at GET /admin/threadpool
+#
+# use it on a sync endpoint, under the route decorator:
+#
+#   @app.get("/users/")
+#   @threadpool.instrument
+#   def read_users(...):
+#
+# config by env:
+# SQL_APP_THREADPOOL_SIZE: the threads of the pool, default is 40 (the anyio default)
+# SQL_APP_ROUTE_LIMITS: the limits per route, by the name of the endpoint function, ex: "create_user=4,read_items=8"
+
+SQL_APP_THREADPOOL_SIZE = int(os.getenv("SQL_APP_THREADPOOL_SIZE", "40"))
+SQL_APP_ROUTE_LIMITS = os.getenv("SQL_APP_ROUTE_LIMITS", "")
+
+
+def parse_limits(value: str) -> Dict[str, int]:
+    # "create_user=4, read_items=8" => {"create_user": 4, "read_items": 8}
+    limits = {}
+    for part in value.split(","):
+        if part.strip():
+            name, tokens = part.split("=")
+            limits[name.strip()] = int(tokens)
+    return limits
+
+
+class LimiterStats:
+    # the counters are only changed from the event loop, so they don't need a lock
+    def __init__(self, window: int = 1000):
+        self.acquired = 0
+        self.active = 0
+        self.max_active = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # the last waits, for the percentiles
+        self.waits = deque(maxlen=window)
+
+    def snapshot(self) -> dict:
+        waits = sorted(self.waits)
+
+        def percentile(p):
+            return waits[min(len(waits) - 1, int(p / 100 * len(waits)))] * 1000 if waits else 0
+
+        return {
+            "acquired": self.acquired,
+            "active": self.active,
+            "max_active": self.max_active,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "wait_avg_ms": self.wait_total / self.acquired * 1000 if self.acquired else 0,
+            "wait_p95_ms": percentile(95),
+            "wait_max_ms": self.wait_max * 1000,
+        }
+
+
+class _Instrumented:
+    # an "async with" wrapper around a CapacityLimiter that measures the wait for a token
+    # anyio.to_thread.run_sync() only does "async with limiter", so it accepts it as its limiter
+    def __init__(self, limiter: anyio.CapacityLimiter, stats: LimiterStats):
+        self.limiter = limiter
+        self.stats = stats
+
+    async def __aenter__(self):
+        stats = self.stats
+        start = time.perf_counter()
+        try:
+            self.limiter.acquire_nowait()
+        except anyio.WouldBlock:
+            # no free token, the request is queued
+            stats.queued += 1
+            stats.max_queued = max(stats.max_queued, stats.queued)
+            try:
+                await self.limiter.acquire()
+            finally:
+                stats.queued -= 1
+        wait = time.perf_counter() - start
+        stats.acquired += 1
+        stats.active += 1
+        stats.max_active = max(stats.max_active, stats.active)
+        stats.wait_total += wait
+        stats.wait_max = max(stats.wait_max, wait)
+        stats.waits.append(wait)
+
+    async def __aexit__(self, *exc_info):
+        self.limiter.release()
+        self.stats.active -= 1
+
+
+class ThreadPool:
+    def __init__(self, size: int = SQL_APP_THREADPOOL_SIZE, route_limits: Dict[str, int] = None):
+        self.size = size
+        self.route_limits = parse_limits(SQL_APP_ROUTE_LIMITS) if route_limits is None else route_limits
+        self.stats: Dict[str, LimiterStats] = {"pool": LimiterStats()}
+        self._route_limiters: Dict[str, anyio.CapacityLimiter] = {}
+        for name in self.route_limits:
+            self.stats[name] = LimiterStats()
+
+    def configure(self) -> anyio.CapacityLimiter:
+        # the default limiter of anyio belongs to the event loop, so this must run in the loop,
+        # ex: in a startup handler. the sync dependencies (get_db) use the same pool
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        if limiter.total_tokens != self.size:
+            limiter.total_tokens = self.size
+        return limiter
+
+    def _route_limiter(self, name: str) -> Union[anyio.CapacityLimiter, None]:
+        if name not in self.route_limits:
+            return None
+        limiter = self._route_limiters.get(name)
+        if limiter is None:
+            limiter = self._route_limiters[name] = anyio.CapacityLimiter(self.route_limits[name])
+        return limiter
+
+    async def run(self, name: str, func: Callable, *args, **kwargs):
+        # run func in the pool, after the limit of its route
+        # the request takes a route token first, so the requests over the route limit wait without taking a thread
+        call = functools.partial(func, *args, **kwargs)
+        pool = _Instrumented(self.configure(), self.stats["pool"])
+        route_limiter = self._route_limiter(name)
+        if route_limiter is None:
+            return await anyio.to_thread.run_sync(call, limiter=pool)
+        async with _Instrumented(route_limiter, self.stats[name]):
+            return await anyio.to_thread.run_sync(call, limiter=pool)
+
+    def instrument(self, func: Callable) -> Callable:
+        # FastAPI reads the parameters of the endpoint through functools.wraps (__wrapped__),
+        # and runs the wrapper in the event loop because it's async, the wrapper then sends func to the pool
+        name = func.__name__
+
+        @functools.wraps(func)
+        async def endpoint(*args, **kwargs):
+            return await self.run(name, func, *args, **kwargs)
+
+        return endpoint
+
+    def snapshot(self) -> dict:
+        # call it from the event loop (an async endpoint), so it doesn't wait for a thread itself
+        pool = self.configure()
+        statistics = pool.statistics()
+        return {
+            "size": self.size,
+            # all the work in the pool right now, also the sync dependencies and the other sync endpoints
+            "borrowed_tokens": statistics.borrowed_tokens,
+            "tasks_waiting": statistics.tasks_waiting,
+            "pool": self.stats["pool"].snapshot(),
+            "routes": {
+                name: {"limit": limit, **self.stats[name].snapshot()} for name, limit in self.route_limits.items()
+            },
+        }
+
+    def reset(self):
+        for name in self.stats:
+            self.stats[name] = LimiterStats()
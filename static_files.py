@@ -0,0 +1,239 @@
+import mimetypes
+import os
+import stat
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Tuple, Union
+
+import anyio
+import anyio.to_thread
+from fastapi import HTTPException, Request
+from starlette.responses import Response
+
+# Serve the files of a folder, for GET /files/{file_path:path} in main.py
+#
+# - safe path: "../", absolute paths and symlinks that point out of the root folder give 404
+# - conditional requests: ETag / If-None-Match and Last-Modified / If-Modified-Since give 304 Not Modified
+# - Range requests: "Range: bytes=0-99" gives 206 with only these bytes, ex: to resume a download
+# - the small hot files are kept in memory (LRU cache with a byte budget), so they cost no disk read
+# - the big files are sent with zero copy (sendfile) when the server supports the ASGI
+#   "http.response.zerocopysend" extension, else they are read in chunks in the threadpool
+#   (uvicorn doesn't have the extension, so it's the chunks there)
+#
+# config by env:
+# STATIC_FILES_ROOT: the folder of the files, default is "static"
+# STATIC_FILES_CACHE_BYTES: the memory budget of the cache, default is 16 MiB
+# STATIC_FILES_CACHE_MAX_FILE: the files bigger than this are never cached, default is 64 KiB
+# STATIC_FILES_CHUNK_SIZE: the size of the chunks of the big files, default is 1 MiB
+#
+# the cost of the chunks (python -m benchmarks.bench_static, 20 concurrent requests):
+# - with uvicorn, the chunks are as fast as reading the whole file: ~225 MB/s for both on big.bin (8 MiB)
+# - in process (httpx ASGITransport, no socket), every chunk is a trip to the threadpool and back to the event loop,
+#   that's the cost: big.bin ~600 MB/s against ~1900-2000 MB/s when the whole file is read at once
+#   (STATIC_FILES_CHUNK_SIZE=16777216 gets the same as the whole file, but then 1 request holds 8 MiB in memory)
+# - a body of 1 chunk or less (ex: medium.bin, 256 KiB, too big for the cache) is opened and read in 1 trip,
+#   ~400 MB/s against ~450 MB/s for the whole file read (it was ~345 MB/s with a trip to open and a trip to read)
+# zero copy needs the socket, that only the server has, so it's only there with "http.response.zerocopysend"
+
+STATIC_FILES_ROOT = os.getenv("STATIC_FILES_ROOT", "static")
+STATIC_FILES_CACHE_BYTES = int(os.getenv("STATIC_FILES_CACHE_BYTES", str(16 * 1024 * 1024)))
+STATIC_FILES_CACHE_MAX_FILE = int(os.getenv("STATIC_FILES_CACHE_MAX_FILE", str(64 * 1024)))
+
+# a big file holds at most 1 chunk in memory per request, bigger chunks are fewer trips to the threadpool
+CHUNK_SIZE = int(os.getenv("STATIC_FILES_CHUNK_SIZE", str(1024 * 1024)))
+
+
+class FileCache:
+    # path => (mtime_ns, size, content), the least recently used files are dropped when the budget is full
+    # it's only used from the event loop, so it doesn't need a lock
+    def __init__(self, max_bytes: int = STATIC_FILES_CACHE_BYTES, max_file_size: int = STATIC_FILES_CACHE_MAX_FILE):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[int, int, bytes]]" = OrderedDict()
+
+    def get(self, path: str, st: os.stat_result) -> Union[bytes, None]:
+        entry = self._entries.get(path)
+        # a file that changed on disk is a miss, the new content replaces it
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, path: str, st: os.stat_result, content: bytes):
+        if len(content) > self.max_file_size or len(content) > self.max_bytes:
+            return
+        old = self._entries.pop(path, None)
+        if old is not None:
+            self.bytes -= len(old[2])
+        self._entries[path] = (st.st_mtime_ns, st.st_size, content)
+        self.bytes += len(content)
+        while self.bytes > self.max_bytes:
+            _, (_, _, dropped) = self._entries.popitem(last=False)
+            self.bytes -= len(dropped)
+
+    def stats(self) -> dict:
+        return {"files": len(self._entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+
+def parse_range(header: str, size: int) -> Union[Tuple[int, int], None]:
+    # "bytes=0-99" => (0, 100), "bytes=100-" => (100, size), "bytes=-100" => (size - 100, size)
+    # returns None when the header can't be used, then the whole file is sent (allowed by the HTTP spec)
+    # raises ValueError when the range is out of the file, that is 416
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        # we only support 1 range, multiple ranges need a multipart response
+        return None
+    first, sep, last = ranges.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            start, end = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+def _read(path: str, start: int, end: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+class FileResponse(Response):
+    # sends bytes that are already in memory, or a part of a file on disk
+    def __init__(self, path: str, start: int, end: int, content: Union[bytes, None], status_code: int,
+                 headers: dict, head: bool = False):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.start = start
+        self.end = end
+        self.content = content
+        self.head = head
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.head or self.start == self.end:
+            await send({"type": "http.response.body", "body": b""})
+        elif self.content is not None:
+            await send({"type": "http.response.body", "body": self.content[self.start:self.end]})
+        elif "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f, "offset": self.start,
+                            "count": self.end - self.start})
+        else:
+            await self.send_chunks(send)
+
+    async def send_chunks(self, send):
+        if self.end - self.start <= CHUNK_SIZE:
+            # 1 chunk: open and read it in 1 trip to the threadpool
+            body = await anyio.to_thread.run_sync(_read, self.path, self.start, self.end)
+            await send({"type": "http.response.body", "body": body})
+            return
+        f = await anyio.to_thread.run_sync(open, self.path, "rb")
+        try:
+            position = self.start
+            while position < self.end:
+                chunk = await anyio.to_thread.run_sync(os.pread, f.fileno(),
+                                                       min(CHUNK_SIZE, self.end - position), position)
+                if not chunk:
+                    # the file was truncated while we send it, the client sees a short body
+                    break
+                position += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": position < self.end})
+            if position < self.end:
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            f.close()
+
+
+class FileServer:
+    def __init__(self, root: str = STATIC_FILES_ROOT, cache: FileCache = None):
+        self.root = os.path.realpath(root)
+        self.cache = cache if cache is not None else FileCache()
+
+    def resolve(self, file_path: str) -> str:
+        # the real path of the file, with the symlinks and ".." resolved, it must be inside the root folder
+        if "\x00" in file_path or os.path.isabs(file_path):
+            raise HTTPException(status_code=404, detail="File not found")
+        path = os.path.realpath(os.path.join(self.root, file_path))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise HTTPException(status_code=404, detail="File not found")
+        return path
+
+    async def response(self, file_path: str, request: Request) -> Response:
+        path = self.resolve(file_path)
+        # a stat is a few microseconds, we do it in the event loop, a thread would cost more than that
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise HTTPException(status_code=404, detail="File not found")
+        if not stat.S_ISREG(st.st_mode):
+            raise HTTPException(status_code=404, detail="File not found")
+
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "last-modified": last_modified,
+            "content-type": mimetypes.guess_type(path)[0] or "application/octet-stream",
+        }
+
+        if self.not_modified(request, etag, st.st_mtime):
+            del headers["content-type"]
+            return Response(status_code=304, headers=headers)
+
+        start, end, status_code = 0, st.st_size, 200
+        range_header = request.headers.get("range")
+        if range_header and self.if_range_matches(request, etag, last_modified):
+            try:
+                byte_range = parse_range(range_header, st.st_size)
+            except ValueError:
+                return Response(status_code=416, headers={"content-range": f"bytes */{st.st_size}"})
+            if byte_range is not None:
+                start, end = byte_range
+                status_code = 206
+                headers["content-range"] = f"bytes {start}-{end - 1}/{st.st_size}"
+        headers["content-length"] = str(end - start)
+
+        head = request.method == "HEAD"
+        content = None
+        if st.st_size <= self.cache.max_file_size and not head:
+            content = self.cache.get(path, st)
+            if content is None:
+                content = await anyio.to_thread.run_sync(_read, path, 0, st.st_size)
+                self.cache.put(path, st, content)
+        return FileResponse(path, start, end, content, status_code, headers, head=head)
+
+    @staticmethod
+    def not_modified(request: Request, etag: str, mtime: float) -> bool:
+        # If-None-Match wins over If-Modified-Since when both are sent
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    @staticmethod
+    def if_range_matches(request: Request, etag: str, last_modified: str) -> bool:
+        # If-Range: only send the range if the file didn't change since the client got the first part
+        if_range = request.headers.get("if-range")
+        return if_range is None or if_range.strip() in (etag, last_modified)
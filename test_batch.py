@@ -0,0 +1,156 @@
+import os
+import tempfile
+
+# keep the idempotency keys of main.py out of the project folder, it must be set before main is imported
+os.environ.setdefault("IDEMPOTENCY_DB", f"{tempfile.mkdtemp()}/idempotency.db")
+
+import asyncio
+
+from fastapi import FastAPI, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from batch import add_batch_route
+from main import app as main_app
+
+
+# run by: pytest test_batch.py
+
+
+def make_app(concurrency):
+    app = FastAPI()
+    app.state.running = 0
+    app.state.max_running = 0
+    lanes = []
+
+    def lane():
+        slot = {"slot": len(lanes)}
+        lanes.append(slot)
+        yield slot
+        slot["closed"] = True
+
+    @app.get("/echo/{value}")
+    async def echo(value: str, request: Request, x_user: str = Header(default=None), q: int = 0):
+        app.state.running += 1
+        app.state.max_running = max(app.state.max_running, app.state.running)
+        await asyncio.sleep(0.02)
+        app.state.running -= 1
+        return {"value": value, "user": x_user, "q": q, "slot": request.state.slot}
+
+    @app.post("/double/")
+    async def double(numbers: list):
+        return [number * 2 for number in numbers]
+
+    @app.get("/not-json")
+    async def not_json():
+        return Response(b"{not json", media_type="application/json")
+
+    @app.get("/boom")
+    async def boom():
+        raise RuntimeError("boom")
+
+    @app.get("/stream")
+    async def stream():
+        async def events():
+            try:
+                while True:
+                    yield b"data: tick\n\n"
+                    await asyncio.sleep(0.01)
+            finally:
+                app.state.stream_closed = True
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    add_batch_route(app, concurrency=concurrency, max_requests=10, lane=lane)
+    return app, lanes
+
+
+def test_batch_runs_the_sub_requests_concurrently():
+    app, lanes = make_app(concurrency=3)
+    client = TestClient(app, raise_server_exceptions=False)
+    requests = [{"path": f"/echo/{i}?q={i}"} for i in range(8)]
+    requests.append({"method": "POST", "path": "/double/", "body": [1, 2]})
+    requests.append({"path": "/echo/me", "headers": {"X-User": "other"}})
+    response = client.post("/batch/", json={"requests": requests}, headers={"X-User": "deadpool"})
+    assert response.status_code == 200
+    results = response.json()
+
+    # in the order of the requests, with the headers of the batch unless a sub-request overrides them
+    assert [result["body"]["value"] for result in results[:8]] == [str(i) for i in range(8)]
+    assert [result["body"]["q"] for result in results[:8]] == list(range(8))
+    assert {result["body"]["user"] for result in results[:8]} == {"deadpool"}
+    assert results[8] == {"status": 200, "headers": results[8]["headers"], "body": [2, 4]}
+    assert results[9]["body"]["user"] == "other"
+
+    # at most 3 at the same time, on 3 slots that are reused, then closed
+    assert 1 < app.state.max_running <= 3
+    assert len(lanes) == 3 and all(slot["closed"] for slot in lanes)
+    assert {result["body"]["slot"] for result in results if "slot" in result["body"]} == {0, 1, 2}
+
+
+def test_batch_errors():
+    app, _ = make_app(concurrency=2)
+    client = TestClient(app, raise_server_exceptions=False)
+    results = client.post("/batch/", json={"requests": [
+        {"path": "/boom"}, {"path": "/missing"}, {"method": "POST", "path": "/batch/"}, {"path": "/echo/ok"},
+    ]}).json()
+    # a failed sub-request doesn't fail the others
+    assert [result["status"] for result in results] == [500, 404, 400, 200]
+
+    response = client.post("/batch/", json={"requests": [{"path": "/echo/1"}] * 11})
+    assert response.status_code == 413
+
+
+def test_batch_bad_sub_requests_and_responses():
+    app, _ = make_app(concurrency=2)
+    client = TestClient(app)
+    results = client.post("/batch/", json={"requests": [
+        {"path": "/not-json"},
+        {"path": "/echo/ok", "headers": {"X-User": "\u2603"}},
+        {"path": "/echo/ok", "headers": {"X-User": "a\r\nX-Admin: 1"}},
+        {"path": "/echo/ok", "headers": {"X-User": "caf\u00e9"}},
+    ]}).json()
+    # a body that isn't the JSON it claims is returned as text, a header that can't be sent is a 400
+    assert results[0]["status"] == 200 and results[0]["body"] == "{not json"
+    assert [result["status"] for result in results[1:]] == [400, 400, 200]
+    assert results[3]["body"]["user"] == "caf\u00e9"
+
+
+def test_batch_rejects_streams():
+    app, _ = make_app(concurrency=2)
+    client = TestClient(app)
+    # the stream never ends by itself, the sub-request gets a disconnect, so the batch finishes
+    results = client.post("/batch/", json={"requests": [{"path": "/stream"}, {"path": "/echo/ok"}]}).json()
+    assert [result["status"] for result in results] == [400, 200]
+    assert results[0]["body"] == {"detail": "A batch can't contain a streaming response"}
+    assert app.state.stream_closed
+
+
+def test_main_batch_checks_the_token_once():
+    client = TestClient(main_app)
+    response = client.post("/batch/", json={"requests": [{"path": "/items/foo"}, {"path": "/items/nope"}]},
+                           headers={"X-Token": "coneofsilence"})
+    assert [result["status"] for result in response.json()] == [200, 404]
+    assert response.json()[0]["body"]["id"] == "foo"
+
+    response = client.post("/batch/", json={"requests": [{"path": "/items/foo"}]}, headers={"X-Token": "hailhydra"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid X-Token header"}
+
+
+def test_batch_doesnt_share_the_idempotency_key():
+    client = TestClient(main_app)
+    headers = {"X-Token": "coneofsilence", "Idempotency-Key": "batch-key"}
+    requests = [{"method": "POST", "path": "/items/", "body": {"id": f"batch{i}", "title": "Batch"}} for i in range(2)]
+    response = client.post("/batch/", json={"requests": requests}, headers=headers)
+    # 2 items, not a 422 (or a replay) for the second one
+    assert [result["status"] for result in response.json()] == [200, 200]
+    assert client.get("/items/batch1", headers=headers).status_code == 200
+
+    # the key of a sub-request is its own
+    request = {"method": "POST", "path": "/items/", "body": {"id": "batch2", "title": "Batch"},
+               "headers": {"Idempotency-Key": "sub-key"}}
+    first = client.post("/batch/", json={"requests": [request]}, headers=headers).json()
+    replay = client.post("/batch/", json={"requests": [request]}, headers=headers).json()
+    assert first[0]["status"] == replay[0]["status"] == 200
+    assert replay[0]["headers"]["idempotent-replayed"] == "true"
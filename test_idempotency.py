@@ -0,0 +1,118 @@
+import os
+import tempfile
+
+# keep the keys of the tests out of the project folder, it must be set before main is imported
+os.environ.setdefault("IDEMPOTENCY_DB", f"{tempfile.mkdtemp()}/idempotency.db")
+
+import asyncio
+import time
+
+import httpx
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from idempotency import IdempotencyMiddleware, IdempotencyStore
+from main import app as main_app
+
+
+# run by: pytest test_idempotency.py
+
+
+def make_app(tmp_path, middleware_options: dict = None, **options):
+    app = FastAPI()
+    app.state.calls = []
+
+    @app.post("/orders/")
+    async def create_order(order: dict):
+        app.state.calls.append(order)
+        await asyncio.sleep(order.get("sleep", 0))
+        if order.get("fail"):
+            raise HTTPException(status_code=503, detail="try again")
+        return {"id": len(app.state.calls), **order}
+
+    app.add_middleware(IdempotencyMiddleware, store=IdempotencyStore(f"{tmp_path}/keys.db", **options),
+                       **(middleware_options or {}))
+    return app
+
+
+def test_retry_replays_the_first_response(tmp_path):
+    app = make_app(tmp_path)
+    client = TestClient(app)
+    first = client.post("/orders/", json={"item": "foo"}, headers={"Idempotency-Key": "k1"})
+    retry = client.post("/orders/", json={"item": "foo"}, headers={"Idempotency-Key": "k1"})
+    assert first.json() == retry.json() == {"id": 1, "item": "foo"}
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert len(app.state.calls) == 1
+
+    # another key, or no key, runs the endpoint
+    assert client.post("/orders/", json={"item": "foo"}, headers={"Idempotency-Key": "k2"}).json()["id"] == 2
+    assert client.post("/orders/", json={"item": "foo"}).json()["id"] == 3
+
+    # the same key with another body is refused
+    response = client.post("/orders/", json={"item": "bar"}, headers={"Idempotency-Key": "k1"})
+    assert response.status_code == 422
+    assert len(app.state.calls) == 3
+
+
+def test_concurrent_duplicates_wait_for_the_first(tmp_path):
+    app = make_app(tmp_path)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await asyncio.gather(*[
+                client.post("/orders/", json={"item": "foo", "sleep": 0.1}, headers={"Idempotency-Key": "k1"})
+                for _ in range(5)
+            ])
+
+    responses = asyncio.run(run())
+    assert len(app.state.calls) == 1
+    assert [response.json()["id"] for response in responses] == [1] * 5
+    assert sum(response.headers.get("Idempotent-Replayed") == "true" for response in responses) == 4
+
+
+def test_failures_and_expired_keys_run_again(tmp_path):
+    app = make_app(tmp_path, ttl=0.2)
+    client = TestClient(app)
+    # a 5xx is not stored, the retry runs the endpoint again
+    assert client.post("/orders/", json={"fail": True}, headers={"Idempotency-Key": "k1"}).status_code == 503
+    assert client.post("/orders/", json={"fail": True}, headers={"Idempotency-Key": "k1"}).status_code == 503
+    assert len(app.state.calls) == 2
+
+    client.post("/orders/", json={"item": "foo"}, headers={"Idempotency-Key": "k2"})
+    time.sleep(0.3)
+    assert client.post("/orders/", json={"item": "foo"}, headers={"Idempotency-Key": "k2"}).json()["id"] == 4
+
+
+def test_body_limits(tmp_path):
+    app = make_app(tmp_path, middleware_options={"max_request_body": 100, "max_body": 100})
+    client = TestClient(app)
+    big = {"item": "x" * 200}
+    # by Content-Length, and without it (a chunked body), the endpoint doesn't run
+    assert client.post("/orders/", json=big, headers={"Idempotency-Key": "k1"}).status_code == 413
+    chunked = (part for part in [b'{"item": "', b"x" * 200, b'"}'])
+    assert client.post("/orders/", content=chunked, headers={"Idempotency-Key": "k1"}).status_code == 413
+    assert app.state.calls == []
+    # without a key, the body is not held by the middleware, so it isn't limited
+    assert client.post("/orders/", json=big).status_code == 200
+
+    # a response over max_body is sent, but not stored: the retry runs the endpoint again
+    # (a request of 97 bytes, its response is 103 bytes)
+    order = {"item": "y" * 85}
+    for _ in range(2):
+        response = client.post("/orders/", json=order, headers={"Idempotency-Key": "k2"})
+        assert response.status_code == 200 and response.json()["item"] == order["item"]
+    assert len(app.state.calls) == 3
+
+
+def test_main_create_item_retry():
+    client = TestClient(main_app)
+    headers = {"X-Token": "coneofsilence", "Idempotency-Key": f"create-{time.time()}"}
+    item = {"id": f"retry-{time.time()}", "title": "Retry", "description": "Sent twice"}
+    first = client.post("/items/", headers=headers, json=item)
+    # without the key, the second request would be "Item already exists"
+    retry = client.post("/items/", headers=headers, json=item)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == item
+    assert retry.headers["Idempotent-Replayed"] == "true"
@@ -0,0 +1,47 @@
+from jobqueue import JobQueue, Worker
+
+
+# run by: pytest test_jobqueue.py
+
+
+def test_job_runs_once(tmp_path):
+    jobs = JobQueue(str(tmp_path / "jobs.db"))
+    done = []
+
+    @jobs.task
+    def collect(value, suffix=""):
+        done.append(value + suffix)
+
+    jobs.enqueue(collect, "a", suffix="!")
+    jobs.enqueue("collect", "b")
+    assert jobs.stats()["depth"] == 2
+
+    worker = Worker(jobs, batch=10)
+    assert worker.run_once() == 2
+    assert worker.run_once() == 0
+    assert done == ["a!", "b"]
+    stats = jobs.stats()
+    assert stats["depth"] == 0
+    assert stats["done"] == 2
+    assert stats["latency_p50_seconds"] is not None
+
+
+def test_failed_job_is_retried_then_given_up(tmp_path):
+    jobs = JobQueue(str(tmp_path / "jobs.db"), max_attempts=2)
+    calls = []
+
+    @jobs.task
+    def broken():
+        calls.append(1)
+        raise ValueError("boom")
+
+    job_id = jobs.enqueue(broken, delay=0)
+    worker = Worker(jobs)
+    worker.run_once()
+    assert jobs.stats()["depth"] == 1
+
+    # make the retry due now, instead of waiting for the backoff
+    jobs._connection().execute("UPDATE jobs SET run_at = 0 WHERE id = ?", (job_id,))
+    worker.run_once()
+    assert len(calls) == 2
+    assert jobs.stats()["failed"] == 1
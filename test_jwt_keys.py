@@ -0,0 +1,83 @@
+import logging
+
+import pytest
+from jose import JWTError
+
+from jwt_keys import KeyRing, generate_private_key, load_key_ring
+
+
+# check that the key ring can rotate and retire keys by kid
+# run by: pytest test_jwt_keys.py
+
+
+@pytest.mark.parametrize("algorithm", ["RS256", "ES256"])
+def test_sign_and_verify(algorithm):
+    ring = KeyRing(algorithm)
+    ring.add_key("k1", private_key=generate_private_key(algorithm))
+    token = ring.encode({"sub": "johndoe"})
+    assert ring.decode(token) == {"sub": "johndoe"}
+
+
+def test_verify_with_public_key_only():
+    issuer = KeyRing("RS256")
+    issuer.add_key("k1", private_key=generate_private_key("RS256"))
+    verifier = KeyRing("RS256")
+    verifier.add_key("k1", public_key=issuer.export_public_key("k1"))
+    token = issuer.encode({"sub": "johndoe"})
+    assert verifier.decode(token) == {"sub": "johndoe"}
+    # the verifier doesn't hold any private key, so it can't sign
+    with pytest.raises(JWTError):
+        verifier.encode({"sub": "johndoe"})
+
+
+def test_rotate_and_retire():
+    ring = KeyRing("ES256")
+    ring.add_key("k1", private_key=generate_private_key("ES256"))
+    old_token = ring.encode({"sub": "johndoe"})
+    ring.rotate("k2", private_key=generate_private_key("ES256"))
+    new_token = ring.encode({"sub": "johndoe"})
+
+    # both tokens are valid until k1 is retired
+    assert ring.decode(old_token) == ring.decode(new_token)
+    ring.retire("k1")
+    assert ring.decode(new_token) == {"sub": "johndoe"}
+    with pytest.raises(JWTError):
+        ring.decode(old_token)
+
+
+def test_load_key_ring(tmp_path, monkeypatch):
+    private_key = generate_private_key("ES256")
+    issuer = KeyRing("ES256")
+    issuer.add_key("2024.01", private_key=generate_private_key("ES256"))
+    (tmp_path / "2024.01.pub.pem").write_bytes(issuer.export_public_key("2024.01"))
+    (tmp_path / "2024.key.pem").write_bytes(private_key)
+    monkeypatch.setenv("JWT_KEYS_DIR", str(tmp_path))
+    monkeypatch.setenv("JWT_ACTIVE_KID", "2024")
+
+    ring = load_key_ring("ES256")
+    # "2024.01" and "2024" are 2 kids, the private key of "2024" is read from 2024.key.pem
+    assert sorted(ring.kids()) == ["2024", "2024.01"]
+    assert ring.decode(issuer.encode({"sub": "johndoe"})) == {"sub": "johndoe"}
+    signer = KeyRing("ES256")
+    signer.add_key("2024", private_key=private_key)
+    assert ring.encode({"sub": "johndoe"}) and ring.decode(signer.encode({"sub": "johndoe"})) == {"sub": "johndoe"}
+
+
+def test_load_key_ring_bad_active_kid(tmp_path, monkeypatch):
+    issuer = KeyRing("ES256")
+    issuer.add_key("verify-only", private_key=generate_private_key("ES256"))
+    (tmp_path / "verify-only.pub.pem").write_bytes(issuer.export_public_key("verify-only"))
+    monkeypatch.setenv("JWT_KEYS_DIR", str(tmp_path))
+    # a typo, or a kid without its private key
+    for kid in ["typo", "verify-only"]:
+        monkeypatch.setenv("JWT_ACTIVE_KID", kid)
+        with pytest.raises(ValueError):
+            load_key_ring("ES256")
+
+
+def test_load_key_ring_dev_key_warns(monkeypatch, caplog):
+    monkeypatch.delenv("JWT_KEYS_DIR", raising=False)
+    with caplog.at_level(logging.WARNING, logger="jwt_keys"):
+        ring = load_key_ring("ES256")
+    assert ring.kids() == ["dev"]
+    assert "JWT_KEYS_DIR is not set" in caplog.text
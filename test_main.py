@@ -1,3 +1,5 @@
+import json
+
 from fastapi.testclient import TestClient
 
 from main import app
@@ -73,4 +75,66 @@ def test_create_existing_item():
         },
     )
     assert response.status_code == 400
-    assert response.json() == {"detail": "Item already exists"}
\ No newline at end of file
+    assert response.json() == {"detail": "Item already exists"}
+
+
+def test_patch_item():
+    headers = {"X-Token": "coneofsilence"}
+    client.post("/items/", headers=headers, json={"id": "patchme", "title": "Patch", "description": "Kept"})
+    response = client.patch("/items/patchme", headers=headers, json={"title": "Patched", "version": 1})
+    assert response.status_code == 200
+    # the description wasn't sent, so it's kept
+    assert response.json() == {"id": "patchme", "title": "Patched", "description": "Kept"}
+    assert response.headers["ETag"] == '"2"'
+
+    response = client.patch("/items/patchme", headers=headers, json={"description": "Lost", "version": 1})
+    assert response.status_code == 409
+    assert client.patch("/items/patchme", headers=headers, json={"title": None}).status_code == 422
+    assert client.patch("/items/nope", headers=headers, json={"title": "x"}).status_code == 404
+    assert client.patch("/items/patchme", headers={"X-Token": "hailhydra"}, json={}).status_code == 400
+
+
+def test_patch_item_if_match():
+    headers = {"X-Token": "coneofsilence"}
+    client.post("/items/", headers=headers, json={"id": "etag", "title": "ETag"})
+    # the version comes from the read, then it's sent back in If-Match
+    etag = client.get("/items/etag", headers=headers).headers["ETag"]
+    assert etag == '"1"'
+    response = client.patch("/items/etag", headers={**headers, "If-Match": etag}, json={"title": "Changed"})
+    assert response.status_code == 200
+    new_etag = response.headers["ETag"]
+    assert client.get("/items/etag", headers=headers).headers["ETag"] == new_etag == '"2"'
+
+    # the other client still has the old ETag
+    response = client.patch("/items/etag", headers={**headers, "If-Match": etag}, json={"title": "Lost"})
+    assert response.status_code == 412
+    assert client.get("/items/etag", headers=headers).json()["title"] == "Changed"
+    response = client.patch("/items/etag", headers={**headers, "If-Match": f'W/{new_etag}'}, json={"title": "Ok"})
+    assert response.status_code == 200
+
+
+def test_create_items_bulk():
+    body = (
+        b'{"name": "Foo", "price": 1.5, "tax": 0.5, "images": [{"url": "http://a.com/a.png", "name": "a"}]}\n'
+        b'{"name": "Bar"}\n'
+        b'\n'
+        b'not json\n'
+        b'{"name": "Baz", "price": 2}'
+    )
+    response = client.post("/create_item/bulk/", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert [result.get("line") for result in results] == [1, 2, 4, 5, None]
+    assert results[0]["ok"] is True
+    assert results[0]["item"]["price_with_tax"] == 2.0
+    assert results[0]["item"]["images"][0]["url"] == "http://a.com/a.png"
+    assert results[1]["ok"] is False
+    assert results[1]["errors"][0]["loc"] == ["price"]
+    assert results[2]["ok"] is False
+    assert results[3]["item"]["name"] == "Baz"
+    assert results[4] == {"summary": {"lines": 5, "valid": 2, "invalid": 2}}
+
+    # the results are the same when they are sent while the body is read
+    response = client.post("/create_item/bulk/?duplex=true", content=body)
+    assert [json.loads(line) for line in response.text.splitlines()] == results
@@ -0,0 +1,134 @@
+import asyncio
+import time
+import tracemalloc
+
+import anyio
+import httpx
+
+from fastapi import Depends, FastAPI, Header, HTTPException
+from fastapi.testclient import TestClient
+
+import memprof
+from memprof import MemoryProfiler
+
+
+# run by: pytest test_memprof.py
+
+leaked = []
+
+
+# the header of the /admin/memory routes in these tests
+ADMIN = {"X-Token": "admin"}
+
+
+async def verify_token(x_token: str = Header(default="")):
+    if x_token != ADMIN["X-Token"]:
+        raise HTTPException(status_code=403, detail="Invalid X-Token header")
+
+
+def make_app(profiler: MemoryProfiler, **options) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/leak")
+    def leak():
+        leaked.append(bytearray(100_000))
+        return {"leaked": len(leaked)}
+
+    @app.get("/ok")
+    def ok():
+        return {"ok": True}
+
+    @app.get("/slow")
+    async def slow():
+        await asyncio.sleep(0.1)
+        return {"ok": True}
+
+    memprof.install(app, profiler, dependencies=[Depends(verify_token)], **options)
+    return app
+
+
+def test_memory_profiler():
+    profiler = MemoryProfiler(enabled=True, sample_every=1, report_interval=0.05)
+    with TestClient(make_app(profiler), headers=ADMIN) as client:
+        client.post("/admin/memory/snapshot")
+        for _ in range(5):
+            client.get("/leak")
+            client.get("/ok")
+        time.sleep(0.2)
+
+        stats = client.get("/admin/memory").json()
+        assert stats["enabled"] and stats["rss_bytes"] > 0 and stats["traced_bytes"] > 0
+        # the route that keeps memory comes first
+        assert list(stats["routes"])[0] == "GET leak"
+        assert stats["routes"]["GET leak"]["samples"] == 5
+        assert stats["routes"]["GET leak"]["avg_delta_bytes"] >= 90_000
+        assert stats["routes"]["GET ok"]["avg_delta_bytes"] < 100_000
+        assert stats["history"] and stats["history"][-1]["rss_bytes"] > 0
+
+        # the line of the leak grew by 5 x 100 KB since the snapshot
+        diff = client.get("/admin/memory/diff?limit=5").json()
+        assert "test_memprof.py" in diff[0]["site"]
+        assert diff[0]["size_diff_bytes"] >= 500_000
+        top = client.get("/admin/memory/top?limit=50&group_by=filename").json()
+        assert any(stat["site"].endswith("test_memprof.py") for stat in top)
+    # tracemalloc is stopped with the app
+    assert not tracemalloc.is_tracing()
+    leaked.clear()
+
+
+def test_memory_profiler_off():
+    with TestClient(make_app(MemoryProfiler(enabled=False), admin=True), headers=ADMIN) as client:
+        client.get("/leak")
+        stats = client.get("/admin/memory").json()
+        assert not stats["enabled"] and stats["rss_bytes"] > 0 and stats["routes"] == {}
+        assert client.get("/admin/memory/top").status_code == 400
+        assert client.get("/admin/memory/diff").status_code == 400
+
+        # a trace window: tracemalloc runs for a while, then it stops by itself
+        client.post("/admin/memory/trace?seconds=0.5")
+        client.post("/admin/memory/snapshot")
+        client.get("/leak")
+        assert client.get("/admin/memory/diff").json()[0]["size_diff_bytes"] >= 100_000
+        time.sleep(0.7)
+        assert not tracemalloc.is_tracing()
+        assert client.get("/admin/memory/top").status_code == 400
+    leaked.clear()
+
+
+def test_memory_profiler_overlapped_requests():
+    profiler = MemoryProfiler(enabled=True, sample_every=1)
+    app = make_app(profiler)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://test") as client:
+            # /leak runs while /slow is sampled, so the delta of /slow would have the 100 KB of /leak
+            slow = asyncio.ensure_future(client.get("/slow"))
+            await asyncio.sleep(0.02)
+            await client.get("/leak")
+            await slow
+            # alone again, the next request is sampled
+            await client.get("/ok")
+
+    profiler.start()
+    try:
+        anyio.run(run)
+        routes = profiler.snapshot()["routes"]
+    finally:
+        profiler.stop()
+    assert routes["GET slow"]["samples"] == 0 and routes["GET slow"]["overlapped"] == 1
+    assert "GET leak" not in routes
+    assert routes["GET ok"]["samples"] == 1
+    leaked.clear()
+
+
+def test_memory_routes_need_auth():
+    with TestClient(make_app(MemoryProfiler(enabled=True))) as client:
+        for method, path in [("GET", "/admin/memory"), ("GET", "/admin/memory/top"), ("POST", "/admin/memory/trace"),
+                             ("POST", "/admin/memory/snapshot"), ("GET", "/admin/memory/diff")]:
+            assert client.request(method, path).status_code == 403, path
+            assert client.request(method, path, headers={"X-Token": "wrong"}).status_code == 403, path
+
+    # without MEMPROF=1 or MEMPROF_ADMIN=1, the routes are not there at all
+    app = make_app(MemoryProfiler(enabled=False))
+    assert not [route for route in app.routes if route.path.startswith("/admin/memory")]
+    assert TestClient(app, headers=ADMIN).get("/admin/memory").status_code == 404
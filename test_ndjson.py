@@ -0,0 +1,33 @@
+import asyncio
+
+from ndjson import read_lines
+
+# tests for ndjson.py, run by: pytest test_ndjson.py
+
+
+def collect(chunks, max_line_bytes=10):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    async def run():
+        return [batch async for batch in read_lines(stream(), max_line_bytes)]
+
+    return asyncio.run(run())
+
+
+def test_read_lines_across_chunks():
+    # a line can be cut anywhere between 2 chunks
+    assert collect([b'{"a"', b': 1}\n{"b": 2}\n{', b'"c": 3}']) == [
+        [(1, b'{"a": 1}'), (2, b'{"b": 2}')],
+        [(3, b'{"c": 3}')],
+    ]
+
+
+def test_read_lines_too_long():
+    # the too long line is reported once as None, its end is dropped, the next lines are still read
+    assert collect([b"short\n0123456789abc", b"defgh", b"ij\nnext\n"]) == [
+        [(1, b"short"), (2, None)],
+        [(3, b"next")],
+    ]
+    assert collect([b"0123456789abc\nok\n"]) == [[(1, None), (2, b"ok")]]
@@ -0,0 +1,65 @@
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import openapi_cache
+
+
+# run by: pytest test_openapi_cache.py
+
+
+def make_app(extra_route: bool = False) -> FastAPI:
+    app = FastAPI(title="cached")
+
+    @app.get("/items/{item_id}")
+    def read_item(item_id: int):
+        return {"item_id": item_id}
+
+    if extra_route:
+        @app.get("/users/")
+        def read_users():
+            return []
+
+    return app
+
+
+def test_miss_builds_and_saves_the_schema(tmp_path):
+    app = make_app()
+    openapi_cache.install(app, str(tmp_path))
+    schema = TestClient(app).get("/openapi.json").json()
+    assert "/items/{item_id}" in schema["paths"]
+
+    # the next worker finds the file of the same hash
+    path = openapi_cache.cache_path(make_app(), str(tmp_path))
+    with open(path) as f:
+        assert json.load(f) == schema
+
+
+def test_matching_hash_is_served_from_the_file(tmp_path):
+    app = make_app()
+    path = openapi_cache.build(app, str(tmp_path))
+    # change the saved file, the app must return it as it is, without building the schema
+    with open(path) as f:
+        schema = json.load(f)
+    schema["info"]["title"] = "from the file"
+    with open(path, "w") as f:
+        json.dump(schema, f)
+
+    app = make_app()
+    openapi_cache.install(app, str(tmp_path))
+    assert TestClient(app).get("/openapi.json").json()["info"]["title"] == "from the file"
+
+
+def test_stale_hash_regenerates(tmp_path):
+    old_path = openapi_cache.build(make_app(), str(tmp_path))
+
+    # a new route: a new hash, so the old file is not used
+    app = make_app(extra_route=True)
+    new_path = openapi_cache.cache_path(app, str(tmp_path))
+    assert new_path != old_path
+    openapi_cache.install(app, str(tmp_path))
+    schema = TestClient(app).get("/openapi.json").json()
+    assert "/users/" in schema["paths"]
+    with open(new_path) as f:
+        assert json.load(f) == schema
@@ -0,0 +1,98 @@
+import os
+import tempfile
+
+# keep the idempotency keys of main.py out of the project folder, it must be set before main is imported
+os.environ.setdefault("IDEMPOTENCY_DB", f"{tempfile.mkdtemp()}/idempotency.db")
+
+import json
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+import pricing
+from main import Item, app, item_with_tax
+
+
+# run by: pytest test_pricing.py
+
+client = TestClient(app)
+
+
+def test_quote_json_columns():
+    prices = [35.4, 10, 2.5, 7]
+    taxes = [3.2, None, 0, 1.25]
+    response = client.post("/create_item/quote/", json={"price": prices, "tax": taxes})
+    assert response.status_code == 200
+    result = response.json()
+
+    # the same totals as create_item, item by item
+    expected = [item_with_tax(Item(name="x", price=price, tax=tax)) for price, tax in zip(prices, taxes)]
+    assert result["totals"] == [item.get("price_with_tax", item["price"]) for item in expected]
+    assert result["summary"] == {
+        "count": 4, "taxed": 3, "price_sum": 54.9, "tax_sum": 4.45, "total_sum": sum(result["totals"]),
+        "total_min": 2.5, "total_max": 38.6, "total_mean": sum(result["totals"]) / 4,
+    }
+
+    # without the taxes, and only the summary
+    response = client.post("/create_item/quote/?totals=false", json={"price": [1, 2]})
+    assert response.json() == {"summary": {
+        "count": 2, "taxed": 0, "price_sum": 3.0, "tax_sum": 0.0, "total_sum": 3.0,
+        "total_min": 1.0, "total_max": 2.0, "total_mean": 1.5,
+    }}
+
+
+def test_quote_binary():
+    prices = np.arange(1000, dtype=np.float64)
+    taxes = np.where(prices % 2 == 0, 0.5, np.nan)
+    response = client.post(
+        "/create_item/quote/",
+        content=np.concatenate([prices, taxes]).astype("<f8").tobytes(),
+        headers={"Content-Type": "application/octet-stream", "Accept": "application/octet-stream"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/octet-stream"
+    totals = np.frombuffer(response.content, dtype="<f8")
+    assert np.array_equal(totals, prices + np.nan_to_num(taxes))
+    summary = json.loads(response.headers["X-Quote-Summary"])
+    assert summary["count"] == 1000 and summary["taxed"] == 500 and summary["tax_sum"] == 250.0
+
+    # binary in, JSON out
+    response = client.post("/create_item/quote/", content=np.array([1.0, 2.0]).tobytes(),
+                           headers={"Content-Type": "application/octet-stream"})
+    assert response.json()["totals"] == [3.0]
+
+
+def test_quote_errors(monkeypatch):
+    bad = [
+        (b"not json", "application/json"),
+        (json.dumps({"price": [1, 2], "tax": [1]}).encode(), "application/json"),
+        (json.dumps({"price": [1, None]}).encode(), "application/json"),
+        (json.dumps({"price": ["a"]}).encode(), "application/json"),
+        (json.dumps([1, 2]).encode(), "application/json"),
+        (b"\x00" * 24, "application/octet-stream"),
+        (np.array([np.inf, 0.0]).tobytes(), "application/octet-stream"),
+        # finite numbers, but the totals overflow
+        (json.dumps({"price": [1e308], "tax": [1e308]}).encode(), "application/json"),
+        (json.dumps({"price": [1e308, 1e308]}).encode(), "application/json"),
+    ]
+    for body, content_type in bad:
+        response = client.post("/create_item/quote/", content=body, headers={"Content-Type": content_type})
+        assert response.status_code == 422, body
+
+    monkeypatch.setattr(pricing, "PRICING_MAX_BODY_BYTES", 100)
+    response = client.post("/create_item/quote/", json={"price": list(range(100))})
+    assert response.status_code == 413
+
+    monkeypatch.setattr(pricing, "PRICING_MAX_ITEMS", 2)
+    response = client.post("/create_item/quote/", json={"price": [1, 2, 3]})
+    assert response.status_code == 422
+
+
+def test_zero_tax_is_a_tax_on_both_endpoints():
+    item = client.post("/create_item/", json={"name": "Foo", "price": 10.5, "tax": 0}).json()
+    assert item["price_with_tax"] == 10.5
+    assert "price_with_tax" not in client.post("/create_item/", json={"name": "Foo", "price": 10.5}).json()
+
+    result = client.post("/create_item/quote/", json={"price": [10.5], "tax": [0]}).json()
+    assert result["totals"] == [item["price_with_tax"]]
+    assert result["summary"]["taxed"] == 1
@@ -0,0 +1,42 @@
+import serve
+
+
+# run by: pytest test_serve.py
+
+
+def test_default_workers(monkeypatch):
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    assert serve.default_workers() == 3
+
+    monkeypatch.delenv("WEB_CONCURRENCY")
+    monkeypatch.setattr(serve.os, "sched_getaffinity", lambda pid: {0, 1}, raising=False)
+    assert serve.default_workers() == 2
+
+    # no sched_getaffinity (ex: macOS), the CPU count is used
+    monkeypatch.delattr(serve.os, "sched_getaffinity")
+    monkeypatch.setattr(serve.os, "cpu_count", lambda: 5)
+    assert serve.default_workers() == 5
+    monkeypatch.setattr(serve.os, "cpu_count", lambda: None)
+    assert serve.default_workers() == 1
+
+
+def test_loop_and_http_fallbacks(monkeypatch):
+    installed = set()
+    monkeypatch.setattr(serve.importlib.util, "find_spec", lambda name: object() if name in installed else None)
+    monkeypatch.setenv("WEB_CONCURRENCY", "2")
+    assert serve.resolve_options() == (2, "asyncio", "h11")
+
+    installed.update({"uvloop", "httptools"})
+    assert serve.resolve_options() == (2, "uvloop", "httptools")
+    # the options that are given are kept
+    assert serve.resolve_options(4, "asyncio", "h11") == (4, "asyncio", "h11")
+
+
+def test_command_line(monkeypatch):
+    calls = []
+    monkeypatch.setattr(serve, "serve", lambda app, **options: calls.append((app, options)))
+    serve.main(["sql_app.main:app", "--workers", "4", "--loop", "asyncio", "--port", "9000"])
+    app, options = calls[0]
+    assert app == "sql_app.main:app"
+    assert options["workers"] == 4 and options["loop"] == "asyncio" and options["http"] is None
+    assert options["port"] == 9000
@@ -0,0 +1,64 @@
+import threading
+import time
+
+from singleflight import SingleFlight
+
+
+# run by: pytest test_singleflight.py
+
+
+def test_concurrent_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.1)
+        return {"id": 1}
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do("user:1", load))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [{"id": 1}] * 10
+    # the key is removed when the call is done, so the next call runs again
+    flight.do("user:1", load)
+    assert len(calls) == 2
+
+
+def test_waiters_over_the_limit_run_by_themselves():
+    flight = SingleFlight(max_waiters=2)
+    calls = []
+    results = []
+    leading = threading.Event()
+
+    def load():
+        calls.append(1)
+        leading.set()
+        time.sleep(0.2)
+        return "item"
+
+    leader = threading.Thread(target=lambda: results.append(flight.do("item:foo", load)))
+    leader.start()
+    leading.wait()
+    # the leader is running, 4 more requests arrive
+    threads = [threading.Thread(target=lambda: results.append(flight.do("item:foo", load))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in [leader] + threads:
+        thread.join()
+
+    assert results == ["item"] * 5
+    # 1 leader + 2 waiters share a call, the other 2 requests run their own
+    assert len(calls) == 3
+    assert flight.stats == {"leaders": 1, "shared": 2, "bypassed": 2}
+
+
+def test_sql_app_waiters_stay_below_the_threadpool():
+    from sql_app.main import flight, threadpool
+
+    assert flight.max_waiters < threadpool.size
@@ -0,0 +1,546 @@
+import os
+import tempfile
+
+# use a temp db for the tests, it must be set before sql_app is imported
+TEST_DIR = tempfile.mkdtemp()
+os.environ["SQL_APP_DATABASE_URL"] = f"sqlite:///{TEST_DIR}/test_sql_app.db"
+os.environ.setdefault("IDEMPOTENCY_DB", f"{TEST_DIR}/idempotency.db")
+os.environ["SQL_APP_ADMIN_TOKEN"] = "test-admin-token"
+
+import threading
+import time
+
+import anyio
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from sql_app import crud, models, schema, schemas
+from sql_app.database import LazySession, SessionLocal, create_shard_engine, engine, pool_stats, slow_query_log
+from sql_app.feed import ChangeFeed
+from sql_app.main import app, batch_dispatcher, threadpool
+from sql_app.threadpool import ThreadPool
+
+# tests for sql_app, run by: pytest test_sql_app.py
+schema.migrate(engine)
+client = TestClient(app)
+# the header of the /admin/ routes
+ADMIN = {"X-Admin-Token": "test-admin-token"}
+
+
+def test_schema_check(tmp_path):
+    new_engine = create_engine(f"sqlite:///{tmp_path}/new.db")
+    # an empty db must be migrated before the app can start
+    with pytest.raises(schema.SchemaVersionError):
+        schema.check(new_engine)
+    schema.migrate(new_engine)
+    schema.check(new_engine)
+    # migrate again does nothing
+    assert schema.migrate(new_engine) == schema.current_version(new_engine) == schema.SCHEMA_VERSION
+
+
+def test_migrate_race(tmp_path):
+    # the workers that start together with SQL_APP_AUTO_MIGRATE=1 migrate the same empty db
+    worker_engines = [create_engine(f"sqlite:///{tmp_path}/race.db") for _ in range(4)]
+    barrier = threading.Barrier(len(worker_engines))
+    errors = []
+
+    def start(worker_engine):
+        barrier.wait()
+        try:
+            schema.migrate(worker_engine)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=start, args=(worker_engine,)) for worker_engine in worker_engines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    schema.check(worker_engines[0])
+
+
+def test_create_and_read_user():
+    response = client.post("/users/", json={"email": "deadpool@example.com", "password": "chimichangas4life"})
+    assert response.status_code == 200
+    user_id = response.json()["id"]
+
+    response = client.post(f"/users/{user_id}/items/", json={"title": "Foo", "description": "The Foo Wrestlers"})
+    assert response.status_code == 200
+
+    response = client.get(f"/users/{user_id}")
+    assert response.status_code == 200
+    assert response.json()["email"] == "deadpool@example.com"
+    assert [item["title"] for item in response.json()["items"]] == ["Foo"]
+
+
+def test_create_existing_user():
+    client.post("/users/", json={"email": "twice@example.com", "password": "secret"})
+    response = client.post("/users/", json={"email": "twice@example.com", "password": "secret"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Email already registered"}
+
+
+def test_create_user_email_race(monkeypatch):
+    client.post("/users/", json={"email": "race@example.com", "password": "secret"})
+    # the email is taken between the check of the endpoint and the insert
+    monkeypatch.setattr(crud, "get_user_by_email", lambda db, email: None)
+    response = client.post("/users/", json={"email": "race@example.com", "password": "secret"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Email already registered"}
+
+    # the session is rolled back, so it can still be used
+    db = LazySession()
+    with pytest.raises(IntegrityError):
+        crud.create_user(db, schemas.UserCreate(email="race@example.com", password="x"))
+    assert crud.create_user(db, schemas.UserCreate(email="race2@example.com", password="x")).id
+    db.close()
+
+
+def test_total_count_headers():
+    users_before = int(client.get("/users/").headers["X-Total-Count"])
+    items_before = int(client.get("/items/").headers["X-Total-Count"])
+
+    user_id = client.post("/users/", json={"email": "counted@example.com", "password": "secret"}).json()["id"]
+    for title in ["A", "B", "C"]:
+        client.post(f"/users/{user_id}/items/", json={"title": title})
+
+    assert client.get("/users/").headers["X-Total-Count"] == str(users_before + 1)
+    assert client.get("/items/").headers["X-Total-Count"] == str(items_before + 3)
+    response = client.get(f"/items/?owner_id={user_id}&limit=2")
+    assert len(response.json()) == 2
+    assert response.headers["X-Total-Count"] == "3"
+
+
+def test_reconcile_counters():
+    with SessionLocal() as db:
+        crud.increment_counter(db, "users", 5)
+        db.commit()
+        fixed = crud.reconcile_counters(db)
+        assert fixed["users"][0] == fixed["users"][1] + 5
+        assert crud.reconcile_counters(db) == {}
+
+
+def test_user_item_summary():
+    user_id = client.post("/users/", json={"email": "summary@example.com", "password": "secret"}).json()["id"]
+    client.post(f"/users/{user_id}/items/", json={"title": "First"})
+    latest_id = client.post(f"/users/{user_id}/items/", json={"title": "Second"}).json()["id"]
+
+    summaries = client.get("/users/summary/?limit=1000").json()
+    expected = {"user_id": user_id, "item_count": 2, "latest_item_id": latest_id, "latest_item_title": "Second"}
+    assert expected in summaries
+
+    # the rebuild gives the same table as the one kept up to date by crud
+    with SessionLocal() as db:
+        crud.rebuild_user_item_summary(db)
+    assert client.get("/users/summary/?limit=1000").json() == summaries
+
+
+def test_slow_query_log():
+    threshold = slow_query_log.threshold
+    # every query is slow with a threshold of 0
+    slow_query_log.threshold = 0
+    try:
+        client.delete("/admin/slow-queries", headers=ADMIN)
+        client.get("/users/?skip=0&limit=3")
+    finally:
+        slow_query_log.threshold = threshold
+
+    entries = client.get("/admin/slow-queries", headers=ADMIN).json()["entries"]
+    select_users = [e for e in entries
+                    if e["statement"].lstrip().startswith("SELECT") and "FROM users" in e["statement"]]
+    assert select_users
+    assert select_users[0]["route"] == "GET /users/"
+    assert select_users[0]["parameters"] == ["int", "int"]
+    assert select_users[0]["plan"]
+
+
+def test_slow_query_log_route_template():
+    user = client.post("/users/", json={"email": "template@example.com", "password": "x"}).json()
+    threshold = slow_query_log.threshold
+    slow_query_log.threshold = 0
+    try:
+        client.delete("/admin/slow-queries", headers=ADMIN)
+        client.get(f"/users/{user['id']}")
+    finally:
+        slow_query_log.threshold = threshold
+
+    routes = {e["route"] for e in client.get("/admin/slow-queries", headers=ADMIN).json()["entries"]}
+    # the template of the route, not the id of the path
+    assert "GET /users/{user_id}" in routes
+    assert f"GET /users/{user['id']}" not in routes
+
+
+def test_admin_routes_need_the_token():
+    for method, path in [("GET", "/admin/slow-queries"), ("DELETE", "/admin/slow-queries"), ("GET", "/admin/pool"),
+                         ("GET", "/admin/threadpool"), ("GET", "/admin/feed")]:
+        assert client.request(method, path).status_code == 403, path
+        assert client.request(method, path, headers={"X-Admin-Token": "wrong"}).status_code == 403, path
+        assert client.request(method, path, headers=ADMIN).status_code == 200, path
+
+
+def test_lazy_session_and_pool_stats():
+    pool_stats.reset()
+    # a validation error returns before the endpoint runs, so the session never takes a connection
+    assert client.get("/users/not-a-number").status_code == 422
+    client.get("/users/")
+    stats = client.get("/admin/pool", headers=ADMIN).json()
+    assert stats["sessions_used"] == 1
+    assert stats["checkouts"] == stats["checkins"] >= 1
+    assert stats["in_use"] == 0
+
+
+def test_create_user_retry():
+    headers = {"Idempotency-Key": "create-user-retry"}
+    user = {"email": "retry@example.com", "password": "x"}
+    first = client.post("/users/", json=user, headers=headers)
+    # without the key, the retry would be "Email already registered"
+    retry = client.post("/users/", json=user, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    item = {"title": "Retry"}
+    path = f"/users/{first.json()['id']}/items/"
+    first = client.post(path, json=item, headers=headers)
+    assert client.post(path, json=item, headers=headers).json() == first.json()
+    assert len(client.get(f"/items/?owner_id={first.json()['owner_id']}").json()) == 1
+
+
+def test_threadpool_stats():
+    threadpool.reset()
+    client.get("/users/")
+    stats = client.get("/admin/threadpool", headers=ADMIN).json()
+    assert stats["size"] == threadpool.size
+    assert stats["pool"]["acquired"] == 1
+    assert stats["pool"]["active"] == 0
+
+
+def test_threadpool_route_limit():
+    pool = ThreadPool(size=4, route_limits={"work": 1})
+    running = []
+
+    @pool.instrument
+    def work():
+        running.append(1)
+        assert len(running) == 1
+        time.sleep(0.02)
+        running.pop()
+
+    async def run_all():
+        async with anyio.create_task_group() as tg:
+            for _ in range(3):
+                tg.start_soon(work)
+        return pool.snapshot()
+
+    stats = anyio.run(run_all)
+    # the route limit lets 1 request run at a time, the 2 others wait for it without taking a thread
+    assert stats["routes"]["work"]["acquired"] == 3
+    assert stats["routes"]["work"]["max_queued"] == 2
+    assert stats["routes"]["work"]["wait_max_ms"] > 10
+    assert stats["pool"]["max_active"] == 1
+
+
+def test_shards(tmp_path):
+    engines = [create_shard_engine(f"sqlite:///{tmp_path}/shard{index}.db") for index in range(3)]
+    schema.migrate_all(engines)
+    factories = [sessionmaker(bind=shard_engine) for shard_engine in engines]
+    db = LazySession(factories)
+
+    user_ids = [crud.create_user(db, schemas.UserCreate(email=f"user{i}@example.com", password="x")).id
+                for i in range(6)]
+    item_ids = []
+    for user_id in user_ids:
+        for title in ["A", "B"]:
+            item_ids.append(crud.create_user_item(db, schemas.ItemCreate(title=title), user_id).id)
+
+    # every user and its items are on the shard user_id % 3
+    for index, factory in enumerate(factories):
+        with factory() as shard_db:
+            shard_user_ids = [user.id for user in shard_db.query(models.User)]
+            assert shard_user_ids == [user_id for user_id in user_ids if user_id % 3 == index]
+            assert {item.owner_id % 3 for item in shard_db.query(models.Item)} <= {index}
+
+    # the ids are unique on all the shards, and the listings are merged in id order
+    assert len(set(item_ids)) == len(item_ids)
+    assert [user.id for user in crud.get_users(db, skip=1, limit=4)] == sorted(user_ids)[1:5]
+    assert [item.id for item in crud.get_items(db, skip=0, limit=100)] == sorted(item_ids)
+    assert [item.title for item in crud.get_items(db, owner_id=user_ids[4])] == ["A", "B"]
+    assert crud.get_user(db, user_ids[2]).email == "user2@example.com"
+    assert crud.get_user_by_email(db, "user5@example.com").id == user_ids[5]
+    assert crud.get_count(db, "users") == 6
+    assert crud.get_count(db, "items") == 12
+    assert crud.get_count(db, crud.owner_counter(user_ids[1]), user_id=user_ids[1]) == 2
+    summaries = crud.get_user_item_summaries(db, limit=100)
+    assert [(summary.user_id, summary.item_count) for summary in summaries] == [(user_id, 2) for user_id in user_ids]
+
+    # the email is unique on all the shards
+    with pytest.raises(IntegrityError):
+        crud.create_user(db, schemas.UserCreate(email="user1@example.com", password="x"))
+    db.close()
+
+
+def test_sparse_fieldsets():
+    user_id = client.post("/users/", json={"email": "sparse@example.com", "password": "secret"}).json()["id"]
+    client.post(f"/users/{user_id}/items/", json={"title": "Sparse", "description": "only some fields"})
+
+    threshold = slow_query_log.threshold
+    slow_query_log.threshold = 0
+    try:
+        client.delete("/admin/slow-queries", headers=ADMIN)
+        response = client.get("/users/?fields=id,email&limit=1000")
+        statements = [entry["statement"] for entry in client.get("/admin/slow-queries", headers=ADMIN).json()["entries"]]
+    finally:
+        slow_query_log.threshold = threshold
+
+    assert response.status_code == 200
+    assert {"id": user_id, "email": "sparse@example.com"} in response.json()
+    assert int(response.headers["X-Total-Count"]) >= 1
+    # only the asked columns are selected, and the items are not loaded
+    select_users = [statement for statement in statements if "FROM users" in statement]
+    assert select_users and "hashed_password" not in select_users[0] and "is_active" not in select_users[0]
+    assert not [statement for statement in statements if "FROM items" in statement]
+
+    response = client.get(f"/users/{user_id}?fields=email,items")
+    assert response.json() == {
+        "email": "sparse@example.com",
+        "items": [{"title": "Sparse", "description": "only some fields", "id": response.json()["items"][0]["id"],
+                   "owner_id": user_id, "version": 1}],
+    }
+    response = client.get(f"/items/?owner_id={user_id}&fields=title")
+    assert response.json() == [{"title": "Sparse"}]
+    assert response.headers["X-Total-Count"] == "1"
+    assert client.get("/users/summary/?fields=user_id,item_count&limit=1000").json()[-1] == {
+        "user_id": user_id, "item_count": 1,
+    }
+
+    response = client.get("/users/?fields=id,password")
+    assert response.status_code == 400
+    assert "password" in response.json()["detail"]
+
+
+def test_feed_users_out_of_order(tmp_path):
+    engines = [create_shard_engine(f"sqlite:///{tmp_path}/order{index}.db") for index in range(2)]
+    schema.migrate_all(engines)
+    factories = [sessionmaker(bind=shard_engine) for shard_engine in engines]
+    feed = ChangeFeed(factories)
+    feed.position = feed._current_position()
+
+    # the user 101 has its id in the index, but it's not committed on shard 1 yet
+    with factories[0]() as index_db:
+        index_db.add(models.UserIndex(id=101, email="slow@example.com"))
+        index_db.commit()
+    db = LazySession(factories)
+    user_ids = [crud.create_user(db, schemas.UserCreate(email=f"order{i}@example.com", password="x")).id
+                for i in range(2)]
+    db.close()
+    assert user_ids == [102, 103]
+    # 102 is on shard 0, 103 waits for 101
+    assert [e.id for e in feed._poll()] == [102]
+    assert feed.position["u1"] == 0
+
+    with factories[1]() as user_db:
+        user_db.add(models.User(id=101, email="slow@example.com", hashed_password="x"))
+        user_db.commit()
+    assert [e.id for e in feed._poll()] == [101, 103]
+
+    # a gap that never settles is given up
+    with factories[0]() as index_db:
+        index_db.add(models.UserIndex(id=105, email="lost@example.com"))
+        index_db.commit()
+    with factories[1]() as user_db:
+        user_db.add(models.User(id=107, email="late@example.com", hashed_password="x"))
+        user_db.commit()
+    assert feed._poll() == []
+    feed.settle_seconds = 0
+    assert [e.id for e in feed._poll()] == [107]
+    assert feed._gaps == {}
+
+
+def test_patch_user_and_item():
+    user = client.post("/users/", json={"email": "patch@example.com", "password": "x"}).json()
+    item = client.post(f"/users/{user['id']}/items/", json={"title": "Old", "description": "kept"}).json()
+    assert user["version"] == item["version"] == 1
+
+    threshold = slow_query_log.threshold
+    slow_query_log.threshold = 0
+    try:
+        client.delete("/admin/slow-queries", headers=ADMIN)
+        response = client.patch(f"/items/{item['id']}", json={"title": "New", "version": 1})
+        # the same value again: nothing changed, so no UPDATE and the version stays
+        same = client.patch(f"/items/{item['id']}", json={"title": "New"})
+    finally:
+        slow_query_log.threshold = threshold
+    assert response.status_code == 200
+    assert response.json() == {**item, "title": "New", "version": 2}
+    assert same.json()["version"] == 2
+
+    # only the column that changed is in the UPDATE, with the version check
+    updates = [e["statement"] for e in client.get("/admin/slow-queries", headers=ADMIN).json()["entries"]
+               if e["statement"].lstrip().startswith("UPDATE items")]
+    assert len(updates) == 1
+    assert "title=" in updates[0] and "description" not in updates[0] and "WHERE items.id" in updates[0]
+    assert "items.version = ?" in updates[0]
+    summary = [s for s in client.get("/users/summary/?limit=1000").json() if s["user_id"] == user["id"]]
+    assert summary[0]["latest_item_title"] == "New"
+
+    # a client that read version 1 can't overwrite the change
+    response = client.patch(f"/items/{item['id']}", json={"description": "lost", "version": 1})
+    assert response.status_code == 409
+    assert client.patch(f"/items/{item['id']}", json={"title": None}).status_code == 422
+    assert client.patch("/items/999999", json={"title": "x"}).status_code == 404
+
+    response = client.patch(f"/users/{user['id']}", json={"email": "patched@example.com", "is_active": False})
+    assert response.status_code == 200
+    assert response.json()["version"] == 2 and not response.json()["is_active"]
+    assert client.post("/users/", json={"email": "patch@example.com", "password": "x"}).status_code == 200
+    response = client.patch(f"/users/{user['id']}", json={"email": "patch@example.com"})
+    assert response.status_code == 400
+    assert client.patch(f"/users/{user['id']}", json={"email": None}).status_code == 422
+
+
+def test_patch_on_shards(tmp_path):
+    engines = [create_shard_engine(f"sqlite:///{tmp_path}/shard{index}.db") for index in range(2)]
+    schema.migrate_all(engines)
+    db = LazySession([sessionmaker(bind=shard_engine) for shard_engine in engines])
+    user_ids = [crud.create_user(db, schemas.UserCreate(email=f"user{i}@example.com", password="x")).id
+                for i in range(2)]
+    item = crud.create_user_item(db, schemas.ItemCreate(title="A"), user_ids[1])
+
+    # the user of shard 1 changes its email, the global index on shard 0 follows
+    crud.update_user(db, user_ids[1], {"email": "moved@example.com"}, version=1)
+    assert crud.get_user_by_email(db, "moved@example.com").id == user_ids[1]
+    assert crud.get_user_by_email(db, "user1@example.com") is None
+    # the email of the other user is taken, nothing is changed
+    with pytest.raises(IntegrityError):
+        crud.update_user(db, user_ids[1], {"email": "user0@example.com"})
+    assert crud.get_user(db, user_ids[1]).email == "moved@example.com"
+
+    assert crud.update_item(db, item.id, {"title": "B"}, version=1).version == 2
+    with pytest.raises(crud.VersionConflict) as conflict:
+        crud.update_item(db, item.id, {"title": "C"}, version=1)
+    assert conflict.value.current_version == 2
+    db.close()
+
+
+def test_migrate_adds_versions(tmp_path):
+    old_engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    with old_engine.begin() as connection:
+        # a db at schema version 4, before the version columns
+        for target in range(1, 5):
+            schema.MIGRATIONS[target](connection)
+            connection.execute(models.SchemaVersion.__table__.insert().values(version=target))
+        connection.exec_driver_sql("ALTER TABLE users DROP COLUMN version")
+        connection.exec_driver_sql("INSERT INTO users (id, email, hashed_password, is_active) VALUES (1, 'a', 'x', 1)")
+    schema.migrate(old_engine)
+    with sessionmaker(bind=old_engine)() as db:
+        assert crud.update_user(db, 1, {"is_active": False}, version=1).version == 2
+
+
+def test_feed(tmp_path):
+    engines = [create_shard_engine(f"sqlite:///{tmp_path}/feed{index}.db") for index in range(2)]
+    schema.migrate_all(engines)
+    factories = [sessionmaker(bind=shard_engine) for shard_engine in engines]
+
+    def create(email, titles):
+        db = LazySession(factories)
+        user_id = crud.create_user(db, schemas.UserCreate(email=email, password="x")).id
+        for title in titles:
+            crud.create_user_item(db, schemas.ItemCreate(title=title), user_id)
+        db.close()
+        return user_id
+
+    async def next_events(stream, count):
+        events = []
+        while len(events) < count:
+            chunk = (await stream.__anext__()).decode()
+            events += [block for block in chunk.split("\n\n") if block.startswith("id:")]
+        return events
+
+    async def run():
+        # a long poll interval: only the commits wake the feed up
+        feed = ChangeFeed(factories, poll_interval=60, buffer_size=4, queue_size=1)
+        await feed.start()
+        try:
+            subscriber = feed.subscribe()
+            stream = feed.stream(subscriber)
+            assert await stream.__anext__() == b"retry: 1000\n\n"
+            user_id = await anyio.to_thread.run_sync(create, "feed1@example.com", ["A"])
+            events = await next_events(stream, 2)
+            assert "event: user" in events[0] and f'"id": {user_id}' in events[0]
+            assert "event: item" in events[1] and '"title": "A"' in events[1]
+            last_event_id = events[1].splitlines()[0][len("id: "):]
+            await stream.aclose()
+            assert feed.snapshot()["subscribers"] == 0
+
+            # resume after a disconnect: the missed events come from the buffer
+            await anyio.to_thread.run_sync(create, "feed2@example.com", ["B"])
+            await anyio.sleep(0.1)
+            stream = feed.stream(feed.subscribe(last_event_id))
+            await stream.__anext__()
+            events = await next_events(stream, 2)
+            assert '"feed2@example.com"' in events[0] and '"title": "B"' in events[1]
+            await stream.aclose()
+
+            # too far behind: the events are not in the buffer of 4 events anymore
+            await anyio.to_thread.run_sync(create, "feed3@example.com", ["C", "D", "E"])
+            await anyio.sleep(0.1)
+            stream = feed.stream(feed.subscribe(last_event_id))
+            await stream.__anext__()
+            assert (await stream.__anext__()).startswith(b"event: reset")
+            await stream.aclose()
+
+            # a slow subscriber: its queue of 1 batch is full, it catches up from the buffer
+            stream = feed.stream(feed.subscribe())
+            await stream.__anext__()
+            for email in ["feed4@example.com", "feed5@example.com"]:
+                await anyio.to_thread.run_sync(create, email, [])
+                await anyio.sleep(0.1)
+            events = await next_events(stream, 2)
+            assert '"feed4@example.com"' in events[0] and '"feed5@example.com"' in events[1]
+            await stream.aclose()
+            return feed.snapshot()
+        finally:
+            await feed.stop()
+
+    stats = anyio.run(run)
+    assert stats["events"] == 10
+    assert stats["resets"] == 1
+    assert stats["lagged"] >= 1
+
+
+def test_batch():
+    user_id = client.post("/users/", json={"email": "batch@example.com", "password": "x"}).json()["id"]
+    requests = [{"path": f"/users/{user_id}"}, {"path": f"/items/?owner_id={user_id}&fields=title"}]
+    requests += [{"method": "POST", "path": f"/users/{user_id}/items/", "body": {"title": f"Batch {i}"}}
+                 for i in range(10)]
+    created = pool_stats.snapshot(engine.pool)["sessions_created"]
+    response = client.post("/batch/", json={"requests": requests})
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["status"] for result in results] == [200] * 12
+    assert results[0]["body"]["email"] == "batch@example.com"
+    assert {result["body"]["title"] for result in results[2:]} == {f"Batch {i}" for i in range(10)}
+    # 1 session per batch slot, not 1 per sub-request
+    assert pool_stats.snapshot(engine.pool)["sessions_created"] - created <= 8
+    assert len(client.get(f"/items/?owner_id={user_id}").json()) == 10
+
+
+def test_batch_lane_after_a_failure(monkeypatch):
+    user_id = client.post("/users/", json={"email": "lane@example.com", "password": "x"}).json()["id"]
+
+    def create_user(db, user):
+        # fails in the middle of a transaction, without a rollback
+        db.add(models.User(id=user_id, email=user.email, hashed_password="x"))
+        db.flush()
+
+    monkeypatch.setattr(crud, "create_user", create_user)
+    # 1 slot: the sub-requests after the failure run on the same session
+    monkeypatch.setattr(batch_dispatcher, "concurrency", 1)
+    requests = [{"method": "POST", "path": "/users/", "body": {"email": "lane2@example.com", "password": "x"}},
+                {"path": f"/users/{user_id}"},
+                {"method": "POST", "path": f"/users/{user_id}/items/", "body": {"title": "After"}}]
+    results = client.post("/batch/", json={"requests": requests}).json()
+    assert [result["status"] for result in results] == [400, 200, 200]
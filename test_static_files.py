@@ -0,0 +1,124 @@
+import os
+from email.utils import formatdate
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import static_files
+from static_files import FileCache, FileServer, parse_range
+
+# tests for static_files.py, run by: pytest test_static_files.py
+client = TestClient(main.app)
+
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    (tmp_path / "public").mkdir()
+    (tmp_path / "public" / "data.bin").write_bytes(CONTENT)
+    (tmp_path / "public" / "site.css").write_text("body {}")
+    (tmp_path / "secret.txt").write_text("secret")
+    monkeypatch.setattr(main, "files", FileServer(str(tmp_path / "public"), FileCache(max_file_size=512)))
+    return tmp_path / "public"
+
+
+def test_read_file(root):
+    response = client.get("/files/site.css")
+    assert response.status_code == 200
+    assert response.text == "body {}"
+    assert response.headers["content-type"].startswith("text/css")
+    assert response.headers["accept-ranges"] == "bytes"
+
+    # data.bin is bigger than max_file_size, so it's sent in chunks instead of from the cache
+    response = client.get("/files/data.bin")
+    assert response.content == CONTENT
+    assert response.headers["content-length"] == str(len(CONTENT))
+
+    response = client.head("/files/data.bin")
+    assert response.status_code == 200
+    assert response.content == b""
+    assert response.headers["content-length"] == str(len(CONTENT))
+
+
+def test_read_file_chunks(root, monkeypatch):
+    # data.bin is sent in chunks of 100 bytes, the last one is shorter
+    monkeypatch.setattr(static_files, "CHUNK_SIZE", 100)
+    response = client.get("/files/data.bin")
+    assert response.content == CONTENT
+    response = client.get("/files/data.bin", headers={"Range": "bytes=150-449"})
+    assert response.status_code == 206
+    assert response.content == CONTENT[150:450]
+
+
+def test_read_file_outside_root(root):
+    os.symlink(root.parent / "secret.txt", root / "link.txt")
+    for path in ["/files/../secret.txt", "/files/%2e%2e/secret.txt", "/files/link.txt", "/files/missing.txt",
+                 "/files/"]:
+        assert client.get(path).status_code == 404, path
+
+
+def test_read_file_range(root):
+    response = client.get("/files/data.bin", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.content == CONTENT[10:20]
+    assert response.headers["content-range"] == f"bytes 10-19/{len(CONTENT)}"
+
+    response = client.get("/files/data.bin", headers={"Range": "bytes=-5"})
+    assert response.content == CONTENT[-5:]
+
+    response = client.get("/files/data.bin", headers={"Range": f"bytes={len(CONTENT)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+    # If-Range with an old ETag: the file changed, so the whole file is sent
+    response = client.get("/files/data.bin", headers={"Range": "bytes=0-9", "If-Range": '"old"'})
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+
+def test_read_file_not_modified(root):
+    response = client.get("/files/site.css")
+    etag = response.headers["etag"]
+    assert client.get("/files/site.css", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/files/site.css", headers={"If-Modified-Since": response.headers["last-modified"]}
+                      ).status_code == 304
+    old = formatdate(os.stat(root / "site.css").st_mtime - 60, usegmt=True)
+    assert client.get("/files/site.css", headers={"If-Modified-Since": old}).status_code == 200
+
+
+def test_file_cache(root):
+    cache = main.files.cache
+    client.get("/files/site.css")
+    client.get("/files/site.css")
+    assert cache.stats() == {"files": 1, "bytes": 7, "hits": 1, "misses": 1}
+
+    # a changed file is read again
+    (root / "site.css").write_text("body { color: red }")
+    os.utime(root / "site.css", ns=(0, 10 ** 9))
+    assert client.get("/files/site.css").text == "body { color: red }"
+
+
+def test_file_cache_budget():
+    cache = FileCache(max_bytes=10, max_file_size=10)
+    st = os.stat(__file__)
+    cache.put("a", st, b"12345")
+    cache.put("b", st, b"12345")
+    cache.get("a", st)
+    # "b" is the least recently used, it's dropped for "c"
+    cache.put("c", st, b"123")
+    assert cache.get("b", st) is None
+    assert cache.get("a", st) == b"12345"
+    assert cache.bytes == 8
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1000) == (0, 100)
+    assert parse_range("bytes=900-", 1000) == (900, 1000)
+    assert parse_range("bytes=-100", 1000) == (900, 1000)
+    assert parse_range("bytes=0-5000", 1000) == (0, 1000)
+    assert parse_range("bytes=0-1,5-6", 1000) is None
+    assert parse_range("items=0-1", 1000) is None
+    with pytest.raises(ValueError):
+        parse_range("bytes=1000-", 1000)
@@ -0,0 +1,28 @@
+from main import Image, Item
+from trusted import construct_trusted
+
+
+# construct_trusted() should give the same model as the validation, but without validating
+# run by: pytest test_trusted.py
+
+
+def test_construct_trusted_builds_nested_models():
+    data = {
+        "name": "Foo",
+        "price": 35.4,
+        "tags2": ["a", "b"],
+        "image": {"url": "http://example.com/a.png", "name": "a"},
+        "images": [{"url": "http://example.com/b.png", "name": "b"}],
+        "not_a_field": "ignored",
+    }
+    item = construct_trusted(Item, data)
+    assert isinstance(item.image, Image)
+    assert isinstance(item.images[0], Image)
+    assert item == Item.parse_obj(data)
+    assert item.__fields_set__ == {"name", "price", "tags2", "image", "images"}
+
+
+def test_construct_trusted_does_not_validate():
+    # "description" must have at least 10 characters, but trusted data is not checked
+    item = construct_trusted(Item, {"name": "Foo", "price": 1, "description": "short"})
+    assert item.description == "short"
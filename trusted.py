@@ -0,0 +1,96 @@
+import os
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Any, Type, TypeVar
+
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SET, SHAPE_SINGLETON, SHAPE_TUPLE_ELLIPSIS
+
+# Build pydantic models WITHOUT validation, for data that we produced ourselves
+# such as the data from our own fake_db or our own database
+#
+# !important: only use it for trusted data, NEVER for the data from the client
+# client data must go through the normal validation, ex: async def create_item(item: Item)
+#
+# Model.construct() of pydantic also skips validation, but it doesn't build the nested models
+# ex: Item.construct(images=[{"url": ..., "name": ...}]).images[0] is still a dict, not an Image
+# construct_trusted() builds the nested models as well, so the result looks like a validated model
+#
+# set TRUSTED_CONSTRUCT=0 to validate everything again, it's useful when you suspect the stored data is bad
+
+TRUSTED_CONSTRUCT = os.getenv("TRUSTED_CONSTRUCT", "1") != "0"
+
+Model = TypeVar("Model", bound=BaseModel)
+
+_MISSING = object()
+
+
+def _is_model(type_) -> bool:
+    return isinstance(type_, type) and issubclass(type_, BaseModel)
+
+
+@lru_cache(maxsize=None)
+def _plan(model: Type[BaseModel]):
+    # read the fields of the model once, then reuse it for every construct
+    plan = []
+    for name, field in model.__fields__.items():
+        nested = field.type_ if _is_model(field.type_) and not field.sub_fields_mapping else None
+        if nested is not None and field.shape not in (SHAPE_SINGLETON, SHAPE_LIST, SHAPE_SET, SHAPE_TUPLE_ELLIPSIS):
+            nested = None
+        plan.append((name, field.alias, field, nested))
+    return plan
+
+
+def _build_nested(nested: Type[BaseModel], shape: int, value: Any) -> Any:
+    if value is None:
+        return None
+    if shape == SHAPE_SINGLETON:
+        return value if isinstance(value, nested) else _construct(nested, value)
+    items = [v if isinstance(v, nested) or v is None else _construct(nested, v) for v in value]
+    if shape == SHAPE_SET:
+        return set(items)
+    if shape == SHAPE_TUPLE_ELLIPSIS:
+        return tuple(items)
+    return items
+
+
+def _construct(model: Type[Model], data: Any) -> Model:
+    # data can be a dict, or an object (such as an ORM model) when the model uses orm_mode
+    if isinstance(data, Mapping):
+        get = data.get
+    else:
+        def get(key, default):
+            return getattr(data, key, default)
+
+    values = {}
+    fields_set = set()
+    for name, alias, field, nested in _plan(model):
+        value = get(alias, _MISSING)
+        if value is _MISSING and alias != name:
+            value = get(name, _MISSING)
+        if value is _MISSING:
+            if field.required:
+                continue
+            values[name] = field.get_default()
+            continue
+        fields_set.add(name)
+        if nested is not None:
+            value = _build_nested(nested, field.shape, value)
+        elif field.shape == SHAPE_SET and isinstance(value, list):
+            # sets are stored as lists in JSON
+            value = set(value)
+        values[name] = value
+
+    obj = model.__new__(model)
+    object.__setattr__(obj, "__dict__", values)
+    object.__setattr__(obj, "__fields_set__", fields_set)
+    obj._init_private_attributes()
+    return obj
+
+
+def construct_trusted(model: Type[Model], data: Any) -> Model:
+    if not TRUSTED_CONSTRUCT:
+        if isinstance(data, Mapping) or not model.__config__.orm_mode:
+            return model.parse_obj(data)
+        return model.from_orm(data)
+    return _construct(model, data)